@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+浏览数据导出工具
+将 browser_history / bookmarks / 分析汇总表导出为 Parquet 或 Arrow IPC，供离线分析使用
+
+用法示例:
+    python export_data.py browser_history -o history.parquet
+    python export_data.py bookmarks --format arrow -o bookmarks.arrows
+    python export_data.py browser_history --start 2024-01-01 --end 2024-02-01 --columns url,title,visit_time
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import time
+
+# server.py 使用相对路径加载模板/静态资源与数据库，需在 backend 目录下导入；
+# 命令行中的相对路径仍按调用时的工作目录解析
+INVOCATION_DIR = os.getcwd()
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import HTTPException  # noqa: E402
+
+import server  # noqa: E402
+
+
+def parse_time(value):
+    """解析时间参数：支持 Unix 毫秒或 YYYY-MM-DD[ HH:MM[:SS]]（本地时间）"""
+    if value is None:
+        return None
+    if value.isdigit():
+        return int(value)
+    for fmt in ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return int(datetime.datetime.strptime(value, fmt).timestamp() * 1000)
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"无法解析时间: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导出浏览数据为 Parquet / Arrow IPC")
+    parser.add_argument("dataset", choices=sorted(server.EXPORT_DATASETS.keys()), help="导出的数据集")
+    parser.add_argument("-o", "--output", help="输出文件路径（默认: <dataset>.<格式后缀>）")
+    parser.add_argument("--format", choices=sorted(server.EXPORT_FORMATS.keys()), default="parquet", help="导出格式")
+    parser.add_argument("--columns", help="逗号分隔的导出列（默认全部）")
+    parser.add_argument("--start", type=parse_time, help="起始时间（含）")
+    parser.add_argument("--end", type=parse_time, help="结束时间（不含）")
+    parser.add_argument("--batch-rows", type=int, default=server.EXPORT_BATCH_ROWS, help="每个 row group 的行数")
+    parser.add_argument("--db", help=f"数据库文件路径（默认: backend/{server.DATABASE_FILE}）")
+    args = parser.parse_args()
+
+    if args.db:
+        server.DATABASE_FILE = os.path.join(INVOCATION_DIR, args.db)
+    output = os.path.join(
+        INVOCATION_DIR, args.output or f"{args.dataset}.{server.EXPORT_FORMATS[args.format][1]}"
+    )
+
+    try:
+        columns = server.resolve_export_columns(args.dataset, args.columns)
+        started = time.time()
+        written = 0
+        with open(output, "wb") as f:
+            for chunk in server.iter_export_chunks(
+                args.dataset, args.format, columns, args.start, args.end, max(1024, args.batch_rows)
+            ):
+                f.write(chunk)
+                written += len(chunk)
+    except HTTPException as e:
+        print(f"❌ 导出失败: {e.detail}", file=sys.stderr)
+        return 1
+
+    print(f"✅ 已导出 {args.dataset} -> {output} ({written / 1024 / 1024:.2f} MB, 用时 {time.time() - started:.2f}s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
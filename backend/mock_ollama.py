@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地模拟 Ollama 服务（压测 / CI 用）
+实现 /api/tags 与 /api/generate（流式与非流式），无需真实模型即可端到端测量分析、批量创作与书签分类的吞吐
+
+- 响应内容只由 模型 + 提示词 决定，同一请求总是得到相同文本；书签分类提示词返回合法的分类JSON数组
+- 首字延迟按可配置的分布抽样，生成速度按 tokens/秒 逐个输出片段，返回 Ollama 格式的耗时统计
+- 可注入故障：HTTP 500、长时间挂起、流式输出中途断开；抽样以 种子+提示词+第几次请求 为种子，结果可复现
+
+用法示例:
+    python mock_ollama.py --port 11435 --models gemma3,qwen2.5
+    python mock_ollama.py --latency lognormal:300,0.5 --tokens-per-sec 40 --error-rate 0.02
+    python mock_ollama.py --parallel 2 --load-ms 1500 --drop-rate 0.05 --seed 7
+    然后在 AI 配置中把 base_url 指向 http://localhost:11435
+"""
+
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import random
+import re
+import sys
+import time
+from urllib.parse import urlsplit
+
+from aiohttp import web
+
+CLASSIFY_MARKER = "书签列表："
+CLASSIFY_ITEM_RE = re.compile(r"^\{id:'(.*?)', title:'(.*)', url:'(.*)'\}$")
+# 与后端 estimate_tokens 的估算口径一致：CJK字符1个token，其余约4个字符1个token
+TOKEN_RE = re.compile(r"[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]|[^\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]{1,4}", re.S)
+
+# 分类规则：按域名/标题关键词命中，否则按URL哈希取一个分类
+CATEGORY_KEYWORDS = [
+    ("技术", ("github", "stackoverflow", "python", "api", "docs", "dev", "代码", "编程", "教程")),
+    ("学习", ("course", "learn", "edu", "wiki", "课程", "学习", "论文")),
+    ("工作", ("jira", "confluence", "notion", "slack", "office", "会议", "项目")),
+    ("娱乐", ("youtube", "bilibili", "netflix", "music", "game", "视频", "游戏")),
+    ("购物", ("taobao", "jd.com", "amazon", "shop", "购物", "商城")),
+    ("理财", ("bank", "stock", "fund", "finance", "理财", "基金", "股票")),
+    ("设计", ("figma", "dribbble", "behance", "design", "设计")),
+]
+FALLBACK_CATEGORIES = ["技术", "学习", "工作", "生活", "娱乐", "产品", "设计"]
+VOCABULARY = (
+    "浏览 习惯 显示 用户 关注 技术 学习 效率 工具 内容 数据 分析 趋势 主题 兴趣 "
+    "时间 分布 高频 网站 建议 总结 持续 深入 领域 实践 开发 阅读 资料 方向"
+).split()
+
+
+def parse_latency(spec):
+    """解析首字延迟分布（毫秒）: fixed:MS | uniform:MIN,MAX | normal:MEAN,STD | lognormal:MEDIAN,SIGMA"""
+    kind, _, params = spec.partition(":")
+    try:
+        values = [float(v) for v in params.split(",")] if params else []
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无法解析延迟分布: {spec}")
+    arity = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+    if kind not in arity or len(values) != arity[kind]:
+        raise argparse.ArgumentTypeError(f"无法解析延迟分布: {spec}")
+    return kind, values
+
+
+def sample_latency_ms(rng, latency):
+    kind, values = latency
+    if kind == "fixed":
+        return values[0]
+    if kind == "uniform":
+        return rng.uniform(values[0], values[1])
+    if kind == "normal":
+        return max(0.0, rng.gauss(values[0], values[1]))
+    return values[0] * rng.lognormvariate(0, values[1])
+
+
+def split_tokens(text):
+    return TOKEN_RE.findall(text)
+
+
+def classify_response(prompt):
+    """为 build_bookmark_classify_prompt 生成的提示词输出合法的分类JSON数组"""
+    section = prompt.split(CLASSIFY_MARKER, 1)[1]
+    results = []
+    for line in section.splitlines():
+        match = CLASSIFY_ITEM_RE.match(line.strip())
+        if not match:
+            continue
+        item_id, title, url = match.groups()
+        host = (urlsplit(url).hostname or "").lower()
+        haystack = f"{host} {title.lower()}"
+        category = next(
+            (name for name, keywords in CATEGORY_KEYWORDS if any(k in haystack for k in keywords)),
+            FALLBACK_CATEGORIES[int(hashlib.md5(url.encode("utf-8")).hexdigest(), 16) % len(FALLBACK_CATEGORIES)],
+        )
+        words = [w for w in re.split(r"[\s\-_|·:：,，/]+", title) if 1 < len(w) <= 12]
+        tags = list(dict.fromkeys([category] + words[:3] + ([host.split(".")[-2]] if host.count(".") else [])))[:5]
+        digest = int(hashlib.md5(f"{item_id}|{url}".encode("utf-8")).hexdigest(), 16)
+        results.append({"id": item_id, "category": category, "tags": tags, "confidence": round(0.6 + (digest % 40) / 100, 2)})
+    return "[\n" + ",\n".join("  " + json.dumps(r, ensure_ascii=False) for r in results) + "\n]"
+
+
+def text_response(model, prompt, tokens):
+    """按 模型+提示词 生成固定的中文段落（约 tokens 个token）"""
+    rng = random.Random(hashlib.sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest())
+    parts, count = [], 0
+    while count < tokens:
+        sentence = "".join(rng.choice(VOCABULARY) for _ in range(rng.randint(4, 9))) + "。"
+        parts.append(sentence)
+        count += len(split_tokens(sentence))
+        if rng.random() < 0.2:
+            parts.append("\n\n")
+    return "".join(parts).strip()
+
+
+class MockOllama:
+    def __init__(self, args):
+        self.args = args
+        self.models = [m.strip() for m in args.models.split(",") if m.strip()]
+        self.loaded = set()
+        self.seen = {}
+        self.parallel = asyncio.Semaphore(args.parallel) if args.parallel > 0 else None
+        self.stats = {"requests": 0, "errors": 0, "hangs": 0, "drops": 0}
+
+    def known(self, model):
+        return model in self.models or f"{model}:latest" in self.models or model.split(":")[0] in self.models
+
+    def rng_for(self, model, prompt):
+        """同一提示词的第 n 次请求使用固定的随机序列：并发顺序不影响结果，重试可能得到不同结果"""
+        key = hashlib.sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest()
+        n = self.seen.get(key, 0)
+        self.seen[key] = n + 1
+        return random.Random(f"{self.args.seed}|{key}|{n}")
+
+    async def tags(self, request):
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        return web.json_response({"models": [
+            {"name": m, "model": m, "modified_at": now, "size": 0, "digest": hashlib.sha256(m.encode()).hexdigest()}
+            for m in self.models
+        ]})
+
+    async def generate(self, request):
+        body = await request.json()
+        model = body.get("model", "")
+        prompt = body.get("prompt", "")
+        stream = body.get("stream", True)
+        if not self.known(model):
+            return web.json_response({"error": f"model '{model}' not found, try pulling it first"}, status=404)
+        self.stats["requests"] += 1
+
+        if self.parallel:
+            async with self.parallel:
+                return await self._generate(request, body, model, prompt, stream)
+        return await self._generate(request, body, model, prompt, stream)
+
+    async def _generate(self, request, body, model, prompt, stream):
+        args = self.args
+        rng = self.rng_for(model, prompt)
+        started = time.perf_counter()
+
+        load_ms = 0.0
+        if model not in self.loaded:
+            load_ms = args.load_ms
+            await asyncio.sleep(load_ms / 1000)
+            self.loaded.add(model)
+        if str(body.get("keep_alive", "")) in ("0", "0s", "0m"):
+            self.loaded.discard(model)
+
+        # 故障注入：按固定顺序抽样，保证同一种子下结果可复现
+        fail, hang, drop = rng.random() < args.error_rate, rng.random() < args.hang_rate, rng.random() < args.drop_rate
+        if hang:
+            self.stats["hangs"] += 1
+            await asyncio.sleep(args.hang_seconds)
+        if fail:
+            self.stats["errors"] += 1
+            return web.json_response({"error": "mock injected failure"}, status=500)
+
+        # 空提示词只加载模型（预加载/keep_alive 续期）
+        if not prompt:
+            return web.json_response(self._final(model, "", load_ms, 0, 0, 0.0, 0.0, started, "load"))
+
+        prompt_tokens = len(split_tokens(prompt))
+        prompt_eval_ms = prompt_tokens / args.prompt_tokens_per_sec * 1000
+        await asyncio.sleep((sample_latency_ms(rng, args.latency) + prompt_eval_ms) / 1000)
+
+        num_predict = (body.get("options") or {}).get("num_predict") or args.response_tokens
+        if CLASSIFY_MARKER in prompt:
+            tokens = split_tokens(classify_response(prompt))
+        else:
+            tokens = split_tokens(text_response(model, prompt, min(args.response_tokens, num_predict)))
+        done_reason = "stop"
+        if len(tokens) > num_predict:
+            tokens, done_reason = tokens[:num_predict], "length"
+        token_seconds = 1 / args.tokens_per_sec
+
+        if not stream:
+            await asyncio.sleep(len(tokens) * token_seconds)
+            return web.json_response(self._final(
+                model, "".join(tokens), load_ms, prompt_tokens, len(tokens), prompt_eval_ms,
+                len(tokens) * token_seconds * 1000, started, done_reason
+            ))
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        eval_started = time.perf_counter()
+        drop_at = rng.randint(1, max(1, len(tokens) - 1)) if drop else None
+        for index, token in enumerate(tokens):
+            if drop_at is not None and index == drop_at:
+                # 模拟后端崩溃：不发送 done 片段直接断开连接
+                self.stats["drops"] += 1
+                request.transport.close()
+                return response
+            await asyncio.sleep(token_seconds)
+            await response.write((json.dumps({
+                "model": model, "created_at": self._now(), "response": token, "done": False
+            }, ensure_ascii=False) + "\n").encode("utf-8"))
+        final = self._final(model, "", load_ms, prompt_tokens, len(tokens), prompt_eval_ms,
+                            (time.perf_counter() - eval_started) * 1000, started, done_reason)
+        await response.write((json.dumps(final, ensure_ascii=False) + "\n").encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def _final(self, model, text, load_ms, prompt_tokens, eval_tokens, prompt_eval_ms, eval_ms, started, done_reason):
+        """最终片段 / 非流式响应，耗时字段为纳秒（与 Ollama 一致）"""
+        return {
+            "model": model,
+            "created_at": self._now(),
+            "response": text,
+            "done": True,
+            "done_reason": done_reason,
+            "total_duration": int((time.perf_counter() - started) * 1e9),
+            "load_duration": int(load_ms * 1e6),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_eval_ms * 1e6),
+            "eval_count": eval_tokens,
+            "eval_duration": int(eval_ms * 1e6),
+        }
+
+
+def build_app(args):
+    mock = MockOllama(args)
+    app = web.Application()
+    app.router.add_get("/api/tags", mock.tags)
+    app.router.add_post("/api/generate", mock.generate)
+
+    async def report(_app):
+        print(f"📊 请求 {mock.stats['requests']} 次，注入失败 {mock.stats['errors']}，挂起 {mock.stats['hangs']}，断流 {mock.stats['drops']}")
+
+    app.on_cleanup.append(report)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟 Ollama 服务（确定性响应，用于压测与CI）")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=11435, help="监听端口")
+    parser.add_argument("--models", default="gemma3,gemma3:latest", help="逗号分隔的模型名（/api/tags 返回的列表）")
+    parser.add_argument("--latency", type=parse_latency, default=parse_latency("fixed:100"),
+                        help="首字延迟分布（毫秒）: fixed:MS | uniform:MIN,MAX | normal:MEAN,STD | lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="生成速度")
+    parser.add_argument("--prompt-tokens-per-sec", type=float, default=1000.0, help="提示词处理速度")
+    parser.add_argument("--response-tokens", type=int, default=120, help="普通文本响应的token数（受 num_predict 限制）")
+    parser.add_argument("--load-ms", type=float, default=0.0, help="模型首次加载耗时（冷启动，keep_alive=0 时每次都会重新加载）")
+    parser.add_argument("--parallel", type=int, default=0, help="同时处理的请求数（模拟 OLLAMA_NUM_PARALLEL，0 不限制）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 HTTP 500 的概率")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="挂起 --hang-seconds 后才响应的概率")
+    parser.add_argument("--hang-seconds", type=float, default=30.0, help="挂起时长")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="流式输出中途断开连接的概率")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子（延迟与故障抽样）")
+    args = parser.parse_args()
+    if args.tokens_per_sec <= 0 or args.prompt_tokens_per_sec <= 0:
+        parser.error("生成速度必须大于0")
+
+    print(f"✅ 模拟 Ollama 服务: http://{args.host}:{args.port} 模型: {args.models}")
+    web.run_app(build_app(args), host=args.host, port=args.port, print=None)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,18 +8,38 @@ FastAPI + SQLite 实现增量存储浏览历史
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel, field_validator
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import aiohttp
+import asyncio
+import contextvars
+import hashlib
 import json
 import sqlite3
 import datetime
 import logging
+import math
+import os
+import random
+import re
+import string
+import time
 import uvicorn
+from collections import OrderedDict, deque
 from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from html.parser import HTMLParser
+
+try:
+    # 可选依赖：仅数据导出（Parquet / Arrow IPC）需要
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -127,6 +147,7 @@ class AITestRequest(BaseModel):
     config_name: str
     prompt: str
     use_template: Optional[str] = None
+    no_cache: bool = False  # 跳过LLM响应缓存，强制重新生成
 
 class OllamaTestRequest(BaseModel):
     """Ollama连接测试请求"""
@@ -153,6 +174,12 @@ class BatchContentGenerationRequest(BaseModel):
     content_style: str
     target_audience: Optional[str] = None
     content_length: str = "medium"
+    no_cache: bool = False  # 跳过LLM响应缓存，强制重新生成
+
+class PageFetchRequest(BaseModel):
+    """网页正文预抓取请求模型"""
+    urls: List[str]
+    force: bool = False  # 忽略缓存与条件请求，重新下载
 
 class ContentPublishingRequest(BaseModel):
     """内容发布请求模型"""
@@ -168,6 +195,7 @@ class AcademicWorkRequest(BaseModel):
     use_user_profile: bool = True
     use_word_cloud: bool = True
     additional_context: Optional[str] = None
+    no_cache: bool = False  # 跳过LLM响应缓存，强制重新生成
 class BookmarkItem(BaseModel):
     """浏览器书签节点"""
     chrome_id: str
@@ -191,10 +219,19 @@ class BookmarkClassifyStartRequest(BaseModel):
     config_name: Optional[str] = None  # 指定AI配置名称
     scope: Optional[str] = 'all'  # all | unclassified
     limit: Optional[int] = None   # 限制数量（可选）
+    no_cache: bool = False        # 跳过LLM响应缓存，强制重新生成
+    no_classifier: bool = False   # 不使用本地预分类器，全部交给模型
 
 class BookmarkClassifyDraftUpdate(BaseModel):
     draft_json: Dict[str, Any]
 
+class AgentRunRequest(BaseModel):
+    """Agent模板批量执行请求模型"""
+    source: str = 'history'              # history | bookmarks
+    ids: Optional[List[str]] = None      # 历史记录 id 或书签 chrome_id；为空时取最近的条目
+    limit: Optional[int] = 20            # 未指定 ids 时取最近的条目数
+    no_cache: bool = False               # 跳过LLM响应缓存，强制重新生成
+
 
 # 数据库操作
 @contextmanager
@@ -214,6 +251,15 @@ def get_db_connection():
         if conn:
             conn.close()
 
+# 需要维护数据版本号的表（读接口的 ETag 由相关表的版本号派生）
+VERSIONED_TABLES = [
+    "browser_history",
+    "sync_stats",
+    "bookmarks",
+    "analyze_summaries",
+    "browsing_sessions",
+]
+
 def init_database():
     """初始化数据库表"""
     with get_db_connection() as conn:
@@ -309,6 +355,12 @@ def init_database():
             cursor.execute('ALTER TABLE browser_history ADD COLUMN tags TEXT DEFAULT ""')
         except sqlite3.OperationalError:
             pass  # 字段已存在
+
+        try:
+            # 预分类器给出的建议分类，与人工确认的 category 分开存放
+            cursor.execute('ALTER TABLE browser_history ADD COLUMN predicted_category TEXT')
+        except sqlite3.OperationalError:
+            pass  # 字段已存在
         
         # 创建内容生成任务表
         cursor.execute('''
@@ -319,7 +371,7 @@ def init_database():
                 agent_type TEXT NOT NULL,   -- 使用的Agent类型
                 content_style TEXT NOT NULL,
                 target_audience TEXT,
-                status TEXT DEFAULT 'pending',  -- pending, processing, completed, failed
+                status TEXT DEFAULT 'pending',  -- pending, processing, completed, failed, cancelled
                 progress INTEGER DEFAULT 0,    -- 0-100的进度
                 results TEXT,  -- JSON格式存储生成结果
                 error_message TEXT,
@@ -328,6 +380,22 @@ def init_database():
             )
         ''')
         
+        # 批量生成的逐条结果（每条完成即写入，按 item_index 保持原始顺序）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS content_generation_items (
+                task_id INTEGER NOT NULL,
+                item_index INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                status TEXT DEFAULT 'pending',  -- pending, running, success, failed
+                content TEXT,
+                error_message TEXT,
+                duration_ms INTEGER,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (task_id, item_index),
+                FOREIGN KEY (task_id) REFERENCES content_generation_tasks (id)
+            )
+        ''')
+        
         # 创建内容发布记录表
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS content_publishing (
@@ -382,11 +450,56 @@ def init_database():
                 ai_category TEXT,
                 ai_tags TEXT,
                 ai_confidence REAL,
+                ai_fingerprint TEXT,           -- AI分类时的标题+URL指纹，未变化的书签不再重复分类
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
 
+        try:
+            cursor.execute('ALTER TABLE bookmarks ADD COLUMN ai_fingerprint TEXT')
+        except sqlite3.OperationalError:
+            pass  # 字段已存在
+
+        # 本地预分类器的训练统计：人工确认的分类按域名、标题词计数
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS classifier_domain_stats (
+                domain TEXT NOT NULL,
+                category TEXT NOT NULL,
+                count INTEGER DEFAULT 0,
+                PRIMARY KEY (domain, category)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS classifier_token_stats (
+                token TEXT NOT NULL,
+                category TEXT NOT NULL,
+                count INTEGER DEFAULT 0,
+                PRIMARY KEY (token, category)
+            )
+        ''')
+        # 每个条目（书签/历史记录）当前计入统计的人工分类，改判时据此撤销旧计数
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS classifier_labels (
+                item_key TEXT PRIMARY KEY,     -- bookmark:<chrome_id> / history:<id>
+                domain TEXT NOT NULL,
+                tokens TEXT NOT NULL,          -- 空格分隔的标题词
+                category TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # 按规范化URL缓存的书签AI分类（同一链接收藏在多个文件夹时只分类一次）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bookmark_url_classifications (
+                url_key TEXT PRIMARY KEY,
+                category TEXT NOT NULL,
+                tags TEXT,
+                confidence REAL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
         # 书签分类会话表（草稿树）
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS bookmark_classify_sessions (
@@ -411,6 +524,166 @@ def init_database():
             )
         ''')
         
+        # 分段分析的阶段性总结（按周/月），签名未变化时直接复用
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analysis_window_summaries (
+                granularity TEXT NOT NULL,     -- week/month
+                window_key TEXT NOT NULL,      -- 周一日期或 YYYY-MM
+                signature TEXT NOT NULL,       -- 分段数据签名（记录数/最大ID/访问次数/更新时间 + 模型）
+                records INTEGER DEFAULT 0,
+                summary TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (granularity, window_key)
+            )
+        ''')
+        
+        # LLM调用遥测（环形缓冲，只保留最近 AI_TELEMETRY_MAX_ROWS 条）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ai_call_telemetry (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,          -- Unix秒
+                endpoint TEXT NOT NULL,            -- 发起调用的接口路由或后台任务类型
+                call_type TEXT NOT NULL,           -- generate | stream | warmup
+                backend TEXT,
+                model TEXT NOT NULL,
+                prompt_tokens INTEGER,
+                response_tokens INTEGER,
+                latency_ms REAL,
+                total_duration_ms REAL,            -- 以下为 Ollama 返回的耗时
+                load_duration_ms REAL,
+                prompt_eval_duration_ms REAL,
+                eval_duration_ms REAL,
+                cache_hit BOOLEAN DEFAULT 0,
+                outcome TEXT NOT NULL,             -- success | error | cancelled
+                error TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ai_call_telemetry_created ON ai_call_telemetry(created_at)')
+        
+        # 网页正文缓存（批量创作的来源网页），按 ETag/Last-Modified 条件请求复验
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS page_content_cache (
+                url TEXT PRIMARY KEY,
+                final_url TEXT,                -- 跟随重定向后的地址
+                http_status INTEGER,
+                etag TEXT,
+                last_modified TEXT,
+                title TEXT,
+                content TEXT,                  -- 提取的正文（不超过 PAGE_CONTENT_MAX_CHARS 字符）
+                truncated BOOLEAN DEFAULT 0,   -- 下载或正文超出上限被截断
+                fetched_at REAL,               -- 最近一次下载正文的时间（Unix秒）
+                checked_at REAL,               -- 最近一次请求（含304复验与失败）的时间
+                error TEXT
+            )
+        ''')
+        
+        # 浏览会话表（由 browser_history 增量切分生成）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS browsing_sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                start_time INTEGER NOT NULL,   -- Unix毫秒
+                end_time INTEGER NOT NULL,     -- Unix毫秒
+                duration_ms INTEGER DEFAULT 0,
+                visit_count INTEGER DEFAULT 0,
+                top_domains TEXT,              -- JSON: [{"domain": ..., "visits": ...}]
+                domain_counts TEXT,            -- JSON: {domain: visits}，用于增量合并
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # 分析任务状态表（增量处理水位线等）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics_state (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # 关键词索引：每条历史记录标题的词项（稀疏 文档-词 矩阵）与文档频率表
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS keyword_doc_terms (
+                history_id INTEGER NOT NULL,
+                term TEXT NOT NULL,
+                tf REAL NOT NULL,              -- 按访问次数加权后的词频
+                visit_time INTEGER NOT NULL,   -- 冗余存储，便于按时间范围聚合
+                PRIMARY KEY (history_id, term)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS keyword_doc_freq (
+                term TEXT PRIMARY KEY,
+                df INTEGER DEFAULT 0
+            )
+        ''')
+
+        # 画像汇总表：域名访问汇总、星期×小时访问直方图（随同步增量累加）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS history_domain_rollup (
+                domain TEXT PRIMARY KEY,
+                visits INTEGER DEFAULT 0,
+                last_visit_time INTEGER
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS history_time_rollup (
+                weekday INTEGER NOT NULL,   -- 0=周日 ... 6=周六
+                hour INTEGER NOT NULL,      -- 0-23，本地时间
+                visits INTEGER DEFAULT 0,
+                PRIMARY KEY (weekday, hour)
+            )
+        ''')
+
+        # 用户画像物化表（单行），记录计算时依赖的数据版本
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_profile (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                profile_json TEXT NOT NULL,
+                source_versions TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # 后台任务队列：长耗时AI任务持久化排队，由工作协程租约执行，重启后可恢复
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ai_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_type TEXT NOT NULL,
+                payload TEXT,                  -- JSON格式任务参数
+                status TEXT DEFAULT 'queued',  -- queued, running, succeeded, failed, cancelled
+                attempts INTEGER DEFAULT 0,
+                max_attempts INTEGER DEFAULT 3,
+                run_after REAL DEFAULT 0,      -- Unix秒，重试退避期间不会被领取
+                lease_owner TEXT,
+                lease_expires REAL,            -- Unix秒，租约过期后可被其他工作协程接管
+                heartbeat_at REAL,
+                cancel_requested INTEGER DEFAULT 0,
+                result TEXT,                   -- JSON格式执行结果
+                error_message TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # LLM响应缓存（持久层）：按 后端+模型+提示词哈希+生成参数 缓存完整输出
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS llm_response_cache (
+                cache_key TEXT PRIMARY KEY,
+                backend TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_hash TEXT NOT NULL,
+                options_json TEXT,
+                response TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL,      -- Unix秒
+                last_access REAL NOT NULL,     -- Unix秒，用于LRU淘汰
+                hits INTEGER DEFAULT 0
+            )
+        ''')
+        
         # 添加索引
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_browser_history_hidden ON browser_history(is_hidden)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_browser_history_invalid ON browser_history(is_invalid)')
@@ -423,6 +696,29 @@ def init_database():
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_bookmarks_ai_category ON bookmarks(ai_category)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_bookmarks_category ON bookmarks(category)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_bcs_status ON bookmark_classify_sessions(status)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_browsing_sessions_start ON browsing_sessions(start_time, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_browsing_sessions_end ON browsing_sessions(end_time)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_keyword_doc_terms_time ON keyword_doc_terms(visit_time, term)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_response_cache_access ON llm_response_cache(last_access)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ai_jobs_status ON ai_jobs(status, run_after)')
+
+        # 数据版本表：每张表一个递增计数器，任何写入都会通过触发器递增，用于生成 ETag
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS data_versions (
+                table_name TEXT PRIMARY KEY,
+                version INTEGER DEFAULT 0
+            )
+        ''')
+        for table in VERSIONED_TABLES:
+            cursor.execute('INSERT OR IGNORE INTO data_versions (table_name, version) VALUES (?, 0)', (table,))
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version
+                    AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE data_versions SET version = version + 1 WHERE table_name = '{table}';
+                    END
+                ''')
         
         conn.commit()
         logger.info("数据库初始化完成")
@@ -456,18 +752,20 @@ def insert_or_update_history_item(cursor, item: HistoryItem) -> bool:
             ))
             return False  # 表示是更新，不是新增
         else:
-            # 插入新记录
+            # 插入新记录（预分类器有把握时记录建议分类，category 只保存人工确认的分类）
+            predicted = category_classifier.predict(item.title, item.url)
             cursor.execute('''
                 INSERT INTO browser_history 
-                (url, title, visit_time, visit_count, first_visit_time, last_visit_time)
-                VALUES (?, ?, ?, ?, ?, ?)
+                (url, title, visit_time, visit_count, first_visit_time, last_visit_time, predicted_category)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (
                 item.url,
                 item.title,
                 item.visitTime,
                 item.visitCount or 1,
                 item.visitTime,
-                item.visitTime
+                item.visitTime,
+                predicted['category'] if predicted else None
             ))
             return True  # 表示是新增
     except Exception as e:
@@ -497,146 +795,2540 @@ def update_sync_stats(cursor, new_items_count: int):
     except Exception as e:
         logger.error(f"更新同步统计失败: {e}")
 
-# Web界面路由
-@app.get("/", response_class=HTMLResponse)
-async def read_root(request: Request):
-    """Web管理界面首页"""
-    return templates.TemplateResponse("index.html", {"request": request})
-
-@app.get("/ai", response_class=HTMLResponse)
-async def ai_config_page(request: Request):
-    """AI配置管理页面（简化版）"""
-    return templates.TemplateResponse("ai_simple.html", {"request": request})
-
-@app.get("/ai-advanced", response_class=HTMLResponse)
-async def ai_config_advanced_page(request: Request):
-    """AI配置管理页面（高级版）"""
-    return templates.TemplateResponse("ai_config.html", {"request": request})
-
-@app.get("/agents", response_class=HTMLResponse)
-async def agents_hub_page(request: Request):
-    """AI Agent工作台"""
-    return templates.TemplateResponse("agents_hub.html", {"request": request})
-
-@app.get("/links", response_class=HTMLResponse)
-async def link_management_page(request: Request):
-    """链接管理页面"""
-    return templates.TemplateResponse("link_management.html", {"request": request})
+def extract_domain(url: Optional[str]) -> str:
+    """从URL中提取域名（去掉协议与 www. 前缀）"""
+    if not url:
+        return ''
+    try:
+        return url.split('//', 1)[-1].split('/')[0].replace('www.', '')
+    except Exception:
+        return url
+
+# 判重时忽略的跟踪参数：utm_* 按前缀匹配，其余按参数名精确匹配
+TRACKING_QUERY_PREFIX = 'utm_'
+TRACKING_QUERY_KEYS = {
+    'spm', 'spm_id_from', 'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'mc_cid', 'mc_eid', '_hsenc', '_hsmi',
+}
+
+def normalize_bookmark_url(url: Optional[str]) -> str:
+    """规范化URL用于判重：忽略协议、www.、默认端口、锚点、末尾斜杠与跟踪参数，查询参数排序"""
+    if not url:
+        return ''
+    try:
+        parts = urlsplit(url.strip())
+        host = (parts.hostname or '').lower()
+        port = parts.port
+    except ValueError:
+        return url.strip()
+    if not host:
+        return url.strip()
+    if host.startswith('www.'):
+        host = host[4:]
+    if port and port not in (80, 443):
+        host = f"{host}:{port}"
+    query = urlencode(sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not (k.lower() in TRACKING_QUERY_KEYS or k.lower().startswith(TRACKING_QUERY_PREFIX))
+    ))
+    key = host + (parts.path.rstrip('/') or '')
+    return f"{key}?{query}" if query else key
+
+def get_analytics_state(cursor, key: str, default: Optional[str] = None) -> Optional[str]:
+    """读取分析状态值"""
+    cursor.execute('SELECT value FROM analytics_state WHERE key = ?', (key,))
+    row = cursor.fetchone()
+    return row['value'] if row else default
+
+def set_analytics_state(cursor, key: str, value) -> None:
+    """写入分析状态值"""
+    cursor.execute('''
+        INSERT INTO analytics_state (key, value, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP
+    ''', (key, str(value)))
+
+# 浏览会话切分参数
+SESSION_IDLE_GAP_MS = 30 * 60 * 1000   # 超过该间隔必定切分为新会话
+SESSION_SOFT_GAP_MS = 10 * 60 * 1000   # 超过该间隔且域名不连续时切分为新会话
+SESSION_TOP_DOMAINS = 5
+
+def _session_gap(start_a: int, end_a: int, start_b: int, end_b: int) -> int:
+    """两个时间区间之间的间隔（重叠时为0）"""
+    return max(0, start_b - end_a, start_a - end_b)
+
+def _session_continues(gap: int, domains_a, domains_b) -> bool:
+    """按不活跃间隔与域名连续性判断是否属于同一会话"""
+    if gap > SESSION_IDLE_GAP_MS:
+        return False
+    if gap > SESSION_SOFT_GAP_MS:
+        return any(d in domains_a for d in domains_b)
+    return True
+
+def _save_session_cluster(cursor, cluster: dict) -> None:
+    """将一段新切分出的访问并入相邻的已有会话（可能同时合并多个），或新建会话"""
+    cursor.execute('''
+        SELECT id, start_time, end_time, visit_count, domain_counts
+        FROM browsing_sessions
+        WHERE end_time >= ? AND start_time <= ?
+        ORDER BY start_time
+    ''', (cluster['start'] - SESSION_IDLE_GAP_MS, cluster['end'] + SESSION_IDLE_GAP_MS))
+    merged_ids = []
+    for row in cursor.fetchall():
+        counts = json.loads(row['domain_counts'] or '{}')
+        gap = _session_gap(cluster['start'], cluster['end'], row['start_time'], row['end_time'])
+        if not _session_continues(gap, cluster['domains'], counts):
+            continue
+        merged_ids.append(row['id'])
+        cluster['start'] = min(cluster['start'], row['start_time'])
+        cluster['end'] = max(cluster['end'], row['end_time'])
+        cluster['visits'] += row['visit_count'] or 0
+        for d, c in counts.items():
+            cluster['domains'][d] = cluster['domains'].get(d, 0) + c
+
+    top_domains = sorted(cluster['domains'].items(), key=lambda x: x[1], reverse=True)[:SESSION_TOP_DOMAINS]
+    values = (
+        cluster['start'],
+        cluster['end'],
+        cluster['end'] - cluster['start'],
+        cluster['visits'],
+        json.dumps([{"domain": d, "visits": c} for d, c in top_domains], ensure_ascii=False),
+        json.dumps(cluster['domains'], ensure_ascii=False),
+    )
+    if merged_ids:
+        cursor.execute('''
+            UPDATE browsing_sessions
+            SET start_time = ?, end_time = ?, duration_ms = ?, visit_count = ?,
+                top_domains = ?, domain_counts = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', values + (merged_ids[0],))
+        if len(merged_ids) > 1:
+            cursor.execute(f'''
+                DELETE FROM browsing_sessions WHERE id IN ({','.join(['?'] * (len(merged_ids) - 1))})
+            ''', merged_ids[1:])
+    else:
+        cursor.execute('''
+            INSERT INTO browsing_sessions
+            (start_time, end_time, duration_ms, visit_count, top_domains, domain_counts)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', values)
+
+def refresh_browsing_sessions(cursor) -> int:
+    """增量切分浏览会话：只处理水位线之后新增的访问记录，返回处理条数"""
+    last_id = int(get_analytics_state(cursor, 'sessions_last_history_id', '0'))
+    reader = cursor.connection.cursor()
+    reader.execute('''
+        SELECT id, url, visit_time
+        FROM browser_history
+        WHERE id > ?
+        ORDER BY visit_time, id
+    ''', (last_id,))
+
+    processed = 0
+    max_id = last_id
+    cluster = None
+    while True:
+        rows = reader.fetchmany(1000)
+        if not rows:
+            break
+        for r in rows:
+            processed += 1
+            max_id = max(max_id, r['id'])
+            domain = extract_domain(r['url'])
+            if cluster is not None:
+                gap = r['visit_time'] - cluster['end']
+                if _session_continues(gap, cluster['domains'], [domain]):
+                    cluster['end'] = max(cluster['end'], r['visit_time'])
+                    cluster['visits'] += 1
+                    cluster['domains'][domain] = cluster['domains'].get(domain, 0) + 1
+                    continue
+                _save_session_cluster(cursor, cluster)
+            cluster = {"start": r['visit_time'], "end": r['visit_time'], "visits": 1, "domains": {domain: 1}}
+    if cluster is not None:
+        _save_session_cluster(cursor, cluster)
+
+    if max_id != last_id:
+        set_analytics_state(cursor, 'sessions_last_history_id', max_id)
+    return processed
+
+# 关键词提取：标题分词（英文按单词、中文按二元组）+ 增量文档频率 + TF-IDF
+KEYWORD_STOPWORDS = {
+    # 英文虚词与网页常见噪声
+    "the", "and", "for", "with", "from", "that", "this", "you", "your", "are", "was", "not",
+    "how", "what", "why", "all", "can", "new", "use", "using", "into", "about", "our", "its",
+    "http", "https", "www", "com", "org", "net", "html", "htm", "php", "index", "home", "page",
+    "login", "sign", "signin", "search", "untitled", "null", "undefined",
+    # 中文高频无意义二元组
+    "首页", "官网", "登录", "注册", "搜索", "百度", "一下", "什么", "怎么", "如何", "可以",
+    "我们", "你的", "我的", "一个", "没有", "这个", "那个", "以及", "进行", "相关", "最新",
+    "免费", "下载", "官方", "网站", "主页", "页面",
+}
+_LATIN_TOKEN_RE = re.compile(r"[a-z][a-z0-9+#]*(?:[.\-][a-z0-9+#]+)*")
+_CJK_RUN_RE = re.compile(r"[\u4e00-\u9fff]+")
+KEYWORD_TIER_SIZE = 10  # 高/中/低频每档关键词数量
+
+def tokenize_title(text: Optional[str]) -> List[str]:
+    """标题分词：英文/数字按单词切分，中文连续片段按二元组切分，去除停用词"""
+    if not text:
+        return []
+    text = text.lower()
+    tokens = []
+    for word in _LATIN_TOKEN_RE.findall(text):
+        if len(word) >= 2 and word not in KEYWORD_STOPWORDS:
+            tokens.append(word)
+    for run in _CJK_RUN_RE.findall(text):
+        grams = [run[i:i + 2] for i in range(len(run) - 1)]
+        # 3-4 字的完整片段多为独立词（如“机器学习”），额外保留整体
+        if 3 <= len(run) <= 4:
+            grams.append(run)
+        tokens.extend(g for g in grams if g not in KEYWORD_STOPWORDS)
+    return tokens
+
+def title_tags(title: Optional[str], limit: int = 3) -> List[str]:
+    """从标题中取前几个关键词作为标签（跳过中文二元组碎片）"""
+    tags = [t for t in dict.fromkeys(tokenize_title(title)) if not (len(t) == 2 and _CJK_RUN_RE.fullmatch(t))]
+    return tags[:limit]
+
+def refresh_keyword_index(cursor) -> int:
+    """增量建立关键词索引：只处理水位线之后的新记录，同时累加文档频率"""
+    last_id = int(get_analytics_state(cursor, 'keywords_last_history_id', '0'))
+    doc_count = int(get_analytics_state(cursor, 'keywords_doc_count', '0'))
+    reader = cursor.connection.cursor()
+    reader.execute('''
+        SELECT id, title, visit_time, visit_count
+        FROM browser_history
+        WHERE id > ?
+        ORDER BY id
+    ''', (last_id,))
+
+    processed = 0
+    max_id = last_id
+    while True:
+        rows = reader.fetchmany(1000)
+        if not rows:
+            break
+        doc_terms = []
+        df_delta: Dict[str, int] = {}
+        for r in rows:
+            processed += 1
+            max_id = r['id']
+            tokens = tokenize_title(r['title'])
+            if not tokens:
+                continue
+            doc_count += 1
+            # 访问次数按对数加权，避免个别反复刷新的页面主导结果
+            weight = 1.0 + math.log(max(1, r['visit_count'] or 1))
+            counts: Dict[str, int] = {}
+            for t in tokens:
+                counts[t] = counts.get(t, 0) + 1
+            for term, tf in counts.items():
+                doc_terms.append((r['id'], term, tf * weight, r['visit_time']))
+                df_delta[term] = df_delta.get(term, 0) + 1
+        cursor.executemany('''
+            INSERT OR REPLACE INTO keyword_doc_terms (history_id, term, tf, visit_time)
+            VALUES (?, ?, ?, ?)
+        ''', doc_terms)
+        cursor.executemany('''
+            INSERT INTO keyword_doc_freq (term, df) VALUES (?, ?)
+            ON CONFLICT(term) DO UPDATE SET df = df + excluded.df
+        ''', list(df_delta.items()))
+
+    if max_id != last_id:
+        set_analytics_state(cursor, 'keywords_last_history_id', max_id)
+        set_analytics_state(cursor, 'keywords_doc_count', doc_count)
+    return processed
+
+def prune_keyword_index(cursor) -> int:
+    """从关键词索引中移除已删除历史记录的词项，并扣减文档频率与文档总数，返回移除的文档数"""
+    cursor.execute('''
+        SELECT term, COUNT(*) AS docs FROM keyword_doc_terms
+        WHERE history_id NOT IN (SELECT id FROM browser_history)
+        GROUP BY term
+    ''')
+    df_delta = [(r['docs'], r['term']) for r in cursor.fetchall()]
+    if not df_delta:
+        return 0
+    cursor.execute('''
+        SELECT COUNT(DISTINCT history_id) FROM keyword_doc_terms
+        WHERE history_id NOT IN (SELECT id FROM browser_history)
+    ''')
+    removed_docs = cursor.fetchone()[0]
+    cursor.executemany('UPDATE keyword_doc_freq SET df = df - ? WHERE term = ?', df_delta)
+    cursor.execute('DELETE FROM keyword_doc_freq WHERE df <= 0')
+    cursor.execute('DELETE FROM keyword_doc_terms WHERE history_id NOT IN (SELECT id FROM browser_history)')
+    doc_count = int(get_analytics_state(cursor, 'keywords_doc_count', '0'))
+    set_analytics_state(cursor, 'keywords_doc_count', max(0, doc_count - removed_docs))
+    return removed_docs
+
+def compute_keywords(cursor, start: Optional[int] = None, end: Optional[int] = None, limit: int = KEYWORD_TIER_SIZE * 3) -> List[Dict[str, Any]]:
+    """计算时间范围内的 TF-IDF 关键词（在 SQLite 中对稀疏词项表聚合）"""
+    doc_count = int(get_analytics_state(cursor, 'keywords_doc_count', '0'))
+    if doc_count == 0:
+        return []
+    where = []
+    params: list = []
+    if start is not None:
+        where.append("t.visit_time >= ?")
+        params.append(start)
+    if end is not None:
+        where.append("t.visit_time < ?")
+        params.append(end)
+    where_clause = ("WHERE " + " AND ".join(where)) if where else ""
+    cursor.execute(f'''
+        SELECT t.term AS term, SUM(t.tf) AS tf, COUNT(*) AS docs, f.df AS df
+        FROM keyword_doc_terms t
+        JOIN keyword_doc_freq f ON f.term = t.term
+        {where_clause}
+        GROUP BY t.term
+        HAVING COUNT(*) >= ?
+    ''', params + [2 if doc_count >= 20 else 1])
+    scored = []
+    for r in cursor.fetchall():
+        idf = math.log((doc_count + 1) / (r['df'] + 1)) + 1.0
+        scored.append({
+            "term": r['term'],
+            "score": round((1.0 + math.log(r['tf'])) * idf, 4),
+            "docs": r['docs'],
+        })
+    scored.sort(key=lambda x: (x['score'], x['docs'], len(x['term'])), reverse=True)
+
+    # 去掉被更长关键词完全覆盖的中文二元组碎片（如“器学”之于“机器学习”）
+    longer_terms = {k['term']: k['docs'] for k in scored if len(k['term']) > 2 and _CJK_RUN_RE.fullmatch(k['term'])}
+    keywords = []
+    for k in scored:
+        term = k['term']
+        if len(term) == 2 and any(term in t and docs >= k['docs'] for t, docs in longer_terms.items()):
+            continue
+        keywords.append(k)
+        if len(keywords) >= limit:
+            break
+    return keywords
+
+def build_keyword_tiers(keywords: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """将排序后的关键词切分为高/中/低频三档（词云数据格式）"""
+    terms = [k['term'] for k in keywords]
+    size = max(1, math.ceil(len(terms) / 3)) if terms else KEYWORD_TIER_SIZE
+    return {
+        "high_frequency": terms[:size],
+        "medium_frequency": terms[size:size * 2],
+        "low_frequency": terms[size * 2:size * 3],
+        "keywords": keywords,
+    }
 
-@app.get("/studio", response_class=HTMLResponse)
-async def agent_studio_page(request: Request):
-    """Agent工作室页面"""
-    return templates.TemplateResponse("agent_studio.html", {"request": request})
+def refresh_profile_rollups(cursor) -> int:
+    """增量累加域名与时段汇总：只处理水位线之后的新记录"""
+    last_id = int(get_analytics_state(cursor, 'rollups_last_history_id', '0'))
+    reader = cursor.connection.cursor()
+    reader.execute('''
+        SELECT id, url, visit_time
+        FROM browser_history
+        WHERE id > ?
+        ORDER BY id
+    ''', (last_id,))
+
+    processed = 0
+    max_id = last_id
+    while True:
+        rows = reader.fetchmany(1000)
+        if not rows:
+            break
+        domain_delta: Dict[str, List[int]] = {}
+        time_delta: Dict[tuple, int] = {}
+        for r in rows:
+            processed += 1
+            max_id = r['id']
+            domain = extract_domain(r['url'])
+            if domain:
+                stat = domain_delta.setdefault(domain, [0, 0])
+                stat[0] += 1
+                stat[1] = max(stat[1], r['visit_time'])
+            local_time = datetime.datetime.fromtimestamp(r['visit_time'] / 1000)
+            key = (local_time.isoweekday() % 7, local_time.hour)
+            time_delta[key] = time_delta.get(key, 0) + 1
+        cursor.executemany('''
+            INSERT INTO history_domain_rollup (domain, visits, last_visit_time) VALUES (?, ?, ?)
+            ON CONFLICT(domain) DO UPDATE SET
+                visits = visits + excluded.visits,
+                last_visit_time = MAX(COALESCE(last_visit_time, 0), excluded.last_visit_time)
+        ''', [(d, v[0], v[1]) for d, v in domain_delta.items()])
+        cursor.executemany('''
+            INSERT INTO history_time_rollup (weekday, hour, visits) VALUES (?, ?, ?)
+            ON CONFLICT(weekday, hour) DO UPDATE SET visits = visits + excluded.visits
+        ''', [(k[0], k[1], v) for k, v in time_delta.items()])
+
+    if max_id != last_id:
+        set_analytics_state(cursor, 'rollups_last_history_id', max_id)
+    return processed
+
+def rebuild_profile_rollups(cursor) -> int:
+    """清空并全量重建域名与时段汇总（汇总只随新增记录累加，删除历史记录后需调用）"""
+    cursor.execute('DELETE FROM history_domain_rollup')
+    cursor.execute('DELETE FROM history_time_rollup')
+    set_analytics_state(cursor, 'rollups_last_history_id', 0)
+    return refresh_profile_rollups(cursor)
+
+# 常见域名的兴趣分类提示（人工分类较少时用于补充兴趣推断）
+DOMAIN_CATEGORY_HINTS = {
+    "github.com": "技术", "gitlab.com": "技术", "stackoverflow.com": "技术", "csdn.net": "技术",
+    "juejin.cn": "技术", "segmentfault.com": "技术", "cnblogs.com": "技术", "v2ex.com": "技术",
+    "docs.python.org": "技术", "developer.mozilla.org": "技术", "huggingface.co": "技术", "arxiv.org": "学习",
+    "zhihu.com": "学习", "coursera.org": "学习", "bilibili.com": "娱乐", "youtube.com": "娱乐",
+    "douyin.com": "娱乐", "weibo.com": "生活", "xiaohongshu.com": "生活", "douban.com": "生活",
+    "taobao.com": "购物", "jd.com": "购物", "tmall.com": "购物", "amazon.com": "购物",
+    "xueqiu.com": "理财", "eastmoney.com": "理财", "figma.com": "设计", "dribbble.com": "设计",
+    "behance.net": "设计", "woshipm.com": "产品", "producthunt.com": "产品", "notion.so": "工作",
+    "feishu.cn": "工作", "dingtalk.com": "工作", "slack.com": "工作",
+}
+
+# 主要兴趣分类 -> 职业/身份推测
+CATEGORY_PROFESSION_HINTS = {
+    "技术": "程序员/技术从业者",
+    "设计": "设计师",
+    "产品": "产品经理",
+    "理财": "投资理财关注者",
+    "学习": "学生/终身学习者",
+    "工作": "职场办公人士",
+    "购物": "消费达人",
+    "娱乐": "娱乐内容爱好者",
+    "生活": "生活方式关注者",
+}
+
+PROFILE_UNCATEGORIZED = ("", "未分类")
+WEEKDAY_NAMES = ["周日", "周一", "周二", "周三", "周四", "周五", "周六"]
+
+def _domain_hint_category(domain: str) -> Optional[str]:
+    """按域名（含子域名）匹配分类提示"""
+    parts = domain.split('.')
+    for i in range(len(parts) - 1):
+        category = DOMAIN_CATEGORY_HINTS.get('.'.join(parts[i:]))
+        if category:
+            return category
+    return None
+
+def describe_activity_pattern(hour_histogram: List[int], weekday_histogram: List[int]) -> Dict[str, Any]:
+    """由时段直方图推导活动模式描述"""
+    total = sum(hour_histogram)
+    if total == 0:
+        return {"activity_pattern": "暂无数据", "peak_hours": []}
+    # 工作日/周末按天均值比较
+    weekday_avg = sum(weekday_histogram[1:6]) / 5
+    weekend_avg = (weekday_histogram[0] + weekday_histogram[6]) / 2
+    if weekday_avg >= weekend_avg * 1.3:
+        day_text = "工作日活跃"
+    elif weekend_avg >= weekday_avg * 1.3:
+        day_text = "周末活跃"
+    else:
+        day_text = "全周均衡"
+
+    peak_hours = [h for h in sorted(range(24), key=lambda h: hour_histogram[h], reverse=True)[:3] if hour_histogram[h] > 0]
+    night = sum(hour_histogram[h] for h in (22, 23, 0, 1, 2, 3, 4, 5)) / total
+    morning = sum(hour_histogram[h] for h in range(6, 12)) / total
+    if night >= 0.3:
+        time_text = "夜间活跃"
+    elif morning >= 0.4:
+        time_text = "上午活跃"
+    else:
+        time_text = "白天/傍晚活跃"
+    peak_text = "、".join(f"{h:02d}:00" for h in sorted(peak_hours))
+    return {
+        "activity_pattern": f"{day_text}，{time_text}（高峰 {peak_text}）",
+        "peak_hours": sorted(peak_hours),
+        "most_active_weekday": WEEKDAY_NAMES[max(range(7), key=lambda d: weekday_histogram[d])],
+    }
 
-@app.get("/bookmarks", response_class=HTMLResponse)
-async def bookmarks_page(request: Request):
-    """书签管理页面"""
-    return templates.TemplateResponse("bookmarks.html", {"request": request})
+def compute_user_profile(cursor) -> Dict[str, Any]:
+    """由汇总表与分类统计计算用户画像"""
+    # 兴趣：人工分类的历史/书签 + 高频域名的分类提示
+    interest_scores: Dict[str, float] = {}
+    cursor.execute('''
+        SELECT category, COUNT(*) AS cnt FROM browser_history
+        WHERE category IS NOT NULL GROUP BY category
+    ''')
+    for r in cursor.fetchall():
+        if r['category'] not in PROFILE_UNCATEGORIZED:
+            interest_scores[r['category']] = interest_scores.get(r['category'], 0) + r['cnt']
 
-@app.get("/bookmarks/classify", response_class=HTMLResponse)
-async def bookmarks_classify_page(request: Request):
-    """书签智能分类页面（会话草稿）"""
-    return templates.TemplateResponse("bookmarks_classify.html", {"request": request})
+    cursor.execute('''
+        SELECT COALESCE(NULLIF(category, ''), ai_category) AS cat, COUNT(*) AS cnt
+        FROM bookmarks
+        WHERE is_deleted = 0 AND type = 'bookmark'
+        GROUP BY cat
+        ORDER BY cnt DESC
+    ''')
+    bookmark_categories = [(r['cat'], r['cnt']) for r in cursor.fetchall() if r['cat'] and r['cat'] not in PROFILE_UNCATEGORIZED]
+    for cat, cnt in bookmark_categories:
+        # 收藏代表更强的兴趣信号
+        interest_scores[cat] = interest_scores.get(cat, 0) + cnt * 3
+
+    cursor.execute('SELECT domain, visits FROM history_domain_rollup ORDER BY visits DESC LIMIT 200')
+    domain_rows = cursor.fetchall()
+    for r in domain_rows:
+        cat = _domain_hint_category(r['domain'])
+        if cat:
+            interest_scores[cat] = interest_scores.get(cat, 0) + r['visits'] * 0.5
+    interests = [c for c, _ in sorted(interest_scores.items(), key=lambda x: x[1], reverse=True)][:5]
+
+    # 活动模式：星期×小时直方图
+    hour_histogram = [0] * 24
+    weekday_histogram = [0] * 7
+    cursor.execute('SELECT weekday, hour, visits FROM history_time_rollup')
+    for r in cursor.fetchall():
+        hour_histogram[r['hour']] += r['visits']
+        weekday_histogram[r['weekday']] += r['visits']
+    activity = describe_activity_pattern(hour_histogram, weekday_histogram)
+
+    # 内容偏好：书签分类
+    if bookmark_categories:
+        content_preference = "、".join(f"{c}类内容" for c, _ in bookmark_categories[:3])
+    elif interests:
+        content_preference = f"{interests[0]}类内容"
+    else:
+        content_preference = "暂无数据"
 
-# API端点
-@app.get("/api", response_model=ApiResponse)
-async def api_root():
-    """API根路径"""
-    return ApiResponse(
-        success=True,
-        message="浏览器历史记录API服务运行中",
-        data={
-            "version": "1.0.0",
-            "endpoints": ["/api/sync-single", "/api/sync-batch", "/api/stats", "/api/history"]
-        }
-    )
+    return {
+        "interests": interests,
+        "interest_scores": {c: round(interest_scores[c], 1) for c in interests},
+        "profession": CATEGORY_PROFESSION_HINTS.get(interests[0], "未知") if interests else "未知",
+        "activity_pattern": activity["activity_pattern"],
+        "peak_hours": activity["peak_hours"],
+        "most_active_weekday": activity.get("most_active_weekday"),
+        "content_preference": content_preference,
+        "top_domains": [{"domain": r['domain'], "visits": r['visits']} for r in domain_rows[:10]],
+        "hour_histogram": hour_histogram,
+        "weekday_histogram": weekday_histogram,
+        "generated_at": datetime.datetime.now().isoformat(timespec='seconds'),
+    }
 
-# 健康检查
-@app.get("/api/healthz")
-async def healthz():
+def refresh_user_profile(cursor, force: bool = False) -> Optional[Dict[str, Any]]:
+    """依赖数据版本变化时重新物化用户画像，返回新画像（未变化时返回 None）"""
+    versions = get_data_versions(cursor, ["browser_history", "bookmarks"])
+    source_versions = json.dumps(versions, sort_keys=True)
+    if not force:
+        cursor.execute('SELECT source_versions FROM user_profile WHERE id = 1')
+        row = cursor.fetchone()
+        if row and row['source_versions'] == source_versions:
+            return None
+    profile = compute_user_profile(cursor)
+    cursor.execute('''
+        INSERT INTO user_profile (id, profile_json, source_versions, updated_at)
+        VALUES (1, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(id) DO UPDATE SET
+            profile_json = excluded.profile_json,
+            source_versions = excluded.source_versions,
+            updated_at = CURRENT_TIMESTAMP
+    ''', (json.dumps(profile, ensure_ascii=False), source_versions))
+    return profile
+
+def load_user_profile(cursor) -> Optional[Dict[str, Any]]:
+    """读取已物化的用户画像"""
+    cursor.execute('SELECT profile_json FROM user_profile WHERE id = 1')
+    row = cursor.fetchone()
+    return json.loads(row['profile_json']) if row else None
+
+def refresh_user_profile_safely():
+    """刷新用户画像（书签同步等场景调用）；失败只记录日志"""
     try:
-        # 简单读库验证
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT 1")
-        return {"ok": True}
-    except Exception:
-        return JSONResponse(status_code=500, content={"ok": False})
+            refresh_user_profile(cursor)
+            conn.commit()
+    except Exception as e:
+        logger.error(f"刷新用户画像失败: {e}")
 
-# 引导状态：是否已有历史数据、是否有激活AI
-@app.get("/api/onboarding/state", response_model=ApiResponse)
-async def get_onboarding_state():
+def refresh_history_derivatives():
+    """同步后增量刷新派生分析数据；失败只记录日志，不影响同步结果"""
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(1) as cnt FROM browser_history")
-            has_history = (cursor.fetchone()[0] or 0) > 0
+            processed = refresh_browsing_sessions(cursor)
+            refresh_keyword_index(cursor)
+            refresh_profile_rollups(cursor)
+            refresh_user_profile(cursor)
+            conn.commit()
+            if processed:
+                logger.info(f"浏览会话与关键词索引增量刷新完成，处理 {processed} 条访问记录")
+    except Exception as e:
+        logger.error(f"刷新派生分析数据失败: {e}")
 
-            cursor.execute("SELECT COUNT(1) FROM ai_configs WHERE is_active = 1")
-            has_active_ai = (cursor.fetchone()[0] or 0) > 0
+# 本地预分类器：由人工确认的分类（书签 accept_ai/categorize/提交会话、历史 categorize）训练，
+# 域名规则 + 标题词朴素贝叶斯；高置信度的直接采用，其余才交给大模型
+CLASSIFIER_CONFIDENCE_THRESHOLD = float(os.getenv("CLASSIFIER_CONFIDENCE_THRESHOLD", "0.75"))
+CLASSIFIER_MIN_DOMAIN_SAMPLES = 3    # 域名规则生效所需的最少样本数
+CLASSIFIER_MIN_TOKEN_SAMPLES = 20    # 标题词模型生效所需的最少样本总数
 
-        return ApiResponse(
-            success=True,
-            message="获取引导状态成功",
-            data={
-                "has_history": has_history,
-                "has_active_ai": has_active_ai
-            }
-        )
-    except Exception as e:
-        logger.error(f"获取引导状态失败: {e}")
-        raise HTTPException(status_code=500, detail="获取引导状态失败")
+class CategoryClassifier:
+    """基于域名与标题词计数的轻量分类器，统计持久化在 classifier_*_stats 表"""
 
-# AI自动探测（Ollama）
-@app.post("/api/ai/autodetect", response_model=ApiResponse)
-async def autodetect_ai(base_url: Optional[str] = None):
-    try:
-        req = OllamaTestRequest(base_url=base_url or "http://localhost:11434")
-        # 直接复用 test_ollama_connection 的逻辑
-        result = await test_ollama_connection(req)
-        return ApiResponse(success=True, message="探测成功", data=result.data)
-    except HTTPException as he:
-        raise he
-    except Exception as e:
-        logger.error(f"AI自动探测失败: {e}")
-        raise HTTPException(status_code=500, detail="AI自动探测失败")
+    def __init__(self):
+        self._loaded = False
+        self.domain_counts: Dict[str, Dict[str, int]] = {}
+        self.token_counts: Dict[str, Dict[str, int]] = {}
+        self.category_samples: Dict[str, int] = {}
+        self.category_tokens: Dict[str, int] = {}
 
-def build_analysis_prompt_for_history(records: list, range_text: str = "最近数据") -> str:
-    try:
-        # 提取域名与标题
-        sites = []
-        for item in records:
-            url = item.get('url')
-            title = item.get('title') or '无标题'
-            visit_count = item.get('visit_count') or item.get('visitCount') or 1
-            try:
-                domain = url.split('//', 1)[-1].split('/')[0].replace('www.', '') if url else ''
-            except Exception:
-                domain = url or ''
-            sites.append({"domain": domain, "title": title, "visitCount": visit_count})
+    def _load(self):
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT domain, category, count FROM classifier_domain_stats WHERE count > 0')
+            domain_counts: Dict[str, Dict[str, int]] = {}
+            category_samples: Dict[str, int] = {}
+            for r in cursor.fetchall():
+                domain_counts.setdefault(r['domain'], {})[r['category']] = r['count']
+                category_samples[r['category']] = category_samples.get(r['category'], 0) + r['count']
+            cursor.execute('SELECT token, category, count FROM classifier_token_stats WHERE count > 0')
+            token_counts: Dict[str, Dict[str, int]] = {}
+            category_tokens: Dict[str, int] = {}
+            for r in cursor.fetchall():
+                token_counts.setdefault(r['token'], {})[r['category']] = r['count']
+                category_tokens[r['category']] = category_tokens.get(r['category'], 0) + r['count']
+        self.domain_counts, self.token_counts = domain_counts, token_counts
+        self.category_samples, self.category_tokens = category_samples, category_tokens
+        self._loaded = True
+
+    def learn(self, cursor, samples: list) -> int:
+        """记录人工确认的样本 (item_key, title, url, category)，返回统计发生变化的条目数。
+
+        每个条目只计入一个标签：重复确认不再累加，改判时先撤销旧标签的计数，分类被清空时移除。
+        在调用方事务中写入，提交后下次预测时重新加载。
+        """
+        learned = 0
+        for item_key, title, url, category in samples:
+            if category in PROFILE_UNCATEGORIZED:
+                category = None
+            # 无域名时记在空域名下，只参与类别先验
+            domain = extract_domain(url).lower()
+            tokens = ' '.join(sorted(set(tokenize_title(title))))
+            cursor.execute('SELECT domain, tokens, category FROM classifier_labels WHERE item_key = ?', (item_key,))
+            old = cursor.fetchone()
+            if old is None and not category:
+                continue
+            if old is not None:
+                if (old['domain'], old['tokens'], old['category']) == (domain, tokens, category):
+                    continue
+                self._add_counts(cursor, old['domain'], old['tokens'], old['category'], -1)
+            if category:
+                self._add_counts(cursor, domain, tokens, category, 1)
+                cursor.execute('''
+                    INSERT INTO classifier_labels (item_key, domain, tokens, category, updated_at)
+                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(item_key) DO UPDATE SET
+                        domain = excluded.domain, tokens = excluded.tokens,
+                        category = excluded.category, updated_at = CURRENT_TIMESTAMP
+                ''', (item_key, domain, tokens, category))
+            else:
+                cursor.execute('DELETE FROM classifier_labels WHERE item_key = ?', (item_key,))
+            learned += 1
+        if learned:
+            self._loaded = False
+        return learned
+
+    @staticmethod
+    def _add_counts(cursor, domain: str, tokens: str, category: str, delta: int):
+        cursor.execute('''
+            INSERT INTO classifier_domain_stats (domain, category, count) VALUES (?, ?, ?)
+            ON CONFLICT(domain, category) DO UPDATE SET count = count + excluded.count
+        ''', (domain, category, delta))
+        for token in tokens.split():
+            cursor.execute('''
+                INSERT INTO classifier_token_stats (token, category, count) VALUES (?, ?, ?)
+                ON CONFLICT(token, category) DO UPDATE SET count = count + excluded.count
+            ''', (token, category, delta))
+        if delta < 0:
+            cursor.execute('DELETE FROM classifier_domain_stats WHERE count <= 0')
+            cursor.execute('DELETE FROM classifier_token_stats WHERE count <= 0')
+
+    def seed(self, cursor) -> int:
+        """首次启动时用已有的人工分类重建统计（旧版本只累加、未记录逐条标签的统计一并清空）"""
+        if get_analytics_state(cursor, 'classifier_labels_seeded'):
+            return 0
+        for table in ('classifier_domain_stats', 'classifier_token_stats', 'classifier_labels'):
+            cursor.execute(f'DELETE FROM {table}')
+        cursor.execute('''
+            SELECT chrome_id, title, url, category FROM bookmarks
+            WHERE is_deleted = 0 AND type = 'bookmark' AND category IS NOT NULL AND category != ''
+        ''')
+        samples = [(f"bookmark:{r['chrome_id']}", r['title'], r['url'], r['category']) for r in cursor.fetchall()]
+        cursor.execute('''
+            SELECT id, title, url, category FROM browser_history
+            WHERE category IS NOT NULL AND category NOT IN ('', '未分类')
+        ''')
+        samples.extend((f"history:{r['id']}", r['title'], r['url'], r['category']) for r in cursor.fetchall())
+        set_analytics_state(cursor, 'classifier_labels_seeded', 1)
+        self._loaded = False
+        return self.learn(cursor, samples)
+
+    def _predict_domain(self, domain: str):
+        parts = domain.split('.')
+        # 由具体到宽泛匹配子域名 -> 主域名
+        for i in range(len(parts) - 1):
+            counts = self.domain_counts.get('.'.join(parts[i:]))
+            if not counts:
+                continue
+            total = sum(counts.values())
+            if total < CLASSIFIER_MIN_DOMAIN_SAMPLES:
+                continue
+            category, top = max(counts.items(), key=lambda kv: kv[1])
+            return category, top / (total + 1)
+        return None
+
+    def _predict_tokens(self, title: Optional[str]):
+        total_samples = sum(self.category_samples.values())
+        if total_samples < CLASSIFIER_MIN_TOKEN_SAMPLES:
+            return None
+        tokens = [t for t in set(tokenize_title(title)) if t in self.token_counts]
+        if not tokens:
+            return None
+        vocab = len(self.token_counts)
+        scores = {}
+        for category, samples in self.category_samples.items():
+            denom = self.category_tokens.get(category, 0) + vocab
+            score = math.log(samples / total_samples)
+            for t in tokens:
+                score += math.log((self.token_counts[t].get(category, 0) + 1) / denom)
+            scores[category] = score
+        best = max(scores, key=scores.get)
+        norm = sum(math.exp(v - scores[best]) for v in scores.values())
+        return best, 1 / norm
+
+    def predict(self, title: Optional[str], url: Optional[str]) -> Optional[Dict[str, Any]]:
+        """返回 {category, confidence, source}；置信度不足阈值时返回 None"""
+        if not self._loaded:
+            self._load()
+        for source, result in (
+            ("domain", self._predict_domain(extract_domain(url).lower())),
+            ("title", self._predict_tokens(title)),
+        ):
+            if result and result[1] >= CLASSIFIER_CONFIDENCE_THRESHOLD:
+                return {"category": result[0], "confidence": round(result[1], 3), "source": source}
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        if not self._loaded:
+            self._load()
+        return {
+            "samples": sum(self.category_samples.values()),
+            "categories": self.category_samples,
+            "domains": len([d for d in self.domain_counts if d]),
+            "tokens": len(self.token_counts),
+            "confidence_threshold": CLASSIFIER_CONFIDENCE_THRESHOLD,
+        }
 
-        # 统计域名频率
-        domain_stats: Dict[str, int] = {}
-        for s in sites:
-            if s["domain"]:
-                domain_stats[s["domain"]] = domain_stats.get(s["domain"], 0) + int(s["visitCount"] or 1)
-        top_domains = sorted(domain_stats.items(), key=lambda x: x[1], reverse=True)[:20]
-        top_domains_text = "\n".join([f"{d} ({c}次)" for d, c in top_domains])
+category_classifier = CategoryClassifier()
 
-        titles = [s["title"] for s in sites if s["title"] and s["title"] != '无标题'][:30]
+def learn_categories_safely(samples: list):
+    """把人工确认的分类 (item_key, title, url, category) 计入预分类器（首次调用时先用已有人工分类初始化）；失败只记录日志"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            category_classifier.seed(cursor)
+            category_classifier.learn(cursor, samples)
+            conn.commit()
+    except Exception as e:
+        logger.error(f"更新预分类器失败: {e}")
+
+# 读接口响应缓存：key -> (etag, 响应体)，数据版本变化前直接复用序列化结果
+RESPONSE_CACHE_MAX_ENTRIES = 256
+_response_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+def get_data_versions(cursor, tables: List[str]) -> Dict[str, int]:
+    """读取若干表的数据版本号"""
+    cursor.execute(f'''
+        SELECT table_name, version FROM data_versions
+        WHERE table_name IN ({','.join(['?'] * len(tables))})
+    ''', tables)
+    versions = {row['table_name']: row['version'] for row in cursor.fetchall()}
+    return {t: versions.get(t, 0) for t in tables}
+
+async def cached_json_response(request: Request, cache_key: str, tables: List[str], build) -> Response:
+    """基于数据版本的条件GET：ETag 命中返回 304，版本未变时复用缓存的响应体"""
+    with get_db_connection() as conn:
+        versions = get_data_versions(conn.cursor(), tables)
+    version_text = ",".join(f"{t}:{versions[t]}" for t in tables)
+    etag = 'W/"' + hashlib.sha1(f"{cache_key}|{version_text}".encode('utf-8')).hexdigest()[:20] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    cached = _response_cache.get(cache_key)
+    if cached and cached[0] == etag:
+        _response_cache.move_to_end(cache_key)
+        body = cached[1]
+    else:
+        result = await build()
+        body = json.dumps(result.model_dump(), ensure_ascii=False).encode('utf-8')
+        _response_cache[cache_key] = (etag, body)
+        _response_cache.move_to_end(cache_key)
+        while len(_response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            _response_cache.popitem(last=False)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# 进程内事件总线（SSE 推送）
+EVENT_TOPICS = {"ingest", "stats", "tasks", "classification"}
+SSE_HEARTBEAT_SECONDS = 15
+
+class EventBus:
+    """进程内发布/订阅：按主题把事件投递到订阅者队列，慢消费者丢弃最旧的事件"""
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscribers: Dict[str, set] = {}
+
+    def subscribe(self, topics: List[str]) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        for topic in topics:
+            self._subscribers.setdefault(topic, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        for subscribers in self._subscribers.values():
+            subscribers.discard(queue)
+
+    def has_subscribers(self, topic: str) -> bool:
+        return bool(self._subscribers.get(topic))
+
+    def publish(self, topic: str, data: Any):
+        """发布事件（需在事件循环线程内调用）"""
+        for queue in list(self._subscribers.get(topic, ())):
+            if queue.full():
+                try:
+                    queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            queue.put_nowait((topic, data))
+
+event_bus = EventBus()
+
+def format_sse(event: str, data: Any) -> str:
+    """格式化一条 SSE 消息"""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+async def publish_stats_event():
+    """有订阅者时推送最新统计数据"""
+    if not event_bus.has_subscribers("stats"):
+        return
+    try:
+        result = await build_stats()
+        event_bus.publish("stats", result.data)
+    except Exception as e:
+        logger.error(f"推送统计事件失败: {e}")
+
+# AI后端HTTP客户端（应用级连接池，启动时创建、关闭时释放）
+AI_HTTP_CONNECT_TIMEOUT = float(os.getenv("AI_HTTP_CONNECT_TIMEOUT", "10"))   # 建连超时（秒）
+AI_HTTP_READ_TIMEOUT = float(os.getenv("AI_HTTP_READ_TIMEOUT", "300"))        # 两次读之间的最大间隔（秒）
+AI_HTTP_POOL_LIMIT = int(os.getenv("AI_HTTP_POOL_LIMIT", "8"))                # 每个后端的最大连接数
+AI_HTTP_KEEPALIVE_SECONDS = float(os.getenv("AI_HTTP_KEEPALIVE_SECONDS", "60"))
+AI_HTTP_MAX_SESSIONS = int(os.getenv("AI_HTTP_MAX_SESSIONS", "8"))            # 最多保留的后端连接池数（超出时关闭最久未用的空闲池）
+AI_BACKEND_CONCURRENCY = int(os.getenv("AI_BACKEND_CONCURRENCY", "2"))       # 批量任务对单个后端的最大并发生成数
+
+class AIClientManager:
+    """按后端（base_url）维护独立的 aiohttp 连接池，并统计请求与连接复用情况"""
+
+    def __init__(
+        self,
+        pool_limit: int = AI_HTTP_POOL_LIMIT,
+        connect_timeout: float = AI_HTTP_CONNECT_TIMEOUT,
+        read_timeout: float = AI_HTTP_READ_TIMEOUT,
+        keepalive_timeout: float = AI_HTTP_KEEPALIVE_SECONDS,
+        backend_concurrency: int = AI_BACKEND_CONCURRENCY,
+        max_sessions: int = AI_HTTP_MAX_SESSIONS
+    ):
+        self.pool_limit = pool_limit
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.backend_concurrency = backend_concurrency
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, aiohttp.ClientSession]" = OrderedDict()
+        self._closing: set = set()
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    @staticmethod
+    def backend_key(base_url: str) -> str:
+        return base_url.rstrip('/')
+
+    def timeout(self, total: Optional[float] = None, read: Optional[float] = None) -> aiohttp.ClientTimeout:
+        """构建超时配置：默认只限制建连与读间隔，不限制总时长（长文本生成可能需要数分钟）"""
+        return aiohttp.ClientTimeout(
+            total=total,
+            connect=self.connect_timeout,
+            sock_read=read if read is not None else self.read_timeout
+        )
 
-        prompt = f"""作为专业的数据分析师，请分析以下浏览历史数据：
+    def _trace_config(self, key: str) -> aiohttp.TraceConfig:
+        stats = self._stats.setdefault(key, {
+            "requests": 0, "errors": 0, "in_flight": 0, "connections_created": 0, "connections_reused": 0
+        })
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            stats["requests"] += 1
+            stats["in_flight"] += 1
+
+        async def on_request_end(session, ctx, params):
+            stats["in_flight"] -= 1
+
+        async def on_request_exception(session, ctx, params):
+            stats["in_flight"] -= 1
+            stats["errors"] += 1
+
+        async def on_connection_create_end(session, ctx, params):
+            stats["connections_created"] += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            stats["connections_reused"] += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace
+
+    def session(self, base_url: str) -> aiohttp.ClientSession:
+        """获取（必要时创建）指定后端的共享会话"""
+        key = self.backend_key(base_url)
+        session = self._sessions.get(key)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_limit,
+                limit_per_host=self.pool_limit,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout(),
+                trace_configs=[self._trace_config(key)]
+            )
+            self._sessions[key] = session
+            self._evict_sessions()
+        self._sessions.move_to_end(key)
+        return session
+
+    def _evict_sessions(self):
+        """连接池数超出上限时关闭最久未用且没有进行中请求的连接池（如测试连接时探测过的任意地址）"""
+        excess = len(self._sessions) - max(1, self.max_sessions)
+        for key in list(self._sessions)[:-1]:
+            if excess <= 0:
+                break
+            if self._stats.get(key, {}).get("in_flight"):
+                continue
+            session = self._sessions.pop(key)
+            excess -= 1
+            if not session.closed:
+                task = asyncio.get_running_loop().create_task(session.close())
+                self._closing.add(task)
+                task.add_done_callback(self._closing.discard)
+
+    def semaphore(self, base_url: str) -> asyncio.Semaphore:
+        """获取指定后端的并发限制信号量（批量生成等扇出场景共用）"""
+        key = self.backend_key(base_url)
+        sem = self._semaphores.get(key)
+        if sem is None:
+            sem = asyncio.Semaphore(max(1, self.backend_concurrency))
+            self._semaphores[key] = sem
+        return sem
+
+    async def close(self):
+        for session in self._sessions.values():
+            if not session.closed:
+                await session.close()
+        self._sessions.clear()
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+
+    def metrics(self) -> Dict[str, Any]:
+        backends = {}
+        for key, stats in self._stats.items():
+            session = self._sessions.get(key)
+            connector = session.connector if session and not session.closed else None
+            idle = 0
+            acquired = 0
+            if connector is not None:
+                idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+                acquired = len(getattr(connector, '_acquired', ()))
+            backends[key] = {
+                **stats,
+                "pool_limit": self.pool_limit,
+                "active_connections": acquired,
+                "idle_connections": idle,
+                "open": connector is not None,
+            }
+        return {
+            "backend_concurrency": self.backend_concurrency,
+            "connect_timeout": self.connect_timeout,
+            "read_timeout": self.read_timeout,
+            "keepalive_timeout": self.keepalive_timeout,
+            "backends": backends,
+        }
 
-=== 数据概览 ===
-总访问记录: {len(records)} 条
-时间范围: {range_text}
+ai_clients = AIClientManager()
+
+# LLM响应缓存：内存LRU + SQLite持久层，TTL与容量上限均可通过环境变量调整
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "128"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2000"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+class LLMResponseCache:
+    """两级LLM响应缓存：进程内LRU（命中为毫秒级）+ SQLite 表 llm_response_cache（跨重启保留）"""
+
+    def __init__(
+        self,
+        memory_entries: int = LLM_CACHE_MEMORY_ENTRIES,
+        max_entries: int = LLM_CACHE_MAX_ENTRIES,
+        max_bytes: int = LLM_CACHE_MAX_BYTES,
+        ttl_seconds: int = LLM_CACHE_TTL_SECONDS
+    ):
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "bypassed": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(ai_config, prompt: str, options: dict) -> tuple:
+        """返回 (cache_key, backend, model, prompt_hash, options_json)"""
+        backend = ai_config['base_url'].rstrip('/')
+        model = ai_config['model']
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        options_json = json.dumps(options or {}, sort_keys=True)
+        raw = json.dumps([backend, model, prompt_hash, options_json])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest(), backend, model, prompt_hash, options_json
+
+    def get(self, cache_key: str) -> Optional[str]:
+        now = time.time()
+        cached = self._memory.get(cache_key)
+        if cached is not None:
+            created_at, response = cached
+            if now - created_at <= self.ttl_seconds:
+                self._memory.move_to_end(cache_key)
+                self.counters["memory_hits"] += 1
+                return response
+            del self._memory[cache_key]
+
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT response, created_at FROM llm_response_cache WHERE cache_key = ? AND created_at >= ?',
+                (cache_key, now - self.ttl_seconds)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            cursor.execute(
+                'UPDATE llm_response_cache SET last_access = ?, hits = hits + 1 WHERE cache_key = ?',
+                (now, cache_key)
+            )
+            conn.commit()
+        self.counters["disk_hits"] += 1
+        self._remember(cache_key, row['created_at'], row['response'])
+        return row['response']
+
+    def put(self, key_parts: tuple, response: str):
+        cache_key, backend, model, prompt_hash, options_json = key_parts
+        now = time.time()
+        size_bytes = len(response.encode('utf-8'))
+        if size_bytes > self.max_bytes:
+            return
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO llm_response_cache
+                (cache_key, backend, model, prompt_hash, options_json, response, size_bytes, created_at, last_access, hits)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+            ''', (cache_key, backend, model, prompt_hash, options_json, response, size_bytes, now, now))
+            self._evict(cursor, now)
+            conn.commit()
+        self.counters["stores"] += 1
+        self._remember(cache_key, now, response)
+
+    def _remember(self, cache_key: str, created_at: float, response: str):
+        self._memory[cache_key] = (created_at, response)
+        self._memory.move_to_end(cache_key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, cursor, now: float):
+        """删除过期条目，再按最近访问时间淘汰到条数与字节数上限以内"""
+        cursor.execute('DELETE FROM llm_response_cache WHERE created_at < ?', (now - self.ttl_seconds,))
+        evicted = cursor.rowcount
+        cursor.execute('SELECT COUNT(*) AS entries, COALESCE(SUM(size_bytes), 0) AS total_bytes FROM llm_response_cache')
+        row = cursor.fetchone()
+        entries, total_bytes = row['entries'], row['total_bytes']
+        if entries > self.max_entries or total_bytes > self.max_bytes:
+            cursor.execute('SELECT cache_key, size_bytes FROM llm_response_cache ORDER BY last_access ASC')
+            victims = []
+            for victim in cursor.fetchall():
+                if entries <= self.max_entries and total_bytes <= self.max_bytes:
+                    break
+                victims.append((victim['cache_key'],))
+                entries -= 1
+                total_bytes -= victim['size_bytes']
+            cursor.executemany('DELETE FROM llm_response_cache WHERE cache_key = ?', victims)
+            for (cache_key,) in victims:
+                self._memory.pop(cache_key, None)
+            evicted += len(victims)
+        self.counters["evictions"] += evicted
+
+    def clear(self) -> int:
+        self._memory.clear()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM llm_response_cache')
+            deleted = cursor.rowcount
+            conn.commit()
+        return deleted
+
+    def stats(self) -> Dict[str, Any]:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT COUNT(*) AS entries, COALESCE(SUM(size_bytes), 0) AS total_bytes,
+                       COALESCE(SUM(hits), 0) AS total_hits
+                FROM llm_response_cache
+            ''')
+            row = cursor.fetchone()
+        lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+        hits = self.counters["memory_hits"] + self.counters["disk_hits"]
+        return {
+            **self.counters,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "disk_entries": row['entries'],
+            "disk_bytes": row['total_bytes'],
+            "disk_hits_total": row['total_hits'],
+            "limits": {
+                "memory_entries": self.memory_entries,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+            },
+        }
+
+llm_cache = LLMResponseCache()
+
+class _SharedStream:
+    """一条被多个订阅者共享的生成流：已产出的片段全部保留，后加入的订阅者先回放再跟随"""
+
+    def __init__(self):
+        self.chunks: List[dict] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+class SingleFlight:
+    """合并缓存键相同的并发LLM请求：只有首个调用真正访问后端，其余调用等待同一结果（流式调用共享同一条 token 流）。
+
+    生成在独立任务中运行，单个调用方断开不会影响其他等待者；所有等待者都离开后才取消生成。
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, Dict[str, Any]] = {}
+        self._streams: Dict[str, _SharedStream] = {}
+        self.counters = {"calls": 0, "deduplicated": 0, "streams": 0, "stream_deduplicated": 0}
+
+    @staticmethod
+    def _consume_exception(task: asyncio.Task):
+        # 所有等待者都已离开时，避免 "exception was never retrieved" 警告
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: str, factory):
+        """执行 factory() 返回的协程；相同 key 的并发调用共享其结果"""
+        entry = self._calls.get(key)
+        if entry is None:
+            entry = {"task": asyncio.ensure_future(factory()), "waiters": 0}
+            self._calls[key] = entry
+            entry["task"].add_done_callback(self._consume_exception)
+            entry["task"].add_done_callback(
+                lambda _task, k=key, e=entry: self._calls.pop(k, None) if self._calls.get(k) is e else None
+            )
+            self.counters["calls"] += 1
+        else:
+            self.counters["deduplicated"] += 1
+        entry["waiters"] += 1
+        try:
+            return await asyncio.shield(entry["task"])
+        finally:
+            entry["waiters"] -= 1
+            if entry["waiters"] == 0 and not entry["task"].done():
+                entry["task"].cancel()
+
+    async def stream(self, key: str, source_factory, on_complete=None):
+        """订阅 source_factory() 产生的片段流；相同 key 的并发订阅共享同一条上游流。
+
+        on_complete(chunks) 在上游流正常结束后执行一次（如写入响应缓存）。
+        """
+        shared = self._streams.get(key)
+        if shared is None:
+            shared = _SharedStream()
+            self._streams[key] = shared
+
+            async def produce():
+                try:
+                    async for chunk in source_factory():
+                        shared.chunks.append(chunk)
+                        shared.notify()
+                    if on_complete:
+                        on_complete(shared.chunks)
+                except BaseException as e:
+                    shared.error = e
+                    if not isinstance(e, asyncio.CancelledError):
+                        return
+                    raise
+                finally:
+                    shared.done = True
+                    if self._streams.get(key) is shared:
+                        del self._streams[key]
+                    shared.notify()
+
+            shared.task = asyncio.ensure_future(produce())
+            self.counters["streams"] += 1
+        else:
+            self.counters["stream_deduplicated"] += 1
+
+        shared.subscribers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(shared.chunks):
+                    yield shared.chunks[index]
+                    index += 1
+                if shared.done:
+                    if shared.error is not None:
+                        raise shared.error
+                    return
+                await shared.changed.wait()
+        finally:
+            shared.subscribers -= 1
+            if shared.subscribers == 0 and shared.task is not None and not shared.task.done():
+                shared.task.cancel()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "in_flight_calls": len(self._calls),
+            "in_flight_streams": len(self._streams),
+        }
+
+single_flight = SingleFlight()
+
+# 多后端路由：同一模型的多个激活配置之间按负载分发，失败自动切换
+AI_HEALTH_CHECK_SECONDS = int(os.getenv("AI_HEALTH_CHECK_SECONDS", "30"))
+AI_LATENCY_EWMA_ALPHA = 0.3
+
+def percentile(sorted_values: list, p: float):
+    """最近秩分位数（sorted_values 须已升序），空列表返回 None"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(len(sorted_values) * p / 100) - 1))]
+
+# 弹性策略：熔断、带抖动的指数退避重试、截止时间传递、对冲请求
+AI_BREAKER_FAILURE_THRESHOLD = int(os.getenv("AI_BREAKER_FAILURE_THRESHOLD", "3"))      # 连续失败多少次后熔断
+AI_BREAKER_COOLDOWN_SECONDS = float(os.getenv("AI_BREAKER_COOLDOWN_SECONDS", "30"))     # 熔断后多久放行一次试探请求
+AI_RETRY_ATTEMPTS = int(os.getenv("AI_RETRY_ATTEMPTS", "3"))                            # 轮询全部后端的最大轮数
+AI_RETRY_BASE_SECONDS = 0.5
+AI_RETRY_MAX_SECONDS = 8.0
+AI_INTERACTIVE_DEADLINE_SECONDS = float(os.getenv("AI_INTERACTIVE_DEADLINE_SECONDS", "180"))  # 交互式调用的默认截止时间
+AI_HEDGE_PERCENTILE = float(os.getenv("AI_HEDGE_PERCENTILE", "95"))   # 超过主后端该分位延迟仍未返回时向第二个后端对冲，0 关闭
+AI_HEDGE_MIN_SAMPLES = 10
+AI_LATENCY_WINDOW = 100
+
+# 当前请求的截止时间（time.monotonic()），随协程/任务上下文向下传递
+ai_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("ai_deadline", default=None)
+# 未设置截止时间的交互式调用使用的默认时长；后台任务上下文中为 None（只受网络超时约束）
+ai_interactive_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "ai_interactive_deadline", default=AI_INTERACTIVE_DEADLINE_SECONDS
+)
+
+@contextmanager
+def ai_deadline_scope(seconds: float):
+    """在作用域内为AI调用设置截止时间；嵌套时取更早的截止时间"""
+    deadline = time.monotonic() + seconds
+    current = ai_deadline.get()
+    token = ai_deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        ai_deadline.reset(token)
+
+class AIBackendError(Exception):
+    """AI后端不可用或返回错误状态（可切换到其他后端重试）"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def retryable(self) -> bool:
+        # 4xx（如模型不存在）退避重试没有意义，只切换后端；429 与 5xx 可以重试
+        return self.status is None or self.status == 429 or self.status >= 500
+
+class AIDeadlineExceeded(AIBackendError):
+    """超出调用方的截止时间，不再切换或重试"""
+
+    @property
+    def retryable(self) -> bool:
+        return False
+
+async def probe_ollama_tags(base_url: str, timeout: float = 10) -> List[str]:
+    """探测 Ollama /api/tags，返回已安装的模型名列表"""
+    session = ai_clients.session(base_url)
+    async with session.get(f"{base_url.rstrip('/')}/api/tags", timeout=ai_clients.timeout(total=timeout)) as response:
+        if response.status != 200:
+            raise AIBackendError(f"Ollama服务连接失败: HTTP {response.status}", status=response.status)
+        data = await response.json()
+        return [model['name'] for model in data.get('models', [])]
+
+class AIBackendRouter:
+    """在提供相同模型的激活配置间调度请求：优先健康且在途请求最少、延迟EWMA最低的后端。
+
+    每个后端带熔断器（closed → 连续失败后 open → 冷却后 half_open 放行一次试探）；
+    一轮后端全部失败时按带抖动的指数退避重试，所有等待都受截止时间约束；
+    交互式调用在主后端超过其分位延迟仍未返回时向第二个后端发起对冲请求，先返回者胜出。
+    """
+
+    def __init__(self):
+        self._state: Dict[str, Dict[str, Any]] = {}
+        self._latencies: Dict[str, deque] = {}
+        self._health_task: Optional[asyncio.Task] = None
+        self.counters = {
+            "retries": 0,
+            "breaker_opened": 0,
+            "breaker_rejected": 0,
+            "deadline_exceeded": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+        }
+
+    def _backend(self, base_url: str) -> Dict[str, Any]:
+        key = AIClientManager.backend_key(base_url)
+        state = self._state.get(key)
+        if state is None:
+            state = {
+                "healthy": True,        # 未检查过的后端默认可用
+                "breaker": "closed",    # closed | open | half_open
+                "opened_at": None,
+                "trial_in_flight": False,
+                "in_flight": 0,
+                "latency_ewma_ms": None,
+                "requests": 0,
+                "failures": 0,
+                "consecutive_failures": 0,
+                "last_error": None,
+                "last_check": None,
+                "models": None,
+            }
+            self._state[key] = state
+            self._latencies[key] = deque(maxlen=AI_LATENCY_WINDOW)
+        return state
+
+    @staticmethod
+    def candidates(ai_config) -> list:
+        """返回与给定配置同类型、同模型的全部激活配置（给定配置排在首位）"""
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM ai_configs
+                WHERE is_active = 1 AND type = ? AND model = ?
+                ORDER BY id
+            ''', (ai_config['type'], ai_config['model']))
+            rows = cursor.fetchall()
+        configs = [ai_config]
+        seen = {AIClientManager.backend_key(ai_config['base_url'])}
+        for row in rows:
+            key = AIClientManager.backend_key(row['base_url'])
+            if key not in seen:
+                seen.add(key)
+                configs.append(row)
+        return configs
+
+    @staticmethod
+    def _rejects(state: Dict[str, Any]) -> bool:
+        """熔断器是否拒绝请求：open 且未过冷却期，或 half_open 时已有试探请求在途"""
+        if state["breaker"] == "open":
+            return time.monotonic() - state["opened_at"] < AI_BREAKER_COOLDOWN_SECONDS
+        return state["breaker"] == "half_open" and state["trial_in_flight"]
+
+    def _available(self, config) -> bool:
+        state = self._backend(config['base_url'])
+        if not state["healthy"]:
+            return False
+        models = state["models"]
+        return models is None or config['model'] in models or f"{config['model']}:latest" in models
+
+    def order(self, configs: list) -> list:
+        """可用后端按（在途请求数，延迟EWMA）升序；全部不可用时仍按同样顺序尝试（熔断中的后端除外）"""
+        def load(config):
+            state = self._backend(config['base_url'])
+            return (state["in_flight"], state["latency_ewma_ms"] or 0.0)
+        allowed = [c for c in configs if not self._rejects(self._backend(c['base_url']))]
+        self.counters["breaker_rejected"] += len(configs) - len(allowed)
+        available = [c for c in allowed if self._available(c)]
+        unavailable = [c for c in allowed if not self._available(c)]
+        return sorted(available, key=load) + sorted(unavailable, key=load)
+
+    def _enter(self, state: Dict[str, Any]) -> bool:
+        """占用后端；冷却期已过的熔断后端转入 half_open，本次请求作为试探请求"""
+        if state["breaker"] == "open":
+            state["breaker"] = "half_open"
+        trial = state["breaker"] == "half_open"
+        if trial:
+            state["trial_in_flight"] = True
+        state["in_flight"] += 1
+        state["requests"] += 1
+        return trial
+
+    @staticmethod
+    def _leave(state: Dict[str, Any], trial: bool):
+        state["in_flight"] -= 1
+        if trial:
+            state["trial_in_flight"] = False
+
+    def _record_success(self, state: Dict[str, Any], started: float):
+        latency_ms = (time.perf_counter() - started) * 1000
+        previous = state["latency_ewma_ms"]
+        state["latency_ewma_ms"] = latency_ms if previous is None else (
+            AI_LATENCY_EWMA_ALPHA * latency_ms + (1 - AI_LATENCY_EWMA_ALPHA) * previous
+        )
+        state["healthy"] = True
+        state["breaker"] = "closed"
+        state["consecutive_failures"] = 0
+
+    def _record_failure(self, state: Dict[str, Any], error: Exception):
+        state["failures"] += 1
+        state["consecutive_failures"] += 1
+        state["last_error"] = str(error) or error.__class__.__name__
+        # 试探失败或连续失败达到阈值时熔断，冷却期内不再向该后端发送请求
+        if state["breaker"] == "half_open" or state["consecutive_failures"] >= AI_BREAKER_FAILURE_THRESHOLD:
+            if state["breaker"] != "open":
+                self.counters["breaker_opened"] += 1
+                logger.warning(f"AI后端连续失败 {state['consecutive_failures']} 次，熔断 {AI_BREAKER_COOLDOWN_SECONDS:.0f} 秒: {state['last_error']}")
+            state["breaker"] = "open"
+            state["opened_at"] = time.monotonic()
+
+    @staticmethod
+    def _deadline(bounded: bool) -> Optional[float]:
+        """调用方设置的截止时间；交互式（非批量）调用未设置时使用默认截止时间"""
+        deadline = ai_deadline.get()
+        default = ai_interactive_deadline.get()
+        if deadline is None and not bounded and default:
+            deadline = time.monotonic() + default
+        return deadline
+
+    def _remaining(self, deadline: Optional[float]) -> Optional[float]:
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self.counters["deadline_exceeded"] += 1
+            raise AIDeadlineExceeded("AI请求超出截止时间")
+        return remaining
+
+    async def _backoff(self, attempt: int, deadline: Optional[float]):
+        """全抖动指数退避；退避时间超出截止时间时直接放弃"""
+        delay = random.uniform(0, min(AI_RETRY_MAX_SECONDS, AI_RETRY_BASE_SECONDS * 2 ** (attempt - 1)))
+        remaining = self._remaining(deadline)
+        if remaining is not None and delay >= remaining:
+            self.counters["deadline_exceeded"] += 1
+            raise AIDeadlineExceeded("AI请求超出截止时间（重试退避）")
+        self.counters["retries"] += 1
+        await asyncio.sleep(delay)
+
+    def _hedge_delay(self, config) -> Optional[float]:
+        """主后端近期延迟的分位值（秒），样本不足或未启用对冲时返回 None"""
+        if AI_HEDGE_PERCENTILE <= 0:
+            return None
+        samples = sorted(self._latencies.get(AIClientManager.backend_key(config['base_url'])) or [])
+        if len(samples) < AI_HEDGE_MIN_SAMPLES:
+            return None
+        return percentile(samples, AI_HEDGE_PERCENTILE) / 1000
+
+    async def _attempt(self, config, call, bounded: bool, deadline: Optional[float]):
+        """在单个后端上执行一次 call(config)，整个过程（含等待信号量）受截止时间约束"""
+        state = self._backend(config['base_url'])
+        trial = self._enter(state)
+        started: Optional[float] = None
+
+        async def invoke():
+            nonlocal started
+            if bounded:
+                async with ai_clients.semaphore(config['base_url']):
+                    started = time.perf_counter()
+                    return await call(config)
+            started = time.perf_counter()
+            return await call(config)
+
+        try:
+            remaining = self._remaining(deadline)
+            result = await (invoke() if remaining is None else asyncio.wait_for(invoke(), remaining))
+            self._record_success(state, started)
+            self._latencies[AIClientManager.backend_key(config['base_url'])].append((time.perf_counter() - started) * 1000)
+            return result
+        except (AIBackendError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # 调用方截止时间到期（含仍在排队等待信号量）不算后端故障，只有后端自身的错误/超时计入熔断
+            if deadline is not None and time.monotonic() >= deadline:
+                if isinstance(e, AIDeadlineExceeded):
+                    raise
+                self.counters["deadline_exceeded"] += 1
+                raise AIDeadlineExceeded(f"AI请求超出截止时间: {config['base_url']}") from e
+            if started is not None:
+                self._record_failure(state, e)
+            raise
+        finally:
+            self._leave(state, trial)
+
+    async def _hedged(self, primary, secondary, call, deadline: Optional[float], delay: float):
+        """先请求主后端；超过 delay 未返回或主后端失败时请求第二个后端，取先成功的结果"""
+        tasks = [asyncio.create_task(self._attempt(primary, call, False, deadline))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                error = tasks[0].exception()
+                if error is None:
+                    return tasks[0].result()
+                if isinstance(error, AIDeadlineExceeded):
+                    raise error
+                logger.warning(f"AI后端 {primary['base_url']} 调用失败，尝试切换: {error}")
+            else:
+                self.counters["hedged"] += 1
+            tasks.append(asyncio.create_task(self._attempt(secondary, call, False, deadline)))
+            pending = {task for task in tasks if not task.done()}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is tasks[1] and not tasks[0].done():
+                            self.counters["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def run(self, ai_config, call, bounded: bool = False):
+        """按负载顺序调用 call(config)；连接失败或后端报错时切换到下一个后端，整轮失败后退避重试。
+
+        call 必须是幂等的。bounded=True 时占用所选后端的并发信号量（批量扇出场景），在途计数包含排队等待的请求；
+        bounded=False 的交互式调用在有第二个可用后端时启用对冲。
+        """
+        deadline = self._deadline(bounded)
+        last_error: Optional[Exception] = None
+        for attempt in range(AI_RETRY_ATTEMPTS):
+            if attempt:
+                await self._backoff(attempt, deadline)
+            ordered = self.order(self.candidates(ai_config))
+            retryable = False
+            index = 0
+            while index < len(ordered):
+                config = ordered[index]
+                secondary = ordered[index + 1] if index + 1 < len(ordered) else None
+                delay = None
+                if not bounded and secondary is not None and self._available(secondary):
+                    delay = self._hedge_delay(config)
+                try:
+                    if delay is not None:
+                        index += 2
+                        return await self._hedged(config, secondary, call, deadline, delay)
+                    index += 1
+                    return await self._attempt(config, call, bounded, deadline)
+                except AIDeadlineExceeded:
+                    raise
+                except (AIBackendError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    last_error = e
+                    retryable = retryable or getattr(e, "retryable", True)
+                    logger.warning(f"AI后端 {config['base_url']} 调用失败，尝试切换: {e}")
+            if last_error is None:
+                raise AIBackendError("没有可用的AI后端（全部处于熔断状态）", status=503)
+            if not retryable:
+                break
+        raise last_error
+
+    async def stream(self, ai_config, open_stream, bounded: bool = False):
+        """流式版本的 run：只有在尚未产出任何片段时才切换后端或退避重试，截止时间约束到首个片段为止
+        （bounded=True 时整个流占用后端信号量）"""
+        deadline = self._deadline(bounded)
+        last_error: Optional[Exception] = None
+        for attempt in range(AI_RETRY_ATTEMPTS):
+            if attempt:
+                await self._backoff(attempt, deadline)
+            retryable = False
+            for config in self.order(self.candidates(ai_config)):
+                state = self._backend(config['base_url'])
+                trial = self._enter(state)
+                yielded = False
+                semaphore = ai_clients.semaphore(config['base_url']) if bounded else None
+                acquired = False
+                started: Optional[float] = None
+                chunks = open_stream(config)
+                try:
+                    if semaphore:
+                        await semaphore.acquire()
+                        acquired = True
+                    remaining = self._remaining(deadline)
+                    started = time.perf_counter()
+                    first = chunks.__anext__()
+                    try:
+                        chunk = await (first if remaining is None else asyncio.wait_for(first, remaining))
+                    except StopAsyncIteration:
+                        self._record_success(state, started)
+                        return
+                    yielded = True
+                    yield chunk
+                    async for chunk in chunks:
+                        yield chunk
+                    self._record_success(state, started)
+                    return
+                except (AIBackendError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # 等待首个片段时调用方截止时间到期不算后端故障
+                    if not yielded and deadline is not None and time.monotonic() >= deadline:
+                        if isinstance(e, AIDeadlineExceeded):
+                            raise
+                        self.counters["deadline_exceeded"] += 1
+                        raise AIDeadlineExceeded(f"AI请求超出截止时间: {config['base_url']}") from e
+                    if started is not None:
+                        self._record_failure(state, e)
+                    if yielded:
+                        raise
+                    last_error = e
+                    retryable = retryable or getattr(e, "retryable", True)
+                    logger.warning(f"AI后端 {config['base_url']} 流式调用失败，尝试切换: {e}")
+                finally:
+                    await chunks.aclose()
+                    if acquired:
+                        semaphore.release()
+                    self._leave(state, trial)
+            if last_error is None:
+                raise AIBackendError("没有可用的AI后端（全部处于熔断状态）", status=503)
+            if not retryable:
+                break
+        raise last_error
+
+    async def check(self, base_url: str):
+        state = self._backend(base_url)
+        try:
+            state["models"] = await probe_ollama_tags(base_url, timeout=5)
+            state["healthy"] = True
+            state["consecutive_failures"] = 0
+            state["last_error"] = None
+            # 健康检查通过的熔断后端不必等满冷却期，下一个请求即作为试探请求
+            if state["breaker"] == "open":
+                state["breaker"] = "half_open"
+        except Exception as e:
+            state["healthy"] = False
+            state["last_error"] = str(e) or e.__class__.__name__
+        state["last_check"] = time.time()
+
+    async def check_all(self):
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT DISTINCT base_url FROM ai_configs WHERE is_active = 1 AND type = 'ollama'")
+            urls = [row['base_url'] for row in cursor.fetchall()]
+        await asyncio.gather(*(self.check(url) for url in urls))
+
+    async def _health_loop(self):
+        while True:
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"AI后端健康检查失败: {e}")
+            await asyncio.sleep(AI_HEALTH_CHECK_SECONDS)
+
+    def start(self):
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+
+    def metrics(self) -> Dict[str, Any]:
+        metrics = {}
+        for key, state in self._state.items():
+            hedge_delay = self._hedge_delay({"base_url": key})
+            metrics[key] = {
+                **state,
+                "opened_at": None,
+                "breaker_open_seconds": round(time.monotonic() - state["opened_at"], 1) if state["breaker"] == "open" else None,
+                "latency_ewma_ms": round(state["latency_ewma_ms"], 1) if state["latency_ewma_ms"] is not None else None,
+                "hedge_threshold_ms": round(hedge_delay * 1000, 1) if hedge_delay is not None else None,
+            }
+        return metrics
+
+ai_router = AIBackendRouter()
+
+# 模型生命周期：启动与配置变更时预加载模型并设置 keep_alive，有排队任务时定期续期；
+# 记录 Ollama 返回的加载耗时与推理耗时，区分冷启动延迟与生成延迟
+AI_KEEP_ALIVE = os.getenv("AI_KEEP_ALIVE", "30m")   # Ollama keep_alive：模型在内存中的保留时长
+AI_KEEP_ALIVE_REFRESH_SECONDS = int(os.getenv("AI_KEEP_ALIVE_REFRESH_SECONDS", "300"))
+AI_COLD_START_MS = 500   # 加载耗时超过该值记为一次冷启动
+
+class ModelLifecycleManager:
+    """按 后端+模型 预加载/续期模型，并累计 Ollama 响应中的 load/prompt_eval/eval 耗时"""
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._warming: Dict[str, asyncio.Task] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(base_url: str, model: str) -> str:
+        return f"{AIClientManager.backend_key(base_url)}|{model}"
+
+    def _model_state(self, base_url: str, model: str) -> Dict[str, Any]:
+        key = self._key(base_url, model)
+        state = self._stats.get(key)
+        if state is None:
+            state = {
+                "base_url": base_url.rstrip('/'),
+                "model": model,
+                "requests": 0,
+                "warmups": 0,
+                "cold_starts": 0,
+                "load_ms_total": 0.0,
+                "prompt_eval_ms_total": 0.0,
+                "eval_ms_total": 0.0,
+                "eval_tokens": 0,
+                "last_load_ms": None,
+                "last_warm_at": None,
+                "last_warm_error": None,
+            }
+            self._stats[key] = state
+        return state
+
+    def record(self, base_url: str, model: str, result: dict, warmup: bool = False):
+        """记录一次 Ollama 响应（done 片段或非流式结果）中的耗时字段（纳秒）"""
+        state = self._model_state(base_url, model)
+        load_ms = (result.get('load_duration') or 0) / 1e6
+        state["warmups" if warmup else "requests"] += 1
+        state["load_ms_total"] += load_ms
+        state["prompt_eval_ms_total"] += (result.get('prompt_eval_duration') or 0) / 1e6
+        state["eval_ms_total"] += (result.get('eval_duration') or 0) / 1e6
+        state["eval_tokens"] += result.get('eval_count') or 0
+        state["last_load_ms"] = round(load_ms, 1)
+        if load_ms >= AI_COLD_START_MS:
+            state["cold_starts"] += 1
+
+    async def warm(self, base_url: str, model: str) -> Optional[dict]:
+        """空提示词请求让 Ollama 加载模型并按 keep_alive 常驻；失败只记录"""
+        base_url = base_url.rstrip('/')
+        state = self._model_state(base_url, model)
+        started = time.perf_counter()
+        try:
+            async with ai_clients.session(base_url).post(
+                f"{base_url}/api/generate",
+                json={"model": model, "prompt": "", "stream": False, "keep_alive": AI_KEEP_ALIVE},
+                timeout=ai_clients.timeout()
+            ) as response:
+                if response.status != 200:
+                    raise AIBackendError(f"模型预加载失败: HTTP {response.status}")
+                result = await response.json()
+            self.record(base_url, model, result, warmup=True)
+            ai_telemetry.record(model, "warmup", "success", (time.perf_counter() - started) * 1000,
+                                backend=base_url, result=result)
+            state["last_warm_at"] = time.time()
+            state["last_warm_error"] = None
+            return result
+        except Exception as e:
+            ai_telemetry.record(model, "warmup", "error", (time.perf_counter() - started) * 1000,
+                                backend=base_url, error=e)
+            state["last_warm_error"] = str(e) or e.__class__.__name__
+            logger.warning(f"预加载模型 {model}@{base_url} 失败: {state['last_warm_error']}")
+            return None
+
+    def schedule_warm(self, base_url: str, model: str):
+        """在后台预加载（同一模型正在预加载时不重复提交）"""
+        key = self._key(base_url, model)
+        task = self._warming.get(key)
+        if task is None or task.done():
+            self._warming[key] = asyncio.create_task(self.warm(base_url, model))
+
+    def warm_active(self):
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT DISTINCT base_url, model FROM ai_configs WHERE is_active = 1 AND type = 'ollama'")
+            targets = [(row['base_url'], row['model']) for row in cursor.fetchall()]
+        for base_url, model in targets:
+            self.schedule_warm(base_url, model)
+
+    @staticmethod
+    def has_pending_jobs() -> bool:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM ai_jobs WHERE status IN ('queued', 'running') LIMIT 1")
+            return cursor.fetchone() is not None
+
+    async def _keep_alive_loop(self):
+        while True:
+            await asyncio.sleep(AI_KEEP_ALIVE_REFRESH_SECONDS)
+            try:
+                # 有排队/运行中的任务时续期，避免任务之间的空档让模型被卸载
+                if self.has_pending_jobs():
+                    self.warm_active()
+            except Exception as e:
+                logger.error(f"模型keep-alive续期失败: {e}")
+
+    def start(self):
+        self.warm_active()
+        self._task = asyncio.create_task(self._keep_alive_loop())
+
+    async def stop(self):
+        tasks = [t for t in [self._task, *self._warming.values()] if t is not None and not t.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._warming.clear()
+
+    def metrics(self) -> List[Dict[str, Any]]:
+        models = []
+        for state in self._stats.values():
+            calls = state["requests"] + state["warmups"]
+            models.append({
+                **{k: round(v, 1) if isinstance(v, float) else v for k, v in state.items()},
+                "avg_load_ms": round(state["load_ms_total"] / calls, 1) if calls else None,
+                "avg_eval_ms": round(state["eval_ms_total"] / state["requests"], 1) if state["requests"] else None,
+                "eval_tokens_per_sec": round(state["eval_tokens"] / (state["eval_ms_total"] / 1000), 1) if state["eval_ms_total"] else None,
+            })
+        return models
+
+model_manager = ModelLifecycleManager()
+
+# LLM调用遥测：每次后端调用与缓存命中都记录一行，批量写入 ai_call_telemetry 并按行数环形淘汰
+AI_TELEMETRY_MAX_ROWS = int(os.getenv("AI_TELEMETRY_MAX_ROWS", "20000"))
+AI_TELEMETRY_FLUSH_ROWS = 50         # 缓冲达到该行数时写库
+AI_TELEMETRY_FLUSH_SECONDS = 5       # 或距上次写库超过该秒数
+
+# 当前调用的来源：HTTP 请求的 scope（记录时取匹配到的路由）或后台任务类型
+ai_call_source: contextvars.ContextVar[Any] = contextvars.ContextVar("ai_call_source", default=None)
+
+def current_ai_endpoint() -> str:
+    source = ai_call_source.get()
+    if isinstance(source, dict):
+        route = source.get("route")
+        return f"{source.get('method', '')} {getattr(route, 'path', None) or source.get('path', '')}"
+    return source or "internal"
+
+class AICallSourceMiddleware:
+    """纯 ASGI 中间件：把请求 scope 放入上下文，供遥测按接口归类（不包裹响应体，不影响SSE）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = ai_call_source.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            ai_call_source.reset(token)
+
+app.add_middleware(AICallSourceMiddleware)
+
+class AITelemetry:
+    """缓冲写入LLM调用记录，并按模型/接口/后端汇总延迟分位与生成速度"""
+
+    COLUMNS = (
+        "created_at", "endpoint", "call_type", "backend", "model", "prompt_tokens", "response_tokens",
+        "latency_ms", "total_duration_ms", "load_duration_ms", "prompt_eval_duration_ms", "eval_duration_ms",
+        "cache_hit", "outcome", "error",
+    )
+
+    def __init__(self):
+        self._buffer: List[tuple] = []
+        self._last_flush = time.monotonic()
+
+    def record(self, model: str, call_type: str, outcome: str, latency_ms: Optional[float] = None,
+               backend: Optional[str] = None, prompt: Optional[str] = None, response_text: Optional[str] = None,
+               result: Optional[dict] = None, cache_hit: bool = False, error: Optional[Exception] = None):
+        """记录一次调用；result 为 Ollama 的最终响应（含 *_duration 纳秒与 *_count 字段）"""
+        result = result or {}
+
+        def duration_ms(field: str) -> Optional[float]:
+            value = result.get(field)
+            return round(value / 1e6, 2) if value is not None else None
+
+        prompt_tokens = result.get('prompt_eval_count')
+        if prompt_tokens is None and prompt is not None:
+            prompt_tokens = estimate_tokens(prompt)
+        response_tokens = result.get('eval_count')
+        if response_tokens is None and response_text is not None:
+            response_tokens = estimate_tokens(response_text)
+        self._buffer.append((
+            time.time(), current_ai_endpoint(), call_type,
+            AIClientManager.backend_key(backend) if backend else None, model,
+            prompt_tokens, response_tokens,
+            round(latency_ms, 2) if latency_ms is not None else None,
+            duration_ms('total_duration'), duration_ms('load_duration'),
+            duration_ms('prompt_eval_duration'), duration_ms('eval_duration'),
+            1 if cache_hit else 0, outcome,
+            (str(error) or error.__class__.__name__)[:500] if error is not None else None,
+        ))
+        if len(self._buffer) >= AI_TELEMETRY_FLUSH_ROWS or time.monotonic() - self._last_flush >= AI_TELEMETRY_FLUSH_SECONDS:
+            self.flush()
+
+    def record_cache_hit(self, ai_config, prompt: str, text: str, call_type: str = "generate"):
+        self.record(ai_config['model'], call_type, "success", latency_ms=0.0, prompt=prompt,
+                    response_text=text, cache_hit=True)
+
+    def flush(self):
+        """写入缓冲的记录并淘汰超出环形容量的旧记录；遥测失败只记日志，不影响调用本身"""
+        rows, self._buffer = self._buffer, []
+        self._last_flush = time.monotonic()
+        if not rows:
+            return
+        try:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany(f'''
+                    INSERT INTO ai_call_telemetry ({", ".join(self.COLUMNS)})
+                    VALUES ({", ".join("?" * len(self.COLUMNS))})
+                ''', rows)
+                cursor.execute('''
+                    DELETE FROM ai_call_telemetry
+                    WHERE id <= (SELECT MAX(id) FROM ai_call_telemetry) - ?
+                ''', (AI_TELEMETRY_MAX_ROWS,))
+                conn.commit()
+        except Exception as e:
+            logger.error(f"写入LLM调用遥测失败: {e}")
+
+    @staticmethod
+    def summarize(rows: list) -> Dict[str, Any]:
+        """汇总一组记录：预加载不计入延迟与速度统计，延迟分位只统计实际调用后端且成功的请求"""
+        calls = [r for r in rows if r['call_type'] != 'warmup']
+        backend_ok = [r for r in calls if r['outcome'] == 'success' and not r['cache_hit']]
+        latencies = sorted(r['latency_ms'] for r in backend_ok if r['latency_ms'] is not None)
+        timed = [r for r in backend_ok if r['eval_duration_ms'] and r['response_tokens']]
+        eval_seconds = sum(r['eval_duration_ms'] for r in timed) / 1000
+        wall_seconds = sum(r['latency_ms'] for r in backend_ok if r['latency_ms'] and r['response_tokens']) / 1000
+        loads = [r['load_duration_ms'] for r in backend_ok if r['load_duration_ms'] is not None]
+        cache_hits = sum(1 for r in calls if r['cache_hit'])
+
+        def rounded(value):
+            return round(value, 1) if value is not None else None
+
+        return {
+            "calls": len(calls),
+            "backend_calls": len(calls) - cache_hits,
+            "errors": sum(1 for r in calls if r['outcome'] == 'error'),
+            "cancelled": sum(1 for r in calls if r['outcome'] == 'cancelled'),
+            "cache_hits": cache_hits,
+            "cache_hit_rate": round(cache_hits / len(calls), 3) if calls else None,
+            "warmups": len(rows) - len(calls),
+            "p50_ms": rounded(percentile(latencies, 50)),
+            "p95_ms": rounded(percentile(latencies, 95)),
+            "p99_ms": rounded(percentile(latencies, 99)),
+            "avg_load_ms": rounded(sum(loads) / len(loads)) if loads else None,
+            "prompt_tokens": sum(r['prompt_tokens'] or 0 for r in calls),
+            "response_tokens": sum(r['response_tokens'] or 0 for r in calls),
+            # 生成速度（Ollama eval 阶段）与端到端吞吐（含排队、加载与提示词处理）
+            "eval_tokens_per_sec": rounded(sum(r['response_tokens'] for r in timed) / eval_seconds) if eval_seconds else None,
+            "throughput_tokens_per_sec": rounded(
+                sum(r['response_tokens'] or 0 for r in backend_ok if r['latency_ms']) / wall_seconds
+            ) if wall_seconds else None,
+        }
+
+    def metrics(self, since: Optional[float] = None) -> Dict[str, Any]:
+        self.flush()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {", ".join(self.COLUMNS)} FROM ai_call_telemetry
+                {"WHERE created_at >= ?" if since is not None else ""}
+            ''', (since,) if since is not None else ())
+            rows = cursor.fetchall()
+
+        def grouped(field: str) -> Dict[str, Any]:
+            groups: Dict[str, list] = {}
+            for row in rows:
+                groups.setdefault(row[field] or "cache", []).append(row)
+            return {key: self.summarize(group) for key, group in sorted(groups.items())}
+
+        return {
+            "overall": self.summarize(rows),
+            "by_model": grouped("model"),
+            "by_endpoint": grouped("endpoint"),
+            "by_backend": grouped("backend"),
+            "rows": len(rows),
+        }
+
+ai_telemetry = AITelemetry()
+
+# 后台任务队列配置
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))   # 工作协程数
+JOB_LEASE_SECONDS = 60          # 租约时长：超过该时间未续约的运行中任务视为失联，可被重新领取
+JOB_HEARTBEAT_SECONDS = 15      # 续约间隔，同时检查取消请求
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BASE_SECONDS = 5      # 失败重试的指数退避基数
+JOB_POLL_SECONDS = 2
+JOB_STATUSES = ("queued", "running", "succeeded", "failed", "cancelled")
+
+class JobQueue:
+    """基于 ai_jobs 表的持久化任务队列：领取时加租约，执行中定期心跳续约，失败按指数退避重试。
+
+    进程重启后，未完成的任务仍在表中：排队中的直接继续执行，运行中的在租约过期后被重新领取。
+    正常关闭时会主动释放本进程持有的租约，重启后立即恢复。
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self.owner = f"{os.getpid()}-{int(time.time() * 1000)}"
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._running: Dict[int, asyncio.Task] = {}
+        self.stopping = False
+
+    def enqueue(self, job_type: str, payload: dict, max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+        if job_type not in JOB_HANDLERS:
+            raise HTTPException(status_code=400, detail=f"未知的任务类型: {job_type}")
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO ai_jobs (job_type, payload, status, max_attempts, run_after)
+                VALUES (?, ?, 'queued', ?, ?)
+            ''', (job_type, json.dumps(payload, ensure_ascii=False), max(1, max_attempts), time.time()))
+            job_id = cursor.lastrowid
+            conn.commit()
+        event_bus.publish("tasks", {"job_id": job_id, "job_type": job_type, "status": "queued"})
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    def _claim(self):
+        """领取一个可执行的任务（排队到期或租约已过期），返回任务行或 None"""
+        now = time.time()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id FROM ai_jobs
+                WHERE (status = 'queued' AND run_after <= ?)
+                   OR (status = 'running' AND lease_expires < ?)
+                ORDER BY id
+                LIMIT 1
+            ''', (now, now))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            # 条件更新保证同一任务只会被一个工作协程（或进程）领取
+            cursor.execute('''
+                UPDATE ai_jobs
+                SET status = 'running', lease_owner = ?, lease_expires = ?, heartbeat_at = ?,
+                    attempts = attempts + 1, started_at = COALESCE(started_at, CURRENT_TIMESTAMP),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND (status = 'queued' OR (status = 'running' AND lease_expires < ?))
+            ''', (self.owner, now + JOB_LEASE_SECONDS, now, row['id'], now))
+            conn.commit()
+            if cursor.rowcount == 0:
+                return None
+            cursor.execute('SELECT * FROM ai_jobs WHERE id = ?', (row['id'],))
+            return cursor.fetchone()
+
+    def _update(self, job_id: int, status: str, result: Optional[dict] = None, error: Optional[str] = None,
+                run_after: Optional[float] = None, attempts_delta: int = 0):
+        finished = status in ("succeeded", "failed", "cancelled")
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                UPDATE ai_jobs
+                SET status = ?, result = COALESCE(?, result), error_message = ?,
+                    run_after = COALESCE(?, run_after), attempts = attempts + ?,
+                    lease_owner = NULL, lease_expires = NULL,
+                    {"finished_at = CURRENT_TIMESTAMP," if finished else ""}
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error,
+                  run_after, attempts_delta, job_id))
+            cursor.execute('SELECT job_type FROM ai_jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+            conn.commit()
+        event = {"job_id": job_id, "job_type": row['job_type'] if row else None, "status": status}
+        if error:
+            event["error"] = error
+        if result is not None:
+            event["result"] = result
+        event_bus.publish("tasks", event)
+
+    async def _heartbeat(self, job_id: int, task: asyncio.Task):
+        while not task.done():
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            now = time.time()
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE ai_jobs SET lease_expires = ?, heartbeat_at = ?
+                    WHERE id = ? AND lease_owner = ?
+                ''', (now + JOB_LEASE_SECONDS, now, job_id, self.owner))
+                cursor.execute('SELECT cancel_requested FROM ai_jobs WHERE id = ?', (job_id,))
+                row = cursor.fetchone()
+                conn.commit()
+            # 取消请求可能来自其他进程，由心跳负责转达
+            if row and row['cancel_requested']:
+                task.cancel()
+
+    async def _run_job(self, job):
+        job_id = job['id']
+        if job['cancel_requested']:
+            self._update(job_id, "cancelled")
+            return
+        if job['attempts'] > job['max_attempts']:
+            self._update(job_id, "failed", error=job['error_message'] or "任务多次租约过期，已超过最大尝试次数")
+            return
+        handler = JOB_HANDLERS.get(job['job_type'])
+        if handler is None:
+            self._update(job_id, "failed", error=f"未知的任务类型: {job['job_type']}")
+            return
+
+        event_bus.publish("tasks", {"job_id": job_id, "job_type": job['job_type'], "status": "running", "attempt": job['attempts']})
+        # 后台任务不套用交互式调用的默认截止时间（任务上下文在创建时复制）
+        token = ai_interactive_deadline.set(None)
+        source_token = ai_call_source.set(f"job:{job['job_type']}")
+        try:
+            task = asyncio.create_task(handler(job_id, json.loads(job['payload'] or '{}')))
+        finally:
+            ai_call_source.reset(source_token)
+            ai_interactive_deadline.reset(token)
+        self._running[job_id] = task
+        heartbeat = asyncio.create_task(self._heartbeat(job_id, task))
+        try:
+            result = await task
+            self._update(job_id, "succeeded", result=result or {})
+        except asyncio.CancelledError:
+            if self.stopping:
+                # 服务关闭：释放租约并退回本次尝试，重启后继续执行
+                self._update(job_id, "queued", error=None, attempts_delta=-1)
+                raise
+            self._update(job_id, "cancelled")
+        except HTTPException as he:
+            # 参数或前置条件错误，重试无意义
+            self._update(job_id, "failed", error=str(he.detail))
+        except Exception as e:
+            logger.error(f"后台任务 {job_id} ({job['job_type']}) 执行失败: {e}")
+            if job['attempts'] < job['max_attempts']:
+                delay = JOB_RETRY_BASE_SECONDS * (2 ** (job['attempts'] - 1))
+                self._update(job_id, "queued", error=str(e), run_after=time.time() + delay)
+            else:
+                self._update(job_id, "failed", error=str(e))
+        finally:
+            heartbeat.cancel()
+            self._running.pop(job_id, None)
+
+    async def _worker(self, index: int):
+        while True:
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"领取后台任务失败: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            await self._run_job(job)
+
+    async def start(self):
+        self.stopping = False
+        self._wakeup = asyncio.Event()
+        self._worker_tasks = [asyncio.create_task(self._worker(i)) for i in range(max(1, self.workers))]
+        logger.info(f"后台任务队列已启动，工作协程数: {len(self._worker_tasks)}")
+
+    async def stop(self):
+        self.stopping = True
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+    def cancel(self, job_id: int) -> str:
+        """取消任务：排队中的直接取消，运行中的打断执行（其他进程持有的由其心跳检测后取消）"""
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT status FROM ai_jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+            if not row:
+                raise HTTPException(status_code=404, detail="任务不存在")
+            status = row['status']
+            if status in ("succeeded", "failed", "cancelled"):
+                return status
+            cursor.execute('''
+                UPDATE ai_jobs SET cancel_requested = 1, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+            ''', (job_id,))
+            conn.commit()
+        if status == "queued":
+            self._update(job_id, "cancelled")
+            return "cancelled"
+        task = self._running.get(job_id)
+        if task is not None:
+            task.cancel()
+        return "cancelling"
+
+    def retry(self, job_id: int):
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE ai_jobs
+                SET status = 'queued', attempts = 0, cancel_requested = 0, run_after = ?,
+                    error_message = NULL, finished_at = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status IN ('failed', 'cancelled')
+            ''', (time.time(), job_id))
+            conn.commit()
+            if cursor.rowcount == 0:
+                raise HTTPException(status_code=400, detail="只有失败或已取消的任务可以重试")
+        event_bus.publish("tasks", {"job_id": job_id, "status": "queued"})
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+job_queue = JobQueue()
+
+# Web界面路由
+@app.get("/", response_class=HTMLResponse)
+async def read_root(request: Request):
+    """Web管理界面首页"""
+    return templates.TemplateResponse("index.html", {"request": request})
+
+@app.get("/ai", response_class=HTMLResponse)
+async def ai_config_page(request: Request):
+    """AI配置管理页面（简化版）"""
+    return templates.TemplateResponse("ai_simple.html", {"request": request})
+
+@app.get("/ai-advanced", response_class=HTMLResponse)
+async def ai_config_advanced_page(request: Request):
+    """AI配置管理页面（高级版）"""
+    return templates.TemplateResponse("ai_config.html", {"request": request})
+
+@app.get("/agents", response_class=HTMLResponse)
+async def agents_hub_page(request: Request):
+    """AI Agent工作台"""
+    return templates.TemplateResponse("agents_hub.html", {"request": request})
+
+@app.get("/links", response_class=HTMLResponse)
+async def link_management_page(request: Request):
+    """链接管理页面"""
+    return templates.TemplateResponse("link_management.html", {"request": request})
+
+@app.get("/studio", response_class=HTMLResponse)
+async def agent_studio_page(request: Request):
+    """Agent工作室页面"""
+    return templates.TemplateResponse("agent_studio.html", {"request": request})
+
+@app.get("/bookmarks", response_class=HTMLResponse)
+async def bookmarks_page(request: Request):
+    """书签管理页面"""
+    return templates.TemplateResponse("bookmarks.html", {"request": request})
+
+@app.get("/bookmarks/classify", response_class=HTMLResponse)
+async def bookmarks_classify_page(request: Request):
+    """书签智能分类页面（会话草稿）"""
+    return templates.TemplateResponse("bookmarks_classify.html", {"request": request})
+
+# API端点
+@app.get("/api", response_model=ApiResponse)
+async def api_root():
+    """API根路径"""
+    return ApiResponse(
+        success=True,
+        message="浏览器历史记录API服务运行中",
+        data={
+            "version": "1.0.0",
+            "endpoints": ["/api/sync-single", "/api/sync-batch", "/api/stats", "/api/history"]
+        }
+    )
+
+# 健康检查
+@app.get("/api/healthz")
+async def healthz():
+    try:
+        # 简单读库验证
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+        return {"ok": True}
+    except Exception:
+        return JSONResponse(status_code=500, content={"ok": False})
+
+# 实时事件流（SSE）
+@app.get("/api/events")
+async def stream_events(request: Request, topics: str = "stats,tasks,classification"):
+    """按主题订阅实时事件：ingest / stats / tasks / classification"""
+    topic_list = [t.strip() for t in topics.split(',') if t.strip()]
+    unknown = [t for t in topic_list if t not in EVENT_TOPICS]
+    if unknown or not topic_list:
+        raise HTTPException(status_code=400, detail=f"未知的事件主题: {', '.join(unknown) or topics}")
+    queue = event_bus.subscribe(topic_list)
+
+    async def event_stream():
+        try:
+            yield "retry: 3000\n\n"
+            if "stats" in topic_list:
+                yield format_sse("stats", (await build_stats()).data)
+            while not await request.is_disconnected():
+                try:
+                    topic, data = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(topic, data)
+        finally:
+            event_bus.unsubscribe(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# 引导状态：是否已有历史数据、是否有激活AI
+@app.get("/api/onboarding/state", response_model=ApiResponse)
+async def get_onboarding_state():
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(1) as cnt FROM browser_history")
+            has_history = (cursor.fetchone()[0] or 0) > 0
+
+            cursor.execute("SELECT COUNT(1) FROM ai_configs WHERE is_active = 1")
+            has_active_ai = (cursor.fetchone()[0] or 0) > 0
+
+        return ApiResponse(
+            success=True,
+            message="获取引导状态成功",
+            data={
+                "has_history": has_history,
+                "has_active_ai": has_active_ai
+            }
+        )
+    except Exception as e:
+        logger.error(f"获取引导状态失败: {e}")
+        raise HTTPException(status_code=500, detail="获取引导状态失败")
+
+# AI自动探测（Ollama）
+@app.post("/api/ai/autodetect", response_model=ApiResponse)
+async def autodetect_ai(base_url: Optional[str] = None):
+    try:
+        req = OllamaTestRequest(base_url=base_url or "http://localhost:11434")
+        # 直接复用 test_ollama_connection 的逻辑
+        result = await test_ollama_connection(req)
+        return ApiResponse(success=True, message="探测成功", data=result.data)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"AI自动探测失败: {e}")
+        raise HTTPException(status_code=500, detail="AI自动探测失败")
+
+def format_word_cloud_text(word_cloud: Optional[dict]) -> str:
+    """将词云分档数据格式化为提示词文本"""
+    if not word_cloud:
+        return ""
+    return " | ".join([
+        f"[高频] {', '.join(word_cloud.get('high_frequency', []))}",
+        f"[中频] {', '.join(word_cloud.get('medium_frequency', []))}",
+        f"[低频] {', '.join(word_cloud.get('low_frequency', []))}",
+    ])
+
+# 分析提示词的数据部分按估算token预算打包（域名、标题、时间分布按优先级截断）
+ANALYSIS_PROMPT_TOKEN_BUDGET = int(os.getenv("ANALYSIS_PROMPT_TOKEN_BUDGET", "1500"))
+ANALYSIS_TITLES_PER_DOMAIN = 3   # 每个域名最多入选的标题数，保证标题样本覆盖面
+
+def _history_window_conditions(start: Optional[int], end: Optional[int]) -> tuple:
+    conditions, params = [], []
+    if start is not None:
+        conditions.append("visit_time >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("visit_time < ?")
+        params.append(end)
+    return conditions, params
+
+def collect_history_aggregates(cursor, start: Optional[int] = None, end: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """在 SQLite 中聚合分析所需的概览、域名、标题与时间分布（不限时间范围时覆盖全部历史并使用汇总表）"""
+    conditions, params = _history_window_conditions(start, end)
+    where_clause = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+    use_rollups = not conditions
+    cursor.execute(f'''
+        SELECT COUNT(*) AS records, COUNT(DISTINCT url) AS unique_urls,
+               SUM(visit_count) AS visits, MIN(visit_time) AS earliest, MAX(visit_time) AS latest
+        FROM browser_history {where_clause}
+    ''', params)
+    overview = dict(cursor.fetchone())
+    if not overview['records']:
+        return None
+
+    cursor.connection.create_function("url_domain", 1, extract_domain, deterministic=True)
+    if use_rollups:
+        cursor.execute('SELECT domain, visits FROM history_domain_rollup ORDER BY visits DESC LIMIT 100')
+    else:
+        cursor.execute(f'''
+            SELECT url_domain(url) AS domain, COUNT(*) AS visits
+            FROM browser_history {where_clause}
+            GROUP BY domain
+            ORDER BY visits DESC
+            LIMIT 100
+        ''', params)
+    domains = [(r['domain'], r['visits']) for r in cursor.fetchall() if r['domain']]
+
+    title_filter = " AND ".join(["title IS NOT NULL AND title != ''"] + conditions)
+    cursor.execute(f'''
+        SELECT title, url_domain(MIN(url)) AS domain, COUNT(*) AS visits, MAX(visit_time) AS last_visit
+        FROM browser_history
+        WHERE {title_filter}
+        GROUP BY title
+        ORDER BY visits DESC, last_visit DESC
+        LIMIT 300
+    ''', params)
+    titles = []
+    per_domain: Dict[str, int] = {}
+    for r in cursor.fetchall():
+        if per_domain.get(r['domain'], 0) >= ANALYSIS_TITLES_PER_DOMAIN:
+            continue
+        per_domain[r['domain']] = per_domain.get(r['domain'], 0) + 1
+        titles.append((r['title'], r['visits']))
+
+    hour_histogram = [0] * 24
+    weekday_histogram = [0] * 7
+    if use_rollups:
+        cursor.execute('SELECT weekday, hour, visits FROM history_time_rollup')
+    else:
+        cursor.execute(f'''
+            SELECT CAST(strftime('%w', visit_time / 1000, 'unixepoch', 'localtime') AS INTEGER) AS weekday,
+                   CAST(strftime('%H', visit_time / 1000, 'unixepoch', 'localtime') AS INTEGER) AS hour,
+                   COUNT(*) AS visits
+            FROM browser_history {where_clause}
+            GROUP BY weekday, hour
+        ''', params)
+    for r in cursor.fetchall():
+        hour_histogram[r['hour']] += r['visits']
+        weekday_histogram[r['weekday']] += r['visits']
+
+    cursor.execute(f'''
+        SELECT strftime('%Y-%m', visit_time / 1000, 'unixepoch', 'localtime') AS month, COUNT(*) AS visits
+        FROM browser_history {where_clause}
+        GROUP BY month
+        ORDER BY month DESC
+        LIMIT 12
+    ''', params)
+    months = [(r['month'], r['visits']) for r in cursor.fetchall()]
+
+    cursor.execute(f'''
+        SELECT category, COUNT(*) AS visits
+        FROM browser_history {where_clause}
+        GROUP BY category
+        ORDER BY visits DESC
+    ''', params)
+    categories = [(r['category'], r['visits']) for r in cursor.fetchall() if r['category'] not in PROFILE_UNCATEGORIZED + (None,)]
+
+    return {
+        "overview": overview,
+        "domains": domains,
+        "titles": titles,
+        "activity": describe_activity_pattern(hour_histogram, weekday_histogram),
+        "months": months,
+        "categories": categories,
+    }
+
+def pack_lines(lines: List[str], budget: int) -> List[str]:
+    """按优先级顺序取行，直到估算token超出预算"""
+    packed = []
+    used = 0
+    for line in lines:
+        cost = estimate_tokens(line) + 1
+        if used + cost > budget:
+            break
+        packed.append(line)
+        used += cost
+    return packed
+
+def pack_history_sections(aggregates: Dict[str, Any], budget: int, max_titles: Optional[int] = None) -> tuple:
+    """按预算打包 (域名行, 时间分布行, 标题行)：时间分布占20%、高频域名占35%、标题样本用剩余全部"""
+    activity = aggregates["activity"]
+    time_lines = [f"活动模式: {activity['activity_pattern']}"]
+    if activity.get("most_active_weekday"):
+        time_lines.append(f"最活跃: {activity['most_active_weekday']}")
+    if aggregates["categories"]:
+        time_lines.append("已分类访问: " + ", ".join(f"{c} {n}次" for c, n in aggregates["categories"][:8]))
+    time_lines.extend(f"{m}: {n}次" for m, n in aggregates["months"])
+    time_lines = pack_lines(time_lines, budget // 5)
+    remaining = budget - sum(estimate_tokens(line) + 1 for line in time_lines)
+
+    domain_lines = pack_lines([f"{d} ({c}次)" for d, c in aggregates["domains"]], int(budget * 0.35))
+    remaining -= sum(estimate_tokens(line) + 1 for line in domain_lines)
+
+    title_lines = pack_lines([t for t, _ in aggregates["titles"]][:max_titles], remaining)
+    return domain_lines, time_lines, title_lines
+
+def build_analysis_prompt_for_history(
+    aggregates: Dict[str, Any],
+    range_text: str = "全部数据",
+    word_cloud: Optional[dict] = None,
+    profile: Optional[dict] = None,
+    token_budget: Optional[int] = None
+) -> str:
+    try:
+        overview = aggregates["overview"]
+        # 已有本地计算的关键词时，只保留少量标题样本作为语境
+        has_keywords = bool(word_cloud and word_cloud.get('high_frequency'))
+        domain_lines, time_lines, title_lines = pack_history_sections(
+            aggregates, token_budget or ANALYSIS_PROMPT_TOKEN_BUDGET, 10 if has_keywords else None
+        )
+
+        top_domains_text = "\n".join(domain_lines)
+        titles_text = "\n".join(title_lines)
+        time_text = "\n".join(time_lines)
+
+        if has_keywords:
+            keywords_section = f"""
+=== 关键词词云（本地TF-IDF计算）===
+{format_word_cloud_text(word_cloud)}
+"""
+            word_cloud_task = """3. **兴趣标签解读**
+   - 结合上方已计算的关键词词云，归纳主要兴趣主题（无需重新生成词云）"""
+        else:
+            keywords_section = ""
+            word_cloud_task = """3. **兴趣标签词云** (请用中文，按重要性排序)
+   格式：[高频] 关键词1, 关键词2 | [中频] 关键词3, 关键词4 | [低频] 关键词5, 关键词6"""
+
+        profile_section = ""
+        if profile:
+            profile_section = f"""
+=== 本地统计画像 ===
+兴趣分类: {', '.join(profile.get('interests', [])) or '暂无'}
+活动模式: {profile.get('activity_pattern', '未知')}
+内容偏好: {profile.get('content_preference', '未知')}
+"""
+
+        prompt = f"""作为专业的数据分析师，请分析以下浏览历史数据：
+
+=== 数据概览 ===
+总访问记录: {overview['records']} 条（{overview['unique_urls']} 个不同页面，{len(aggregates['domains'])}+ 个站点）
+时间范围: {range_text}
 
 === 高频访问网站 ===
 {top_domains_text}
 
-=== 页面标题样本 ===
-{'\n'.join(titles)}
+=== 时间分布 ===
+{time_text}
 
+=== 页面标题样本 ===
+{titles_text}
+{keywords_section}{profile_section}
 请提供以下分析：
 
 1. **用户画像分析**
@@ -649,8 +3341,7 @@ def build_analysis_prompt_for_history(records: list, range_text: str = "最近
    - 关注的主题和话题
    - 内容消费习惯
 
-3. **兴趣标签词云** (请用中文，按重要性排序)
-   格式：[高频] 关键词1, 关键词2 | [中频] 关键词3, 关键词4 | [低频] 关键词5, 关键词6
+{word_cloud_task}
 
 4. **行为模式洞察**
    - 浏览行为特点
@@ -667,58 +3358,303 @@ def build_analysis_prompt_for_history(records: list, range_text: str = "最近
     except Exception:
         return "请根据最近的浏览记录，输出画像、偏好、标签词云、行为洞察与个性化建议。"
 
-@app.post("/api/analyze/run", response_model=ApiResponse)
-async def run_analysis(limit: int = 1000):
-    """触发一次AI分析，结果写入 analyze_summaries 表"""
-    try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT url, title, visit_time, visit_count
-                FROM browser_history
-                ORDER BY last_visit_time DESC
-                LIMIT ?
-            ''', (limit,))
-            rows = cursor.fetchall()
-            if not rows:
-                raise HTTPException(status_code=400, detail="没有历史数据可用于分析")
+def get_active_ai_config(config_name: Optional[str] = None):
+    """获取指定名称或当前激活的AI配置，不存在时返回400"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if config_name:
+            cursor.execute("SELECT * FROM ai_configs WHERE name=?", (config_name,))
+        else:
+            cursor.execute("SELECT * FROM ai_configs WHERE is_active = 1 LIMIT 1")
+        ai_config = cursor.fetchone()
+        if not ai_config:
+            raise HTTPException(status_code=400, detail="没有可用的AI配置，请先完成AI配置")
+        return ai_config
 
-            records = [{
-                "url": r["url"],
-                "title": r["title"],
-                "visit_time": r["visit_time"],
-                "visit_count": r["visit_count"],
-            } for r in rows]
+def prepare_history_analysis(limit: Optional[int] = None):
+    """聚合历史记录并构建分析提示词，返回 (提示词, 覆盖的记录数)；limit 为空时覆盖全部历史，否则只覆盖最近 limit 条"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        start = None
+        if limit:
+            cursor.execute('SELECT visit_time FROM browser_history ORDER BY visit_time DESC LIMIT 1 OFFSET ?', (limit - 1,))
+            row = cursor.fetchone()
+            start = row['visit_time'] if row else None
+        aggregates = collect_history_aggregates(cursor, start)
+        if not aggregates:
+            raise HTTPException(status_code=400, detail="没有历史数据可用于分析")
+
+        # 本地计算同一时间范围的关键词词云，无需交给模型生成
+        word_cloud = build_keyword_tiers(compute_keywords(cursor, start, None))
+        profile = load_user_profile(cursor)
+
+    overview = aggregates["overview"]
+    range_text = " 至 ".join(
+        datetime.datetime.fromtimestamp(t / 1000).strftime('%Y-%m-%d') for t in (overview['earliest'], overview['latest'])
+    )
+    prompt = build_analysis_prompt_for_history(aggregates, range_text=range_text, word_cloud=word_cloud, profile=profile)
+    return prompt, overview['records']
 
-        # 获取活跃AI配置
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM ai_configs WHERE is_active = 1 LIMIT 1")
-            ai_config = cursor.fetchone()
-            if not ai_config:
-                raise HTTPException(status_code=400, detail="没有可用的AI配置，请先完成AI配置")
+def save_analysis_summary(summary_text: str, records_used: int) -> int:
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO analyze_summaries (summary_text, records_used)
+            VALUES (?, ?)
+        ''', (summary_text, records_used))
+        conn.commit()
+        return cursor.lastrowid
+
+# 分段（map-reduce）分析：按周/月分段并发总结，分段结果按数据签名缓存，再逐层合并为最终分析
+ANALYSIS_WINDOW_TOKEN_BUDGET = int(os.getenv("ANALYSIS_WINDOW_TOKEN_BUDGET", "600"))
+ANALYSIS_REDUCE_TOKEN_BUDGET = int(os.getenv("ANALYSIS_REDUCE_TOKEN_BUDGET", "3000"))
+ANALYSIS_WINDOW_SQL = {
+    "week": "date(visit_time / 1000, 'unixepoch', 'localtime', 'weekday 0', '-6 days')",
+    "month": "strftime('%Y-%m', visit_time / 1000, 'unixepoch', 'localtime')",
+}
+ANALYSIS_MODES = ("direct", "mapreduce")
+
+def list_analysis_windows(cursor, granularity: str) -> List[Dict[str, Any]]:
+    """按周/月分组，返回每段的时间范围与用于判断变化的统计"""
+    cursor.execute(f'''
+        SELECT {ANALYSIS_WINDOW_SQL[granularity]} AS window_key,
+               COUNT(*) AS records, MAX(id) AS max_id, SUM(visit_count) AS visits, MAX(updated_at) AS updated,
+               MIN(visit_time) AS start, MAX(visit_time) AS latest
+        FROM browser_history
+        GROUP BY window_key
+        ORDER BY window_key
+    ''')
+    return [dict(r) for r in cursor.fetchall()]
+
+def analysis_window_signature(window: Dict[str, Any], ai_config) -> str:
+    text = f"{window['records']}:{window['max_id']}:{window['visits']}:{window['updated']}:{ai_config['type']}:{ai_config['model']}"
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def build_window_summary_prompt(label: str, aggregates: Dict[str, Any], keywords: List[str]) -> str:
+    domain_lines, time_lines, title_lines = pack_history_sections(aggregates, ANALYSIS_WINDOW_TOKEN_BUDGET, 15)
+    return f"""请用不超过150字概括用户在 {label} 这一时段的浏览特征：主要兴趣主题、常用网站类型、时间与行为特点。只输出概括内容。
+
+访问记录: {aggregates['overview']['records']} 条
+高频网站: {', '.join(domain_lines)}
+时间分布: {'；'.join(time_lines)}
+关键词: {', '.join(keywords) or '暂无'}
+页面标题样本:
+{chr(10).join(title_lines)}
+"""
+
+async def summarize_analysis_window(ai_config, granularity: str, window: Dict[str, Any], signature: str, use_cache: bool) -> str:
+    """map：总结单个时间段并保存"""
+    start, end = window['start'], window['latest'] + 1
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        aggregates = collect_history_aggregates(cursor, start, end)
+        keywords = [k['term'] for k in compute_keywords(cursor, start, end, limit=10)]
+    prompt = build_window_summary_prompt(window['window_key'], aggregates, keywords)
+    summary = (await generate_content_with_ai(ai_config, prompt, use_cache=use_cache, bounded=True)).strip()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO analysis_window_summaries (granularity, window_key, signature, records, summary, updated_at)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(granularity, window_key) DO UPDATE SET
+                signature = excluded.signature, records = excluded.records,
+                summary = excluded.summary, updated_at = CURRENT_TIMESTAMP
+        ''', (granularity, window['window_key'], signature, window['records'], summary))
+        conn.commit()
+    return summary
+
+def format_window_entries(entries: List[tuple]) -> List[str]:
+    return [f"[{label}] {text}" for label, text in entries]
+
+async def reduce_window_summaries(ai_config, entries: List[tuple], use_cache: bool) -> List[tuple]:
+    """分段总结超出预算时，把相邻分段分组合并为更高层的总结，直到能放入最终提示词"""
+    budget = ANALYSIS_REDUCE_TOKEN_BUDGET
+    while len(entries) > 1 and sum(estimate_tokens(line) + 1 for line in format_window_entries(entries)) > budget:
+        groups: List[List[tuple]] = []
+        used = budget
+        for entry, line in zip(entries, format_window_entries(entries)):
+            cost = estimate_tokens(line) + 1
+            if used + cost > budget:
+                groups.append([])
+                used = 0
+            groups[-1].append(entry)
+            used += cost
+        if len(groups) == len(entries):
+            break
+
+        async def merge(group: List[tuple]) -> tuple:
+            label = f"{group[0][0]} ~ {group[-1][0]}"
+            if len(group) == 1:
+                return group[0]
+            prompt = f"""请将以下连续时段的浏览总结合并为一段不超过300字的阶段总结，保留主要兴趣主题及其变化。只输出总结内容。
+
+{chr(10).join(format_window_entries(group))}
+"""
+            # 合并提示词只依赖分段总结，分段未变化时命中LLM响应缓存
+            text = await generate_content_with_ai(ai_config, prompt, use_cache=use_cache, bounded=True)
+            return label, text.strip()
 
-        prompt = build_analysis_prompt_for_history(records, range_text="最近数据")
+        entries = list(await asyncio.gather(*(merge(g) for g in groups)))
+    return entries
+
+async def prepare_mapreduce_analysis(ai_config, granularity: str = "month", use_cache: bool = True):
+    """分段分析：只重新总结数据有变化的时间段，返回 (最终提示词, 覆盖的记录数, 分段统计)"""
+    if granularity not in ANALYSIS_WINDOW_SQL:
+        raise HTTPException(status_code=400, detail="granularity 仅支持 week/month")
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        windows = list_analysis_windows(cursor, granularity)
+        if not windows:
+            raise HTTPException(status_code=400, detail="没有历史数据可用于分析")
+        cursor.execute(
+            'SELECT window_key, signature, summary FROM analysis_window_summaries WHERE granularity = ?',
+            (granularity,)
+        )
+        stored = {r['window_key']: r for r in cursor.fetchall()}
+        profile = load_user_profile(cursor)
+
+    summaries: Dict[str, str] = {}
+    todo = []
+    for w in windows:
+        signature = analysis_window_signature(w, ai_config)
+        row = stored.get(w['window_key'])
+        if use_cache and row and row['signature'] == signature:
+            summaries[w['window_key']] = row['summary']
+        else:
+            todo.append((w, signature))
+
+    # 各时间段通过路由器并发提交，按后端并发上限分散到所有可用后端
+    results = await asyncio.gather(
+        *(summarize_analysis_window(ai_config, granularity, w, sig, use_cache) for w, sig in todo),
+        return_exceptions=True
+    )
+    failed = []
+    for (w, _), result in zip(todo, results):
+        if isinstance(result, Exception):
+            logger.warning(f"分段总结失败 {granularity} {w['window_key']}: {result}")
+            failed.append(w['window_key'])
+        else:
+            summaries[w['window_key']] = result
+    if not summaries:
+        raise Exception("所有分段总结均失败")
+
+    entries = await reduce_window_summaries(
+        ai_config, [(w['window_key'], summaries[w['window_key']]) for w in windows if w['window_key'] in summaries], use_cache
+    )
+    records = sum(w['records'] for w in windows if w['window_key'] in summaries)
+    range_text = f"{windows[0]['window_key']} 至 {windows[-1]['window_key']}"
+    unit = "周" if granularity == "week" else "月"
+    profile_section = ""
+    if profile:
+        profile_section = f"""
+=== 本地统计画像 ===
+兴趣分类: {', '.join(profile.get('interests', [])) or '暂无'}
+活动模式: {profile.get('activity_pattern', '未知')}
+内容偏好: {profile.get('content_preference', '未知')}
+"""
+    prompt = f"""作为专业的数据分析师，以下是用户浏览历史按{unit}分段的阶段总结（按时间顺序），覆盖 {range_text} 共 {records} 条访问记录：
+
+=== 阶段总结 ===
+{chr(10).join(pack_lines(format_window_entries(entries), ANALYSIS_REDUCE_TOKEN_BUDGET))}
+{profile_section}
+请综合各阶段提供以下分析：
+
+1. **用户画像分析**
+   - 长期稳定的兴趣领域和偏好
+   - 职业/身份特征推测
+   - 生活习惯和时间模式
+
+2. **兴趣变化趋势**
+   - 新出现、持续增强或逐渐减弱的主题
+   - 阶段性的关注重点
+
+3. **兴趣标签词云** (请用中文，按重要性排序)
+   格式：[高频] 关键词1, 关键词2 | [中频] 关键词3, 关键词4 | [低频] 关键词5, 关键词6
+
+4. **行为模式洞察**
+   - 浏览行为特点
+   - 信息获取方式
+   - 潜在需求和痛点
+
+5. **个性化建议**
+   - 内容推荐方向
+   - 学习成长建议
+   - 效率优化建议
+
+请用专业但易懂的语言，提供有价值的洞察和建议。"""
+    info = {"windows": len(windows), "recomputed": len(todo) - len(failed), "failed_windows": failed}
+    return prompt, records, info
+
+async def prepare_analysis(ai_config, limit: Optional[int], mode: str, granularity: str, use_cache: bool):
+    """按模式构建分析提示词，返回 (提示词, 覆盖的记录数, 附加信息)"""
+    if mode not in ANALYSIS_MODES:
+        raise HTTPException(status_code=400, detail="mode 仅支持 direct/mapreduce")
+    if mode == "mapreduce":
+        return await prepare_mapreduce_analysis(ai_config, granularity, use_cache)
+    prompt, records_used = prepare_history_analysis(limit)
+    return prompt, records_used, {}
+
+@app.post("/api/analyze/run", response_model=ApiResponse)
+async def run_analysis(
+    limit: Optional[int] = None,
+    no_cache: bool = False,
+    background: bool = False,
+    mode: str = "direct",
+    granularity: str = "month"
+):
+    """触发一次AI分析，结果写入 analyze_summaries 表。
+
+    mode=direct 基于聚合数据直接分析（limit 限定最近N条）；mode=mapreduce 按周/月分段总结后再合并，
+    只重新总结数据有变化的时间段。background=true 时加入后台队列并立即返回任务ID。
+    """
+    try:
+        if background:
+            job_id = job_queue.enqueue("analysis", {
+                "limit": limit, "no_cache": no_cache, "mode": mode, "granularity": granularity
+            })
+            return ApiResponse(success=True, message="分析任务已加入队列", data={"job_id": job_id})
+        ai_config = get_active_ai_config()
+        prompt, records_used, info = await prepare_analysis(ai_config, limit, mode, granularity, not no_cache)
         # 复用生成逻辑
-        response_text = await generate_content_with_ai(ai_config, prompt)
+        response_text = await generate_content_with_ai(ai_config, prompt, use_cache=not no_cache)
+        save_analysis_summary(response_text, records_used)
 
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO analyze_summaries (summary_text, records_used)
-                VALUES (?, ?)
-            ''', (response_text, len(records)))
-            conn.commit()
+        return ApiResponse(success=True, message="分析已完成", data={"records_used": records_used, **info})
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"运行分析失败: {e}")
+        raise HTTPException(status_code=500, detail="运行分析失败")
 
-        return ApiResponse(success=True, message="分析已完成", data={"records_used": len(records)})
+@app.post("/api/analyze/run/stream")
+async def run_analysis_stream(
+    limit: Optional[int] = None,
+    no_cache: bool = False,
+    mode: str = "direct",
+    granularity: str = "month"
+):
+    """流式运行AI分析：以SSE逐段推送模型输出（分段模式下先完成各时间段总结），生成结束后写入 analyze_summaries 表"""
+    try:
+        ai_config = get_active_ai_config()
+        prompt, records_used, info = await prepare_analysis(ai_config, limit, mode, granularity, not no_cache)
     except HTTPException as he:
         raise he
     except Exception as e:
         logger.error(f"运行分析失败: {e}")
         raise HTTPException(status_code=500, detail="运行分析失败")
 
+    def on_complete(text: str) -> dict:
+        summary_id = save_analysis_summary(text, records_used)
+        return {"summary_id": summary_id, "records_used": records_used}
+
+    return generation_sse_response(ai_config, prompt, {"records_used": records_used, **info}, on_complete, use_cache=not no_cache)
+
 @app.get("/api/analyze/summary", response_model=ApiResponse)
-async def get_latest_summary():
+async def get_latest_summary(request: Request):
+    """获取最新分析摘要（支持 ETag 条件请求）"""
+    return await cached_json_response(request, "analyze-summary", ["analyze_summaries"], build_latest_summary)
+
+async def build_latest_summary() -> ApiResponse:
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
@@ -797,6 +3733,8 @@ async def sync_bookmarks(batch: BookmarkBatch):
                 else:
                     new_count += 1
             conn.commit()
+        refresh_user_profile_safely()
+        event_bus.publish("ingest", {"source": "bookmarks", "new_items": new_count, "updated_items": upd_count})
         return ApiResponse(success=True, message='书签同步完成', data={"new": new_count, "updated": upd_count, "total": len(batch.items)})
     except Exception as e:
         logger.error(f'同步书签失败: {e}')
@@ -845,7 +3783,11 @@ async def list_bookmarks(limit: int = 100, offset: int = 0, search: Optional[str
         raise HTTPException(status_code=500, detail='获取书签失败')
 
 @app.get('/api/bookmarks/stats', response_model=ApiResponse)
-async def bookmarks_stats():
+async def bookmarks_stats(request: Request):
+    """书签统计（支持 ETag 条件请求）"""
+    return await cached_json_response(request, "bookmarks-stats", ["bookmarks"], build_bookmarks_stats)
+
+async def build_bookmarks_stats() -> ApiResponse:
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
@@ -860,13 +3802,26 @@ async def bookmarks_stats():
         logger.error(f'获取书签统计失败: {e}')
         raise HTTPException(status_code=500, detail='获取书签统计失败')
 
+# 分批分类：按估算token切分书签列表，避免单个提示词超出模型上下文
+CLASSIFY_BATCH_TOKEN_BUDGET = int(os.getenv("CLASSIFY_BATCH_TOKEN_BUDGET", "1500"))  # 每批书签列表的估算token上限
+CLASSIFY_BATCH_MAX_ITEMS = 40      # 每批最多书签数（输出JSON同样占用token）
+CLASSIFY_BATCH_RETRIES = 2         # 失败批次的重试轮数
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """粗略估算token数：CJK字符约1个token，其余字符约4个字符1个token"""
+    if not text:
+        return 0
+    cjk = len(re.findall(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]', text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+def format_classify_item(it: dict) -> str:
+    title = it.get('title') or ''
+    url = it.get('url') or ''
+    chrome_id = it.get('chrome_id') or ''
+    return f"{{id:'{chrome_id}', title:'{title}', url:'{url}'}}"
+
 def build_bookmark_classify_prompt(items: list) -> str:
-    lines = []
-    for it in items:
-        title = it.get('title') or ''
-        url = it.get('url') or ''
-        chrome_id = it.get('chrome_id') or ''
-        lines.append(f"{{id:'{chrome_id}', title:'{title}', url:'{url}'}}")
+    lines = [format_classify_item(it) for it in items]
     template = f"""请对以下收藏夹书签进行智能分类与打标签，并输出严格的JSON数组：
 
 要求：
@@ -885,131 +3840,685 @@ def build_bookmark_classify_prompt(items: list) -> str:
 """
     return template
 
-@app.post('/api/bookmarks/ai-classify', response_model=ApiResponse)
-async def ai_classify_bookmarks(limit: int = 100):
-    try:
-        # 读取待分类书签
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT chrome_id, title, url
-                FROM bookmarks
-                WHERE is_deleted = 0 AND type='bookmark' AND (ai_category IS NULL OR ai_category = '')
-                ORDER BY date_modified DESC NULLS LAST, date_added DESC NULLS LAST
-                LIMIT ?
-            ''', (limit,))
-            rows = cursor.fetchall()
-            if not rows:
-                return ApiResponse(success=True, message='暂无待分类书签', data={"classified": 0})
-            items = [{"chrome_id": r["chrome_id"], "title": r["title"], "url": r["url"]} for r in rows]
+def chunk_classify_items(
+    items: list,
+    token_budget: Optional[int] = None,
+    max_items: Optional[int] = None
+) -> List[list]:
+    """按估算token与条数上限切分书签（单条超预算时独占一批）"""
+    token_budget = token_budget or CLASSIFY_BATCH_TOKEN_BUDGET
+    max_items = max_items or CLASSIFY_BATCH_MAX_ITEMS
+    batches: List[list] = []
+    current: list = []
+    current_tokens = 0
+    for it in items:
+        tokens = estimate_tokens(format_classify_item(it))
+        if current and (current_tokens + tokens > token_budget or len(current) >= max_items):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(it)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+class JSONArrayStreamParser:
+    """容错的增量JSON数组解析器：边接收片段边产出数组中已完整的元素。
+
+    元素按括号深度（跳过字符串内容）切分后单独解析，失败时尝试修复单引号与尾逗号，
+    仍失败的元素（含引号不配对导致跨行的元素）作为错误单独报告，跳过其剩余部分后继续解析其他元素。数组前后的说明文字与代码块标记会被忽略；
+    没有外层数组、逐个输出的对象同样可以解析。
+    """
+
+    def __init__(self):
+        self.index = 0
+        self._state = 'seek'   # seek -> array -> done
+        self._buf: List[str] = []
+        self._junk: List[str] = []
+        self._depth = 0
+        self._quote = ''
+        self._escape = False
+        self._skip = False     # 丢弃已报错元素的剩余部分，直到其括号闭合
+        self._resync = False   # 字符串内遇到换行，等待下一行首字符判断如何恢复
+
+    def feed(self, text: str) -> List[tuple]:
+        """输入一段文本，返回新完成的 ("item", dict) / ("error", {...}) 事件"""
+        events: List[tuple] = []
+        for ch in text:
+            if self._state == 'done':
+                break
+            if self._state == 'seek':
+                if ch == '[':
+                    self._state = 'array'
+                elif ch == '{':
+                    self._state = 'array'
+                    self._buf, self._depth = [ch], 1
+                continue
+            if self._resync:
+                if ch.isspace():
+                    continue
+                self._resync = False
+                if ch in '{[],':
+                    # 下一行以新元素开头：原元素缺少闭合引号，直接回到元素之间
+                    self._skip, self._depth, self._quote, self._escape = False, 0, '', False
+                # 否则视为字符串跨行继续：保持括号与引号状态，跳过该元素余下部分
+            if self._buf or self._skip:
+                if self._buf:
+                    self._buf.append(ch)
+                if self._quote:
+                    if ch == '\n':
+                        # JSON 字符串不能跨行：报告该元素，按下一行的内容决定从哪里继续
+                        if self._buf:
+                            events.append(self._error(''.join(self._buf), "引号不匹配"))
+                            self._buf = []
+                        self._skip = self._resync = True
+                    elif self._escape:
+                        self._escape = False
+                    elif ch == '\\':
+                        self._escape = True
+                    elif ch == self._quote:
+                        self._quote = ''
+                elif ch in '"\'':
+                    self._quote = ch
+                elif ch in '{[':
+                    self._depth += 1
+                elif ch in '}]':
+                    self._depth -= 1
+                    if self._depth == 0:
+                        if self._skip:
+                            self._skip = False
+                        else:
+                            events.append(self._emit(''.join(self._buf)))
+                            self._buf = []
+                continue
+            # 元素之间：逗号/空白分隔，其他字符视为无法解析的元素
+            if ch in '{[,]':
+                if self._junk:
+                    events.append(self._error(''.join(self._junk), "不是JSON对象"))
+                    self._junk = []
+                if ch in '{[':
+                    self._buf, self._depth = [ch], 1
+                elif ch == ']':
+                    self._state = 'done'
+            elif not ch.isspace() or self._junk:
+                self._junk.append(ch)
+        return events
+
+    def close(self) -> List[tuple]:
+        """输入结束：报告被截断的元素"""
+        events: List[tuple] = []
+        if self._buf:
+            events.append(self._error(''.join(self._buf), "输出在元素中途结束"))
+        junk = ''.join(self._junk).strip().strip('`').strip()
+        if junk:
+            events.append(self._error(junk, "不是JSON对象"))
+        self._buf, self._junk = [], []
+        self._skip = self._resync = False
+        return events
+
+    def _error(self, raw: str, message: str) -> tuple:
+        event = ("error", {"index": self.index, "raw": raw.strip()[:200], "error": message})
+        self.index += 1
+        return event
+
+    def _emit(self, raw: str) -> tuple:
+        try:
+            obj = json.loads(raw)
+        except ValueError as e:
+            repaired = re.sub(r',\s*([}\]])', r'\1', raw)
+            if '"' not in repaired:
+                repaired = repaired.replace("'", '"')
+            try:
+                obj = json.loads(repaired)
+            except ValueError:
+                return self._error(raw, f"JSON解析失败: {e}")
+        if not isinstance(obj, dict):
+            return self._error(raw, "不是JSON对象")
+        self.index += 1
+        return ("item", obj)
+
+def parse_json_array_items(text: str) -> tuple:
+    """一次性解析完整文本，返回 (元素列表, 错误列表)
+
+    字符串内的换行只使所在元素报错，其后的元素照常解析：
+
+    >>> items, errors = parse_json_array_items('[{"id":"1","tags":["a\\n b"]},{"id":"2","category":"y"}]')
+    >>> [item["id"] for item in items], [error["index"] for error in errors]
+    (['2'], [0])
+    """
+    parser = JSONArrayStreamParser()
+    items, errors = [], []
+    for kind, payload in parser.feed(text) + parser.close():
+        (items if kind == "item" else errors).append(payload)
+    return items, errors
+
+def save_bookmark_classifications(parsed: list, fingerprints: Optional[Dict[str, str]] = None) -> int:
+    """将分类结果（及分类时的内容指纹）写回 bookmarks 表，返回更新条数"""
+    fingerprints = fingerprints or {}
+    updated = 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for obj in parsed:
+            try:
+                cid = obj.get('id')
+                category = obj.get('category')
+                tags = obj.get('tags')
+                confidence = obj.get('confidence')
+                if not cid or not category:
+                    continue
+                # 没有标签时保留已有的AI标签
+                tags_str = (','.join(tags) if isinstance(tags, list) else tags) or None
+                cursor.execute('''
+                    UPDATE bookmarks
+                    SET ai_category = ?, ai_tags = COALESCE(?, ai_tags), ai_confidence = ?, ai_fingerprint = ?,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE chrome_id = ?
+                ''', (category, tags_str, float(confidence) if confidence is not None else None, fingerprints.get(cid), cid))
+                if cursor.rowcount > 0:
+                    updated += 1
+            except Exception:
+                continue
+        conn.commit()
+    return updated
+
+async def stream_json_array_items(ai_config, prompt: str, on_event, use_cache: bool = True, bounded: bool = True) -> None:
+    """流式生成并增量解析JSON数组：每完成一个元素即调用 on_event("item", dict)，无法解析的元素调用 on_event("error", {...})。
+
+    命中LLM响应缓存时直接解析缓存文本；否则与相同请求共享上游流，正常结束后写入缓存。
+    """
+    parser = JSONArrayStreamParser()
+    key_parts = llm_cache.make_key(ai_config, prompt, build_generate_payload(ai_config, prompt, stream=True)['options'])
+    cached = llm_cache.get(key_parts[0]) if use_cache else None
+    if not use_cache:
+        llm_cache.counters["bypassed"] += 1
+    if cached is not None:
+        ai_telemetry.record_cache_hit(ai_config, prompt, cached, call_type="stream")
+        for event in parser.feed(cached):
+            on_event(*event)
+    else:
+        def cache_stream_text(chunks: List[dict]):
+            streamed = ''.join(c.get('response', '') for c in chunks)
+            if streamed:
+                llm_cache.put(key_parts, streamed)
+
+        async for chunk in single_flight.stream(
+            key_parts[0], lambda: stream_content_with_ai(ai_config, prompt, bounded=bounded), cache_stream_text
+        ):
+            token = chunk.get('response', '')
+            if token:
+                for event in parser.feed(token):
+                    on_event(*event)
+    for event in parser.close():
+        on_event(*event)
+
+CLASSIFY_STREAM_FLUSH_ITEMS = 5    # 流式解析时每累计多少条分类结果写库一次
+
+async def classify_items_in_batches(ai_config, items: list, use_cache: bool = True, on_batch=None) -> Dict[str, Any]:
+    """分批并发分类，边生成边解析，只重试未得到结果的书签，按原顺序合并结果。
+
+    各批次以流式方式通过路由器提交（bounded=True），并发度受每个后端的信号量限制，随可用后端数量扩展。
+    每解析出 CLASSIFY_STREAM_FLUSH_ITEMS 条有效结果就调用一次 on_batch(index, total, parsed)，
+    无法解析或不属于本批次的元素逐条记录在 malformed_items 中。
+    """
+    batches = chunk_classify_items(items)
+    results: List[list] = [[] for _ in batches]
+    errors: Dict[int, str] = {}
+    malformed: List[dict] = []
+
+    async def run_batch(index: int, batch: list, attempt: int) -> list:
+        """运行一个批次，返回仍未得到分类结果的书签"""
+        ids = {str(it['chrome_id']) for it in batch}
+        seen: set = set()
+        pending: list = []
+
+        def flush():
+            if pending:
+                parsed = list(pending)
+                pending.clear()
+                results[index].extend(parsed)
+                if on_batch:
+                    on_batch(index, len(batches), parsed)
+
+        def on_event(kind: str, payload: dict):
+            if kind == "error":
+                malformed.append({"batch": index, "attempt": attempt, **payload})
+                return
+            cid = str(payload.get('id'))
+            if cid not in ids or cid in seen or not payload.get('category'):
+                malformed.append({
+                    "batch": index,
+                    "attempt": attempt,
+                    "raw": json.dumps(payload, ensure_ascii=False)[:200],
+                    "error": "id不属于本批次、重复或缺少category",
+                })
+                return
+            seen.add(cid)
+            pending.append(payload)
+            if len(pending) >= CLASSIFY_STREAM_FLUSH_ITEMS:
+                flush()
 
-        # 获取活跃AI配置
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM ai_configs WHERE is_active = 1 LIMIT 1")
-            ai_config = cursor.fetchone()
-            if not ai_config:
-                raise HTTPException(status_code=400, detail='没有可用的AI配置')
+        try:
+            # 重试时跳过缓存，避免重复拿到同一份无法解析的输出
+            await stream_json_array_items(
+                ai_config, build_bookmark_classify_prompt(batch), on_event, use_cache=use_cache and attempt == 0
+            )
+            if not seen:
+                raise ValueError("模型输出中没有可解析的分类结果")
+            errors.pop(index, None)
+        except Exception as e:
+            errors[index] = str(e)
+        finally:
+            flush()
+        return [it for it in batch if str(it['chrome_id']) not in seen]
+
+    pending_batches = {i: batch for i, batch in enumerate(batches)}
+    for attempt in range(CLASSIFY_BATCH_RETRIES + 1):
+        indexes = list(pending_batches)
+        remaining = await asyncio.gather(*(run_batch(i, pending_batches[i], attempt) for i in indexes))
+        pending_batches = {i: missing for i, missing in zip(indexes, remaining) if missing}
+        if not pending_batches:
+            break
+        logger.warning(
+            f"书签分类有 {sum(len(m) for m in pending_batches.values())} 条未得到结果，"
+            f"涉及 {len(pending_batches)}/{len(batches)} 个批次（第 {attempt + 1} 轮）"
+        )
 
-        prompt = build_bookmark_classify_prompt(items)
-        ai_result = await generate_content_with_ai(ai_config, prompt)
+    if batches and not any(results):
+        raise Exception(f"所有分类批次均失败: {next(iter(errors.values()), '没有可解析的分类结果')}")
+    return {
+        "results": [obj for batch_result in results for obj in batch_result],
+        "batches": len(batches),
+        "failed_batches": [
+            {"batch": i, "items": len(missing), "error": errors.get(i) or "模型未返回这些书签的分类"}
+            for i, missing in pending_batches.items()
+        ],
+        "malformed_items": malformed,
+    }
+
+def queued_sse_response(meta: dict, run, label: str) -> StreamingResponse:
+    """以SSE推送后台协程的进度：start、run 通过 emit(event, data) 推送的中间事件、done（run 的返回值）或 error"""
+    queue: asyncio.Queue = asyncio.Queue()
 
-        # 尝试解析JSON
-        parsed = None
+    async def runner():
         try:
-            parsed = json.loads(ai_result)
-        except Exception:
-            # 尝试提取JSON片段
-            try:
-                start = ai_result.find('[')
-                end = ai_result.rfind(']')
-                if start != -1 and end != -1 and end > start:
-                    parsed = json.loads(ai_result[start:end+1])
-            except Exception:
-                parsed = []
+            result = await run(lambda event, data: queue.put_nowait((event, data)))
+            queue.put_nowait(("done", result))
+        except Exception as e:
+            logger.error(f"{label}失败: {e}")
+            queue.put_nowait(("error", {"message": str(e)}))
+
+    async def event_stream():
+        yield format_sse("start", meta)
+        task = asyncio.create_task(runner())
+        try:
+            while True:
+                event, data = await queue.get()
+                yield format_sse(event, data)
+                if event in ("done", "error"):
+                    break
+        finally:
+            if not task.done():
+                task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def classification_sse_response(meta: dict, run) -> StreamingResponse:
+    """以SSE推送分批分类进度：start、每批完成时的 batch（含该批结果）、done（汇总）或 error"""
+    return queued_sse_response(meta, run, "流式分类")
+
+def bookmark_fingerprint(item) -> str:
+    """书签内容指纹：标题 + 规范化URL"""
+    return bookmark_content_fingerprint(item['title'], item['url'])
+
+def bookmark_content_fingerprint(title: Optional[str], url: Optional[str]) -> str:
+    text = f"{(title or '').strip()}\n{normalize_bookmark_url(url)}"
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def bookmark_classify_item(row) -> dict:
+    return {
+        "chrome_id": row["chrome_id"],
+        "title": row["title"],
+        "url": row["url"],
+        "ai_category": row["ai_category"],
+        "ai_tags": row["ai_tags"],
+        "ai_confidence": row["ai_confidence"],
+        "ai_fingerprint": row["ai_fingerprint"],
+    }
+
+def is_bookmark_classification_current(item: dict) -> bool:
+    """已有AI分类且标题/URL自分类后未变化（无指纹的历史分类视为未变化）"""
+    if not item.get('ai_category'):
+        return False
+    return not item.get('ai_fingerprint') or item['ai_fingerprint'] == bookmark_fingerprint(item)
+
+def load_unclassified_bookmarks(limit: int) -> list:
+    """待AI分类的书签：尚未分类，或标题/URL在上次分类后发生变化
+
+    指纹比较在 SQL 中完成，凑满 limit 条即停止扫描，不再把全部已分类书签读入内存。
+    """
+    with get_db_connection() as conn:
+        conn.create_function("bookmark_fingerprint", 2, bookmark_content_fingerprint, deterministic=True)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT chrome_id, title, url, ai_category, ai_tags, ai_confidence, ai_fingerprint
+            FROM bookmarks
+            WHERE is_deleted = 0 AND type='bookmark'
+              AND (ai_category IS NULL OR ai_category = ''
+                   OR (ai_fingerprint IS NOT NULL AND ai_fingerprint != bookmark_fingerprint(title, url)))
+            ORDER BY date_modified DESC NULLS LAST, date_added DESC NULLS LAST
+            LIMIT ?
+        ''', (max(0, int(limit)),))
+        return [bookmark_classify_item(r) for r in cursor.fetchall()]
+
+def load_url_classifications(url_keys: list) -> Dict[str, dict]:
+    """按规范化URL读取已缓存的分类"""
+    cached: Dict[str, dict] = {}
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for i in range(0, len(url_keys), 500):
+            chunk = url_keys[i:i + 500]
+            cursor.execute(f'''
+                SELECT url_key, category, tags, confidence
+                FROM bookmark_url_classifications
+                WHERE url_key IN ({','.join(['?'] * len(chunk))})
+            ''', chunk)
+            for r in cursor.fetchall():
+                cached[r["url_key"]] = {
+                    "category": r["category"],
+                    "tags": [t for t in (r["tags"] or '').split(',') if t],
+                    "confidence": r["confidence"],
+                }
+    return cached
+
+def save_url_classifications(entries: Dict[str, dict]) -> None:
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for url_key, obj in entries.items():
+            tags = obj.get('tags')
+            cursor.execute('''
+                INSERT INTO bookmark_url_classifications (url_key, category, tags, confidence, updated_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(url_key) DO UPDATE SET
+                    category = excluded.category, tags = excluded.tags,
+                    confidence = excluded.confidence, updated_at = CURRENT_TIMESTAMP
+            ''', (url_key, obj['category'], ','.join(tags) if isinstance(tags, list) else (tags or ''), obj.get('confidence')))
+        conn.commit()
+
+async def classify_bookmarks_incrementally(
+    ai_config, items: list, use_cache: bool = True, on_batch=None, use_classifier: bool = True
+) -> Dict[str, Any]:
+    """增量分类：复用未变化书签的已有分类与按URL缓存的分类，再由本地预分类器处理高置信度项，
+    其余才发送给模型，且同一链接只发送一次。
+
+    结果（含复用部分）都会连同内容指纹写回 bookmarks.ai_*；
+    on_batch(index, total, parsed) 在每批完成后调用，index 为 None 表示复用/缓存命中的结果。
+    use_cache=False 时全部重新分类；use_classifier=False 时不使用本地预分类器。
+    """
+    fingerprints = {it['chrome_id']: bookmark_fingerprint(it) for it in items}
+    url_keys = {it['chrome_id']: normalize_bookmark_url(it['url']) or f"id:{it['chrome_id']}" for it in items}
+    results: Dict[str, dict] = {}
+    reused: list = []
+    pending: list = []
+    for it in items:
+        if use_cache and is_bookmark_classification_current(it):
+            reused.append({
+                "id": it['chrome_id'],
+                "category": it['ai_category'],
+                "tags": [t for t in (it.get('ai_tags') or '').split(',') if t],
+                "confidence": it.get('ai_confidence'),
+            })
+        else:
+            pending.append(it)
+
+    # 同一规范化URL只保留一个代表项发送给模型
+    groups: Dict[str, list] = OrderedDict()
+    for it in pending:
+        groups.setdefault(url_keys[it['chrome_id']], []).append(it)
+    cached_by_url = load_url_classifications(list(groups.keys())) if use_cache else {}
+    cached = list(reused)
+    representatives: list = []
+    predicted_count = 0
+    for key, group in groups.items():
+        if key in cached_by_url:
+            cached.extend({"id": member['chrome_id'], **cached_by_url[key]} for member in group)
+            continue
+        predicted = category_classifier.predict(group[0]['title'], group[0]['url']) if use_classifier else None
+        if predicted:
+            predicted_count += len(group)
+            # 预分类器不产生标签：保留书签已有的AI标签，没有时取标题关键词
+            cached.extend({
+                "id": member['chrome_id'], "category": predicted['category'],
+                "tags": [t for t in (member.get('ai_tags') or '').split(',') if t] or title_tags(member['title']),
+                "confidence": predicted['confidence']
+            } for member in group)
+        else:
+            representatives.append(group[0])
+    total = len(chunk_classify_items(representatives))
+    state = {"classified": 0}
+
+    def record(index, parsed: list):
+        state["classified"] += save_bookmark_classifications(parsed, fingerprints)
+        for obj in parsed:
+            results[obj['id']] = obj
+        if on_batch:
+            on_batch(index, total, parsed)
+
+    if cached:
+        record(None, cached)
+
+    def on_llm_batch(index: int, batches: int, parsed: list):
+        save_url_classifications({url_keys[str(obj['id'])]: obj for obj in parsed})
+        record(index, [
+            {**obj, "id": member['chrome_id']} for obj in parsed for member in groups[url_keys[str(obj['id'])]]
+        ])
+
+    outcome = await classify_items_in_batches(ai_config, representatives, use_cache=use_cache, on_batch=on_llm_batch)
+    return {
+        "results": [results[it['chrome_id']] for it in items if it['chrome_id'] in results],
+        "classified": state["classified"],
+        "reused": len(cached) - predicted_count,
+        "predicted": predicted_count,
+        "sent": len(representatives),
+        "batches": outcome["batches"],
+        "failed_batches": outcome["failed_batches"],
+        "malformed_items": outcome["malformed_items"],
+    }
+
+async def classify_unclassified_bookmarks(
+    ai_config,
+    items: list,
+    use_cache: bool = True,
+    source: str = "ai-classify",
+    job_id: Optional[int] = None,
+    emit=None,
+    use_classifier: bool = True
+) -> Dict[str, Any]:
+    """分批AI分类并在每批完成后立即写回书签"""
+    base_event = {"source": source, **({"job_id": job_id} if job_id else {})}
+    state = {"classified": 0}
+
+    def on_batch(index: Optional[int], total: int, parsed: list):
+        state["classified"] += len(parsed)
+        event_bus.publish("classification", {
+            **base_event, "status": "progress", "batch": index, "batches": total, "classified": state["classified"]
+        })
+        if emit:
+            emit("batch", {"batch": index, "batches": total, "items": parsed})
+
+    event_bus.publish("classification", {**base_event, "status": "started", "items": len(items)})
+    try:
+        outcome = await classify_bookmarks_incrementally(
+            ai_config, items, use_cache=use_cache, on_batch=on_batch, use_classifier=use_classifier
+        )
+    except Exception as e:
+        event_bus.publish("classification", {**base_event, "status": "failed", "error": str(e)})
+        raise
+    result = {
+        "classified": outcome["classified"],
+        "reused": outcome["reused"],
+        "predicted": outcome["predicted"],
+        "sent": outcome["sent"],
+        "batches": outcome["batches"],
+        "failed_batches": outcome["failed_batches"],
+        "malformed_items": outcome["malformed_items"],
+    }
+    event_bus.publish("classification", {**base_event, "status": "completed", **result})
+    return result
+
+@app.post('/api/bookmarks/ai-classify', response_model=ApiResponse)
+async def ai_classify_bookmarks(limit: int = 100, no_cache: bool = False, no_classifier: bool = False, background: bool = False):
+    try:
+        if background:
+            job_id = job_queue.enqueue(
+                "bookmark_classify", {"limit": limit, "no_cache": no_cache, "no_classifier": no_classifier}
+            )
+            return ApiResponse(success=True, message='分类任务已加入队列', data={"job_id": job_id})
+        # 读取待分类书签
+        items = load_unclassified_bookmarks(limit)
+        if not items:
+            return ApiResponse(success=True, message='暂无待分类书签', data={"classified": 0})
 
-        if not isinstance(parsed, list):
-            parsed = []
+        # 获取活跃AI配置
+        ai_config = get_active_ai_config()
 
-        updated = 0
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            for obj in parsed:
-                try:
-                    cid = obj.get('id')
-                    category = obj.get('category')
-                    tags = obj.get('tags')
-                    confidence = obj.get('confidence')
-                    if not cid or not category:
-                        continue
-                    tags_str = ','.join(tags) if isinstance(tags, list) else (tags or '')
-                    cursor.execute('''
-                        UPDATE bookmarks
-                        SET ai_category = ?, ai_tags = ?, ai_confidence = ?, updated_at = CURRENT_TIMESTAMP
-                        WHERE chrome_id = ?
-                    ''', (category, tags_str, float(confidence) if confidence is not None else None, cid))
-                    if cursor.rowcount > 0:
-                        updated += 1
-                except Exception:
-                    continue
-            conn.commit()
+        result = await classify_unclassified_bookmarks(
+            ai_config, items, use_cache=not no_cache, use_classifier=not no_classifier
+        )
+        return ApiResponse(success=True, message='AI分类完成', data=result)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f'AI分类失败: {e}')
+        raise HTTPException(status_code=500, detail='AI分类失败')
 
-        return ApiResponse(success=True, message='AI分类完成', data={"classified": updated})
+@app.post('/api/bookmarks/ai-classify/stream')
+async def ai_classify_bookmarks_stream(limit: int = 100, no_cache: bool = False, no_classifier: bool = False):
+    """流式AI分类：以SSE推送每个批次的分类结果（每批完成即写回书签）"""
+    try:
+        items = load_unclassified_bookmarks(limit)
+        if not items:
+            return ApiResponse(success=True, message='暂无待分类书签', data={"classified": 0})
+        ai_config = get_active_ai_config()
     except HTTPException as he:
         raise he
     except Exception as e:
         logger.error(f'AI分类失败: {e}')
         raise HTTPException(status_code=500, detail='AI分类失败')
 
+    async def run(emit):
+        return await classify_unclassified_bookmarks(
+            ai_config, items, use_cache=not no_cache, emit=emit, use_classifier=not no_classifier
+        )
+
+    return classification_sse_response({"items": len(items)}, run)
+
 # 书签分类会话：开始/读取/更新草稿/提交
+def load_classify_session_items(body: BookmarkClassifyStartRequest) -> list:
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        where = ["is_deleted = 0", "type='bookmark'"]
+        params: list = []
+        if body.scope == 'unclassified':
+            where.append("(category IS NULL OR category='')")
+        where_clause = "WHERE " + " AND ".join(where)
+        limit_sql = " LIMIT ?" if body.limit else ""
+        if body.limit:
+            params.append(body.limit)
+        cursor.execute(f"SELECT chrome_id, title, url, ai_category, ai_tags, ai_confidence, ai_fingerprint FROM bookmarks {where_clause} ORDER BY date_modified DESC NULLS LAST, date_added DESC NULLS LAST{limit_sql}", params)
+        rows = cursor.fetchall()
+        return [bookmark_classify_item(r) for r in rows]
+
+def save_classify_session(ai_config, scope: Optional[str], ai_result: str) -> int:
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO bookmark_classify_sessions (status, config_name, scope, original_json, draft_json)
+            VALUES ('completed', ?, ?, ?, ?)
+        ''', (ai_config['name'] if 'name' in ai_config.keys() else None, scope or 'all', ai_result, ai_result))
+        sid = cursor.lastrowid
+        conn.commit()
+        return sid
+
+async def create_classify_session(
+    ai_config,
+    body: BookmarkClassifyStartRequest,
+    items: list,
+    job_id: Optional[int] = None,
+    emit=None
+) -> Dict[str, Any]:
+    """增量分批分类后将合并结果保存为分类会话草稿（未变化的书签直接复用已有AI分类）"""
+    base_event = {"source": "session", **({"job_id": job_id} if job_id else {})}
+
+    def on_batch(index: Optional[int], total: int, parsed: list):
+        event_bus.publish("classification", {**base_event, "status": "progress", "batch": index, "batches": total})
+        if emit:
+            emit("batch", {"batch": index, "batches": total, "items": parsed})
+
+    event_bus.publish("classification", {**base_event, "status": "started", "items": len(items)})
+    try:
+        outcome = await classify_bookmarks_incrementally(
+            ai_config, items, use_cache=not body.no_cache, on_batch=on_batch, use_classifier=not body.no_classifier
+        )
+        ai_result = json.dumps(outcome["results"], ensure_ascii=False)
+        sid = save_classify_session(ai_config, body.scope, ai_result)
+    except Exception as e:
+        event_bus.publish("classification", {**base_event, "status": "failed", "error": str(e)})
+        raise
+    event_bus.publish("classification", {**base_event, "status": "completed", "session_id": sid})
+    return {
+        "session_id": sid,
+        "original": ai_result,
+        "reused": outcome["reused"],
+        "predicted": outcome["predicted"],
+        "sent": outcome["sent"],
+        "batches": outcome["batches"],
+        "failed_batches": outcome["failed_batches"],
+        "malformed_items": outcome["malformed_items"],
+    }
+
 @app.post('/api/bookmarks/classify/start', response_model=ApiResponse)
-async def bookmarks_classify_start(body: BookmarkClassifyStartRequest):
+async def bookmarks_classify_start(body: BookmarkClassifyStartRequest, background: bool = False):
     try:
+        if background:
+            job_id = job_queue.enqueue("bookmark_classify_session", body.model_dump())
+            return ApiResponse(success=True, message='分类会话任务已加入队列', data={"job_id": job_id})
         # 读取参与分类的书签
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            where = ["is_deleted = 0", "type='bookmark'"]
-            params: list = []
-            if body.scope == 'unclassified':
-                where.append("(category IS NULL OR category='')")
-            where_clause = "WHERE " + " AND ".join(where)
-            limit_sql = " LIMIT ?" if body.limit else ""
-            if body.limit:
-                params.append(body.limit)
-            cursor.execute(f"SELECT chrome_id, title, url FROM bookmarks {where_clause} ORDER BY date_modified DESC NULLS LAST, date_added DESC NULLS LAST{limit_sql}", params)
-            rows = cursor.fetchall()
-            items = [{"chrome_id": r["chrome_id"], "title": r["title"], "url": r["url"]} for r in rows]
+        items = load_classify_session_items(body)
 
         # 获取AI配置
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            if body.config_name:
-                cursor.execute("SELECT * FROM ai_configs WHERE name=?", (body.config_name,))
-            else:
-                cursor.execute("SELECT * FROM ai_configs WHERE is_active = 1 LIMIT 1")
-            ai_config = cursor.fetchone()
-            if not ai_config:
-                raise HTTPException(status_code=400, detail='没有可用的AI配置')
+        ai_config = get_active_ai_config(body.config_name)
 
-        prompt = build_bookmark_classify_prompt(items)
-        ai_result = await generate_content_with_ai(ai_config, prompt)
+        result = await create_classify_session(ai_config, body, items)
+        return ApiResponse(success=True, message='分类会话创建成功', data=result)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f'启动分类会话失败: {e}')
+        raise HTTPException(status_code=500, detail='启动分类会话失败')
 
-        # 存为会话
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO bookmark_classify_sessions (status, config_name, scope, original_json, draft_json)
-                VALUES ('completed', ?, ?, ?, ?)
-            ''', (ai_config['name'] if 'name' in ai_config.keys() else None, body.scope or 'all', ai_result, ai_result))
-            sid = cursor.lastrowid
-            conn.commit()
-        return ApiResponse(success=True, message='分类会话创建成功', data={"session_id": sid, "original": ai_result})
+@app.post('/api/bookmarks/classify/start/stream')
+async def bookmarks_classify_start_stream(body: BookmarkClassifyStartRequest):
+    """流式创建分类会话：以SSE推送每个批次的分类结果，全部完成后保存为会话"""
+    try:
+        items = load_classify_session_items(body)
+        ai_config = get_active_ai_config(body.config_name)
     except HTTPException as he:
         raise he
     except Exception as e:
         logger.error(f'启动分类会话失败: {e}')
         raise HTTPException(status_code=500, detail='启动分类会话失败')
 
+    async def run(emit):
+        result = await create_classify_session(ai_config, body, items, emit=emit)
+        result.pop("original", None)
+        return result
+
+    return classification_sse_response({"items": len(items)}, run)
+
 @app.get('/api/bookmarks/classify/{session_id}', response_model=ApiResponse)
 async def bookmarks_classify_get(session_id: int):
     try:
@@ -1065,23 +4574,8 @@ async def bookmarks_classify_commit(session_id: int):
             if not row:
                 raise HTTPException(status_code=404, detail='会话不存在')
             draft = row['draft_json'] or '[]'
-        # 解析草稿树并写回书签（仅更新叶子节点，按 id 匹配）
-        def parse_json(text: str):
-            try:
-                obj = json.loads(text)
-                return obj if isinstance(obj, list) else []
-            except Exception:
-                s = text.find('[')
-                e = text.rfind(']')
-                if s != -1 and e != -1 and e > s:
-                    try:
-                        obj = json.loads(text[s:e+1])
-                        return obj if isinstance(obj, list) else []
-                    except Exception:
-                        return []
-                return []
-
-        data = parse_json(draft)
+        # 解析草稿树并写回书签（仅更新叶子节点，按 id 匹配）；无法解析的节点逐条报告，不影响其他节点
+        data, malformed = parse_json_array_items(draft)
 
         def iter_leaves(nodes):
             if not isinstance(nodes, list):
@@ -1112,10 +4606,13 @@ async def bookmarks_classify_commit(session_id: int):
                 ''', (category, tags_str, cid))
                 if cursor.rowcount > 0:
                     affected += 1
+                    cursor.execute('SELECT title, url FROM bookmarks WHERE chrome_id = ?', (cid,))
+                    r = cursor.fetchone()
+                    category_classifier.learn(cursor, [(f"bookmark:{cid}", r['title'], r['url'], category)])
             # 更新会话状态
             cursor.execute('UPDATE bookmark_classify_sessions SET status = \"committed\", updated_at = CURRENT_TIMESTAMP WHERE id = ?', (session_id,))
             conn.commit()
-        return ApiResponse(success=True, message='分类结果已入库', data={"affected": affected})
+        return ApiResponse(success=True, message='分类结果已入库', data={"affected": affected, "malformed_items": malformed})
     except HTTPException as he:
         raise he
     except Exception as e:
@@ -1129,6 +4626,18 @@ async def bookmarks_manage(req: BookmarkManageRequest):
             raise HTTPException(status_code=400, detail='未选择书签')
         with get_db_connection() as conn:
             cursor = conn.cursor()
+            if req.action in ('accept_ai', 'categorize'):
+                # 人工确认的分类作为预分类器的训练样本
+                cursor.execute(f'''
+                    SELECT chrome_id, title, url, ai_category FROM bookmarks
+                    WHERE type = 'bookmark' AND chrome_id IN ({','.join(['?']*len(req.chrome_ids))})
+                ''', req.chrome_ids)
+                samples = [
+                    (f"bookmark:{r['chrome_id']}", r['title'], r['url'],
+                     r['ai_category'] if req.action == 'accept_ai' else req.value)
+                    for r in cursor.fetchall()
+                ]
+                category_classifier.learn(cursor, samples)
             if req.action == 'accept_ai':
                 # 将 ai_* 覆盖到人工字段
                 cursor.execute(f'''
@@ -1168,7 +4677,10 @@ async def bookmarks_manage(req: BookmarkManageRequest):
             else:
                 raise HTTPException(status_code=400, detail='不支持的操作或缺少参数')
             conn.commit()
-            return ApiResponse(success=True, message='操作成功', data={"affected": cursor.rowcount})
+            affected = cursor.rowcount
+        if req.action in ('accept_ai', 'categorize', 'delete'):
+            refresh_user_profile_safely()
+        return ApiResponse(success=True, message='操作成功', data={"affected": affected})
     except HTTPException as he:
         raise he
     except Exception as e:
@@ -1185,14 +4697,19 @@ async def sync_single_item(item: HistoryItem):
             
             if is_new:
                 update_sync_stats(cursor, 1)
-            
+
             conn.commit()
-            
-            return ApiResponse(
-                success=True,
-                message="单条记录同步成功" if is_new else "记录已存在，已更新",
-                data={"is_new": is_new, "url": item.url}
-            )
+
+        if is_new:
+            refresh_history_derivatives()
+            event_bus.publish("ingest", {"source": "history", "new_items": 1, "updated_items": 0})
+            await publish_stats_event()
+
+        return ApiResponse(
+            success=True,
+            message="单条记录同步成功" if is_new else "记录已存在，已更新",
+            data={"is_new": is_new, "url": item.url}
+        )
     except Exception as e:
         logger.error(f"同步单条记录失败: {e}")
         raise HTTPException(status_code=500, detail=f"同步失败: {str(e)}")
@@ -1223,25 +4740,38 @@ async def sync_batch_items(batch: HistoryBatch):
             # 更新统计信息
             if new_items_count > 0:
                 update_sync_stats(cursor, new_items_count)
-            
+
             conn.commit()
-            
-            return ApiResponse(
-                success=True,
-                message=f"批量同步完成: 新增 {new_items_count} 条，更新 {updated_items_count} 条",
-                data={
-                    "total_processed": len(batch.items),
-                    "new_items": new_items_count,
-                    "updated_items": updated_items_count
-                }
-            )
+
+        if new_items_count > 0:
+            refresh_history_derivatives()
+            await publish_stats_event()
+        event_bus.publish("ingest", {
+            "source": "history",
+            "new_items": new_items_count,
+            "updated_items": updated_items_count
+        })
+
+        return ApiResponse(
+            success=True,
+            message=f"批量同步完成: 新增 {new_items_count} 条，更新 {updated_items_count} 条",
+            data={
+                "total_processed": len(batch.items),
+                "new_items": new_items_count,
+                "updated_items": updated_items_count
+            }
+        )
     except Exception as e:
         logger.error(f"批量同步失败: {e}")
         raise HTTPException(status_code=500, detail=f"批量同步失败: {str(e)}")
 
 @app.get("/api/stats", response_model=ApiResponse)
-async def get_stats():
-    """获取同步统计信息"""
+async def get_stats(request: Request):
+    """获取同步统计信息（支持 ETag 条件请求）"""
+    return await cached_json_response(request, "stats", ["browser_history", "sync_stats"], build_stats)
+
+async def build_stats() -> ApiResponse:
+    """计算同步统计信息"""
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
@@ -1338,8 +4868,19 @@ async def get_history(limit: int = 100, offset: int = 0, search: Optional[str] =
         raise HTTPException(status_code=500, detail=f"获取历史记录失败: {str(e)}")
 
 @app.get("/api/analytics/daily-visits")
-async def get_daily_visits():
-    """获取每日访问统计"""
+async def get_daily_visits(request: Request):
+    """获取每日访问统计（支持 ETag 条件请求）"""
+    # 统计窗口按自然日对齐，同一天内只随数据版本变化
+    since = datetime.datetime.combine(datetime.date.today() - datetime.timedelta(days=6), datetime.time.min)
+    return await cached_json_response(
+        request,
+        f"daily-visits:{since.date().isoformat()}",
+        ["browser_history"],
+        lambda: build_daily_visits(since)
+    )
+
+async def build_daily_visits(since: datetime.datetime) -> ApiResponse:
+    """计算自 since 起（含今天共7天）的每日访问统计"""
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
@@ -1353,7 +4894,7 @@ async def get_daily_visits():
                 GROUP BY DATE(visit_time/1000, 'unixepoch', 'localtime')
                 ORDER BY date
                 LIMIT 7
-            ''', (int((datetime.datetime.now() - datetime.timedelta(days=7)).timestamp() * 1000),))
+            ''', (int(since.timestamp() * 1000),))
             
             result = cursor.fetchall()
             daily_visits = [{"date": row['date'], "visits": row['visits']} for row in result]
@@ -1368,8 +4909,12 @@ async def get_daily_visits():
         raise HTTPException(status_code=500, detail=f"获取每日访问统计失败: {str(e)}")
 
 @app.get("/api/analytics/top-sites")
-async def get_top_sites(limit: int = 10):
-    """获取热门网站统计"""
+async def get_top_sites(request: Request, limit: int = 10):
+    """获取热门网站统计（支持 ETag 条件请求）"""
+    return await cached_json_response(request, f"top-sites:{limit}", ["browser_history"], lambda: build_top_sites(limit))
+
+async def build_top_sites(limit: int = 10) -> ApiResponse:
+    """计算热门网站统计"""
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
@@ -1410,6 +4955,359 @@ async def get_top_sites(limit: int = 10):
         logger.error(f"获取热门网站统计失败: {e}")
         raise HTTPException(status_code=500, detail=f"获取热门网站统计失败: {str(e)}")
 
+@app.get("/api/analytics/sessions", response_model=ApiResponse)
+async def get_browsing_sessions(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    start: Optional[int] = None,
+    end: Optional[int] = None
+):
+    """获取浏览会话列表（按开始时间倒序，游标分页：cursor = "<start_time>:<id>"）"""
+    try:
+        limit = max(1, min(limit, 500))
+        where = []
+        params: list = []
+        if cursor:
+            try:
+                cursor_time, cursor_id = (int(x) for x in cursor.split(':', 1))
+            except ValueError:
+                raise HTTPException(status_code=400, detail="无效的分页游标")
+            where.append("(start_time < ? OR (start_time = ? AND id < ?))")
+            params.extend([cursor_time, cursor_time, cursor_id])
+        if start is not None:
+            where.append("end_time >= ?")
+            params.append(start)
+        if end is not None:
+            where.append("start_time <= ?")
+            params.append(end)
+        where_clause = ("WHERE " + " AND ".join(where)) if where else ""
+
+        with get_db_connection() as conn:
+            db_cursor = conn.cursor()
+            db_cursor.execute(f'''
+                SELECT id, start_time, end_time, duration_ms, visit_count, top_domains
+                FROM browsing_sessions
+                {where_clause}
+                ORDER BY start_time DESC, id DESC
+                LIMIT ?
+            ''', params + [limit])
+            rows = db_cursor.fetchall()
+
+        sessions = [{
+            "id": r['id'],
+            "start_time": r['start_time'],
+            "end_time": r['end_time'],
+            "duration_ms": r['duration_ms'],
+            "visit_count": r['visit_count'],
+            "top_domains": json.loads(r['top_domains'] or '[]'),
+        } for r in rows]
+        next_cursor = f"{rows[-1]['start_time']}:{rows[-1]['id']}" if len(rows) == limit else None
+
+        return ApiResponse(
+            success=True,
+            message=f"获取到 {len(sessions)} 个浏览会话",
+            data={"sessions": sessions, "limit": limit, "next_cursor": next_cursor}
+        )
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"获取浏览会话失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取浏览会话失败: {str(e)}")
+
+@app.post("/api/analytics/sessions/rebuild", response_model=ApiResponse)
+async def rebuild_browsing_sessions():
+    """清空并全量重建浏览会话（用于去重/删除历史后校正）"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM browsing_sessions')
+            set_analytics_state(cursor, 'sessions_last_history_id', 0)
+            processed = refresh_browsing_sessions(cursor)
+            conn.commit()
+            cursor.execute('SELECT COUNT(1) FROM browsing_sessions')
+            total_sessions = cursor.fetchone()[0] or 0
+        return ApiResponse(
+            success=True,
+            message="浏览会话重建完成",
+            data={"processed_visits": processed, "sessions": total_sessions}
+        )
+    except Exception as e:
+        logger.error(f"重建浏览会话失败: {e}")
+        raise HTTPException(status_code=500, detail=f"重建浏览会话失败: {str(e)}")
+
+@app.get("/api/analytics/keywords", response_model=ApiResponse)
+async def get_keywords(start: Optional[int] = None, end: Optional[int] = None, limit: int = KEYWORD_TIER_SIZE * 3):
+    """获取时间范围内的 TF-IDF 关键词及高/中/低频分档"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            keywords = compute_keywords(cursor, start, end, max(1, min(limit, 300)))
+        return ApiResponse(
+            success=True,
+            message=f"获取到 {len(keywords)} 个关键词",
+            data=build_keyword_tiers(keywords)
+        )
+    except Exception as e:
+        logger.error(f"获取关键词失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取关键词失败: {str(e)}")
+
+@app.get("/api/profile", response_model=ApiResponse)
+async def get_profile():
+    """获取物化的用户画像"""
+    try:
+        profile = await get_user_profile_data()
+        return ApiResponse(success=True, message="获取用户画像成功", data=profile)
+    except Exception as e:
+        logger.error(f"获取用户画像失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取用户画像失败: {str(e)}")
+
+@app.post("/api/profile/refresh", response_model=ApiResponse)
+async def refresh_profile():
+    """强制重新计算用户画像"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            refresh_profile_rollups(cursor)
+            profile = refresh_user_profile(cursor, force=True)
+            conn.commit()
+        return ApiResponse(success=True, message="用户画像已刷新", data=profile)
+    except Exception as e:
+        logger.error(f"刷新用户画像失败: {e}")
+        raise HTTPException(status_code=500, detail=f"刷新用户画像失败: {str(e)}")
+
+# 数据导出（Parquet / Arrow IPC）
+EXPORT_BATCH_ROWS = 65536  # 每个 row group / record batch 的行数
+
+# 每个数据集: sql 模板、列定义 {列名: (SQL表达式, 类型)}、时间过滤列
+EXPORT_DATASETS: Dict[str, Dict[str, Any]] = {
+    "browser_history": {
+        "sql": "SELECT {columns} FROM browser_history {where} ORDER BY id",
+        "time_column": "visit_time",
+        "columns": {
+            "id": ("id", "int"),
+            "url": ("url", "str"),
+            "title": ("title", "str"),
+            "visit_time": ("visit_time", "int"),
+            "visit_count": ("visit_count", "int"),
+            "first_visit_time": ("first_visit_time", "int"),
+            "last_visit_time": ("last_visit_time", "int"),
+            "is_hidden": ("is_hidden", "bool"),
+            "is_invalid": ("is_invalid", "bool"),
+            "category": ("category", "str"),
+            "tags": ("tags", "str"),
+        },
+    },
+    "bookmarks": {
+        "sql": "SELECT {columns} FROM bookmarks {where} ORDER BY id",
+        "time_column": "date_added",
+        "columns": {
+            "id": ("id", "int"),
+            "chrome_id": ("chrome_id", "str"),
+            "parent_id": ("parent_id", "str"),
+            "title": ("title", "str"),
+            "url": ("url", "str"),
+            "type": ("type", "str"),
+            "date_added": ("date_added", "int"),
+            "date_modified": ("date_modified", "int"),
+            "is_deleted": ("is_deleted", "bool"),
+            "category": ("category", "str"),
+            "tags": ("tags", "str"),
+            "ai_category": ("ai_category", "str"),
+            "ai_tags": ("ai_tags", "str"),
+            "ai_confidence": ("ai_confidence", "float"),
+        },
+    },
+    "browsing_sessions": {
+        "sql": "SELECT {columns} FROM browsing_sessions {where} ORDER BY start_time, id",
+        "time_column": "start_time",
+        "columns": {
+            "id": ("id", "int"),
+            "start_time": ("start_time", "int"),
+            "end_time": ("end_time", "int"),
+            "duration_ms": ("duration_ms", "int"),
+            "visit_count": ("visit_count", "int"),
+            "top_domains": ("top_domains", "str"),
+        },
+    },
+    "domain_rollup": {
+        "sql": "SELECT {columns} FROM history_domain_rollup {where} ORDER BY visits DESC",
+        "time_column": "last_visit_time",
+        "columns": {
+            "domain": ("domain", "str"),
+            "visits": ("visits", "int"),
+            "last_visit_time": ("last_visit_time", "int"),
+        },
+    },
+    "time_rollup": {
+        "sql": "SELECT {columns} FROM history_time_rollup {where} ORDER BY weekday, hour",
+        "time_column": None,
+        "columns": {
+            "weekday": ("weekday", "int"),
+            "hour": ("hour", "int"),
+            "visits": ("visits", "int"),
+        },
+    },
+    "daily_visits": {
+        "sql": "SELECT {columns} FROM browser_history {where} GROUP BY date ORDER BY date",
+        "time_column": "visit_time",
+        "columns": {
+            "date": ("DATE(visit_time/1000, 'unixepoch', 'localtime')", "str"),
+            "visits": ("COUNT(*)", "int"),
+            "total_visits": ("SUM(visit_count)", "int"),
+            "unique_urls": ("COUNT(DISTINCT url)", "int"),
+        },
+    },
+}
+
+EXPORT_FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+class _ExportSink:
+    """pyarrow 写入目标：缓存已写出的字节，由调用方按 row group 取走，保证内存恒定"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        chunk = bytes(data)
+        self._chunks.append(chunk)
+        self._position += len(chunk)
+        return len(chunk)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self) -> bool:
+        return True
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def resolve_export_columns(dataset: str, columns: Optional[str]) -> List[str]:
+    """校验数据集与投影列，返回导出列名列表"""
+    spec = EXPORT_DATASETS.get(dataset)
+    if not spec:
+        raise HTTPException(status_code=404, detail=f"不支持的导出数据集: {dataset}")
+    if not columns:
+        return list(spec["columns"].keys())
+    selected = [c.strip() for c in columns.split(',') if c.strip()]
+    unknown = [c for c in selected if c not in spec["columns"]]
+    if unknown or not selected:
+        raise HTTPException(status_code=400, detail=f"未知的导出列: {', '.join(unknown) or columns}")
+    return selected
+
+def iter_export_chunks(
+    dataset: str,
+    fmt: str = "parquet",
+    columns: Optional[List[str]] = None,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    batch_rows: int = EXPORT_BATCH_ROWS
+):
+    """按 row group 分块读取数据集并编码为 Parquet / Arrow IPC 字节流"""
+    if pa is None:
+        raise HTTPException(status_code=501, detail="数据导出需要安装 pyarrow")
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的导出格式: {fmt}")
+
+    spec = EXPORT_DATASETS[dataset]
+    columns = columns or list(spec["columns"].keys())
+    type_map = {"int": pa.int64(), "str": pa.string(), "float": pa.float64(), "bool": pa.bool_()}
+    schema = pa.schema([(c, type_map[spec["columns"][c][1]]) for c in columns])
+
+    where = []
+    params: list = []
+    if start is not None and spec['time_column']:
+        where.append(f"{spec['time_column']} >= ?")
+        params.append(start)
+    if end is not None and spec['time_column']:
+        where.append(f"{spec['time_column']} < ?")
+        params.append(end)
+    # GROUP BY 的数据集需要保证分组列被选中
+    select_columns = list(columns)
+    if "GROUP BY date" in spec["sql"] and "date" not in select_columns:
+        select_columns.insert(0, "date")
+    query = spec["sql"].format(
+        columns=", ".join(f"{spec['columns'][c][0]} AS {c}" for c in select_columns),
+        where=("WHERE " + " AND ".join(where)) if where else ""
+    )
+    offsets = [select_columns.index(c) for c in columns]
+
+    sink = _ExportSink()
+    writer = None
+    try:
+        with get_db_connection() as conn:
+            reader = conn.cursor()
+            reader.row_factory = None  # 元组行，避免 sqlite3.Row 的额外开销
+            reader.execute(query, params)
+            if fmt == "parquet":
+                writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema, compression="zstd")
+            else:
+                writer = pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), schema)
+            while True:
+                rows = reader.fetchmany(batch_rows)
+                if not rows:
+                    break
+                values = list(zip(*rows))
+                arrays = []
+                for name, i in zip(columns, offsets):
+                    field_type = schema.field(name).type
+                    if field_type == pa.bool_():
+                        # SQLite 以 0/1 存储布尔值，先按整数读取再转换
+                        arrays.append(pa.array(values[i], type=pa.int64()).cast(pa.bool_()))
+                    else:
+                        arrays.append(pa.array(values[i], type=field_type))
+                batch = pa.record_batch(arrays, schema=schema)
+                if fmt == "parquet":
+                    writer.write_batch(batch, row_group_size=batch_rows)
+                else:
+                    writer.write_batch(batch)
+                chunk = sink.drain()
+                if chunk:
+                    yield chunk
+            writer.close()
+            writer = None
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    finally:
+        if writer is not None:
+            writer.close()
+
+@app.get("/api/export/{dataset}")
+async def export_dataset(
+    dataset: str,
+    format: str = "parquet",
+    columns: Optional[str] = None,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    batch_rows: int = EXPORT_BATCH_ROWS
+):
+    """流式导出数据集（历史、书签、会话及各类汇总表，见 EXPORT_DATASETS）"""
+    if pa is None:
+        raise HTTPException(status_code=501, detail="数据导出需要安装 pyarrow")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的导出格式: {format}")
+    selected = resolve_export_columns(dataset, columns)
+    media_type, suffix = EXPORT_FORMATS[format]
+    return StreamingResponse(
+        iter_export_chunks(dataset, format, selected, start, end, max(1024, batch_rows)),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{dataset}.{suffix}"'}
+    )
+
 @app.delete("/api/clear-all")
 async def clear_all_data():
     """清空所有历史记录数据"""
@@ -1419,7 +5317,18 @@ async def clear_all_data():
             
             # 清空历史记录表
             cursor.execute('DELETE FROM browser_history')
-            
+            deleted_records = cursor.rowcount
+
+            # 清空派生的会话、关键词与画像汇总数据并重置水位线
+            for table in ('browsing_sessions', 'keyword_doc_terms', 'keyword_doc_freq',
+                          'history_domain_rollup', 'history_time_rollup', 'user_profile'):
+                cursor.execute(f'DELETE FROM {table}')
+            cursor.execute('''
+                DELETE FROM analytics_state
+                WHERE key IN ('sessions_last_history_id', 'keywords_last_history_id',
+                              'keywords_doc_count', 'rollups_last_history_id')
+            ''')
+
             # 重置同步统计
             cursor.execute('DELETE FROM sync_stats')
             
@@ -1428,7 +5337,7 @@ async def clear_all_data():
             return ApiResponse(
                 success=True,
                 message="所有数据已清空",
-                data={"deleted_records": cursor.rowcount}
+                data={"deleted_records": deleted_records}
             )
     except Exception as e:
         logger.error(f"清空数据失败: {e}")
@@ -1480,6 +5389,8 @@ async def create_ai_config(config: AIConfig):
             ''', (config.name, config.type, config.base_url, config.api_key, 
                   config.model, config.max_tokens, config.temperature, config.is_active))
             conn.commit()
+            if config.is_active and config.type == 'ollama':
+                model_manager.schedule_warm(config.base_url, config.model)
             
             return ApiResponse(
                 success=True,
@@ -1510,6 +5421,8 @@ async def update_ai_config(config_name: str, config: AIConfig):
                 raise HTTPException(status_code=404, detail=f"配置 '{config_name}' 不存在")
             
             conn.commit()
+            if config.is_active and config.type == 'ollama':
+                model_manager.schedule_warm(config.base_url, config.model)
             return ApiResponse(
                 success=True,
                 message=f"AI配置 '{config_name}' 更新成功",
@@ -1544,86 +5457,76 @@ async def delete_ai_config(config_name: str):
 async def test_ollama_connection(request: OllamaTestRequest):
     """测试Ollama连接"""
     try:
-        async with aiohttp.ClientSession() as session:
-            # 测试连接
-            health_url = f"{request.base_url.rstrip('/')}/api/tags"
-            async with session.get(health_url, timeout=aiohttp.ClientTimeout(total=10)) as response:
-                if response.status != 200:
-                    raise HTTPException(status_code=400, detail=f"Ollama服务连接失败: HTTP {response.status}")
-                
-                data = await response.json()
-                models = [model['name'] for model in data.get('models', [])]
-                
-                # 测试具体模型
-                if request.model and request.model in models:
-                    test_url = f"{request.base_url.rstrip('/')}/api/generate"
-                    test_data = {
-                        "model": request.model,
-                        "prompt": "Hello",
-                        "stream": False
-                    }
-                    
-                    async with session.post(test_url, json=test_data, 
-                                          timeout=aiohttp.ClientTimeout(total=30)) as test_response:
-                        if test_response.status == 200:
-                            test_result = await test_response.json()
-                            return ApiResponse(
-                                success=True,
-                                message="Ollama连接测试成功",
-                                data={
-                                    "status": "connected",
-                                    "available_models": models,
-                                    "tested_model": request.model,
-                                    "test_response": test_result.get('response', '')[:100] + "..."
-                                }
-                            )
-                
-                return ApiResponse(
-                    success=True,
-                    message="Ollama服务连接成功",
-                    data={
-                        "status": "connected",
-                        "available_models": models,
-                        "note": f"模型 '{request.model}' 未找到" if request.model else "未测试具体模型"
-                    }
-                )
-                
+        # 测试连接
+        try:
+            models = await probe_ollama_tags(request.base_url)
+        except AIBackendError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        # 模型存在即可，无需额外生成；顺便在后台预加载，后续首个请求不再等待模型加载
+        if request.model and (request.model in models or f"{request.model}:latest" in models):
+            model_manager.schedule_warm(request.base_url, request.model)
+            return ApiResponse(
+                success=True,
+                message="Ollama连接测试成功",
+                data={
+                    "status": "connected",
+                    "available_models": models,
+                    "tested_model": request.model,
+                    "warmup": "scheduled"
+                }
+            )
+        
+        return ApiResponse(
+            success=True,
+            message="Ollama服务连接成功",
+            data={
+                "status": "connected",
+                "available_models": models,
+                "note": f"模型 '{request.model}' 未找到" if request.model else "未测试具体模型"
+            }
+        )
+            
+    except HTTPException as he:
+        raise he
     except aiohttp.ClientError as e:
         raise HTTPException(status_code=400, detail=f"连接Ollama失败: {str(e)}")
     except Exception as e:
         logger.error(f"测试Ollama连接失败: {e}")
         raise HTTPException(status_code=500, detail=f"测试连接失败: {str(e)}")
 
+def load_test_ai_config(config_name: str) -> dict:
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT name, type, base_url, api_key, model, max_tokens, temperature
+            FROM ai_configs WHERE name=? AND is_active=1
+        ''', (config_name,))
+        config_row = cursor.fetchone()
+        
+        if not config_row:
+            raise HTTPException(status_code=404, detail=f"AI配置 '{config_name}' 不存在或未激活")
+    
+    config = {
+        'name': config_row['name'],
+        'type': config_row['type'],
+        'base_url': config_row['base_url'],
+        'api_key': config_row['api_key'],
+        'model': config_row['model'],
+        'max_tokens': config_row['max_tokens'],
+        'temperature': config_row['temperature']
+    }
+    if config['type'] != 'ollama':
+        raise HTTPException(status_code=400, detail=f"暂不支持 '{config['type']}' 类型的AI服务")
+    return config
+
 @app.post("/api/ai/test")
 async def test_ai_model(request: AITestRequest):
     """测试AI模型"""
     try:
         # 获取配置
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT type, base_url, api_key, model, max_tokens, temperature
-                FROM ai_configs WHERE name=? AND is_active=1
-            ''', (request.config_name,))
-            config_row = cursor.fetchone()
-            
-            if not config_row:
-                raise HTTPException(status_code=404, detail=f"AI配置 '{request.config_name}' 不存在或未激活")
-        
-        config = {
-            'type': config_row['type'],
-            'base_url': config_row['base_url'],
-            'api_key': config_row['api_key'],
-            'model': config_row['model'],
-            'max_tokens': config_row['max_tokens'],
-            'temperature': config_row['temperature']
-        }
-        
-        # 根据类型测试不同的AI服务
-        if config['type'] == 'ollama':
-            response_text = await test_ollama_model(config, request.prompt)
-        else:
-            raise HTTPException(status_code=400, detail=f"暂不支持 '{config['type']}' 类型的AI服务")
+        config = load_test_ai_config(request.config_name)
+        response_text = await test_ollama_model(config, request.prompt, use_cache=not request.no_cache)
         
         return ApiResponse(
             success=True,
@@ -1636,46 +5539,197 @@ async def test_ai_model(request: AITestRequest):
             }
         )
         
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"测试AI模型失败: {e}")
+        raise HTTPException(status_code=500, detail=f"测试AI模型失败: {str(e)}")
+
+@app.post("/api/ai/test/stream")
+async def test_ai_model_stream(request: AITestRequest):
+    """流式测试AI模型：以SSE逐段推送模型输出"""
+    try:
+        config = load_test_ai_config(request.config_name)
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"测试AI模型失败: {e}")
+        raise HTTPException(status_code=500, detail=f"测试AI模型失败: {str(e)}")
+
+    config['max_tokens'] = config['max_tokens'] or 512
+    meta = {"config_name": request.config_name, "model": config['model']}
+    return generation_sse_response(config, request.prompt, meta, use_cache=not request.no_cache)
+
+async def test_ollama_model(config: dict, prompt: str, use_cache: bool = True) -> str:
+    """测试Ollama模型"""
+    try:
+        session = ai_clients.session(config['base_url'])
+        url = f"{config['base_url'].rstrip('/')}/api/generate"
+        data = {
+            "model": config['model'],
+            "prompt": prompt,
+            "stream": False,
+            "options": {
+                "num_predict": config.get('max_tokens', 512),
+                "temperature": config.get('temperature', 0.7)
+            }
+        }
+        
+        key_parts = llm_cache.make_key(config, prompt, data['options'])
+        if use_cache:
+            cached = llm_cache.get(key_parts[0])
+            if cached is not None:
+                ai_telemetry.record_cache_hit(config, prompt, cached)
+                return cached
+        else:
+            llm_cache.counters["bypassed"] += 1
+        
+        async def request_model() -> str:
+            started = time.perf_counter()
+            try:
+                async with session.post(url, json=data, 
+                                      timeout=ai_clients.timeout(total=60)) as response:
+                    response_text = await response.text()
+                    if response.status != 200:
+                        raise Exception(f"Ollama API请求失败: HTTP {response.status} - {response_text}")
+                    result = await response.json()
+            except Exception as e:
+                ai_telemetry.record(config['model'], "generate", "error", (time.perf_counter() - started) * 1000,
+                                    backend=config['base_url'], prompt=prompt, error=e)
+                raise
+            
+            ai_telemetry.record(config['model'], "generate", "success", (time.perf_counter() - started) * 1000,
+                                backend=config['base_url'], prompt=prompt,
+                                response_text=result.get('response', ''), result=result)
+            if result.get('response'):
+                llm_cache.put(key_parts, result['response'])
+            return result.get('response', '无响应内容')
+        
+        return await single_flight.do(key_parts[0], request_model)
+            
+    except aiohttp.ClientError as e:
+        logger.error(f"Ollama客户端错误: {e}")
+        raise Exception(f"无法连接到Ollama服务: {str(e)}")
+    except Exception as e:
+        logger.error(f"Ollama测试失败: {e}")
+        raise Exception(str(e))
+
+@app.get("/api/ai/pool-stats")
+async def get_ai_pool_stats():
+    """获取AI后端连接池统计（请求数、连接复用、当前活跃/空闲连接）"""
+    try:
+        return ApiResponse(
+            success=True,
+            message="获取连接池统计成功",
+            data=ai_clients.metrics()
+        )
+    except Exception as e:
+        logger.error(f"获取连接池统计失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取连接池统计失败: {str(e)}")
+
+@app.get("/api/ai/backends")
+async def get_ai_backends():
+    """获取AI后端路由状态（健康状况、熔断状态、在途请求、延迟EWMA、对冲阈值、失败次数）与重试/对冲统计"""
+    try:
+        return ApiResponse(
+            success=True,
+            message="获取AI后端状态成功",
+            data={
+                "backends": ai_router.metrics(),
+                "resilience": ai_router.counters,
+                "health_check_seconds": AI_HEALTH_CHECK_SECONDS,
+                "breaker_failure_threshold": AI_BREAKER_FAILURE_THRESHOLD,
+                "breaker_cooldown_seconds": AI_BREAKER_COOLDOWN_SECONDS,
+                "retry_attempts": AI_RETRY_ATTEMPTS,
+                "interactive_deadline_seconds": AI_INTERACTIVE_DEADLINE_SECONDS,
+                "hedge_percentile": AI_HEDGE_PERCENTILE,
+            }
+        )
+    except Exception as e:
+        logger.error(f"获取AI后端状态失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取AI后端状态失败: {str(e)}")
+
+@app.get("/api/ai/metrics")
+async def get_ai_metrics(minutes: Optional[int] = None):
+    """LLM调用统计：按模型、接口、后端汇总的 p50/p95/p99 延迟、tokens/秒、缓存命中与失败次数（minutes 限定最近时间范围）"""
+    try:
+        since = time.time() - minutes * 60 if minutes else None
+        return ApiResponse(
+            success=True,
+            message="获取LLM调用统计成功",
+            data={**ai_telemetry.metrics(since), "minutes": minutes, "max_rows": AI_TELEMETRY_MAX_ROWS}
+        )
+    except Exception as e:
+        logger.error(f"获取LLM调用统计失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取LLM调用统计失败: {str(e)}")
+
+@app.get("/api/ai/models")
+async def get_ai_model_status():
+    """获取模型加载状态：预加载情况、冷启动次数，以及加载耗时与推理耗时的区分统计"""
+    try:
+        return ApiResponse(
+            success=True,
+            message="获取模型状态成功",
+            data={
+                "models": model_manager.metrics(),
+                "keep_alive": AI_KEEP_ALIVE,
+                "refresh_seconds": AI_KEEP_ALIVE_REFRESH_SECONDS,
+                "cold_start_ms": AI_COLD_START_MS,
+            }
+        )
+    except Exception as e:
+        logger.error(f"获取模型状态失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取模型状态失败: {str(e)}")
+
+@app.post("/api/ai/backends/check")
+async def check_ai_backends():
+    """立即对所有激活的Ollama后端执行一次健康检查"""
+    try:
+        await ai_router.check_all()
+        return ApiResponse(
+            success=True,
+            message="AI后端健康检查完成",
+            data={"backends": ai_router.metrics()}
+        )
+    except Exception as e:
+        logger.error(f"AI后端健康检查失败: {e}")
+        raise HTTPException(status_code=500, detail=f"AI后端健康检查失败: {str(e)}")
+
+@app.get("/api/ai/cache/stats")
+async def get_llm_cache_stats():
+    """获取LLM响应缓存统计（命中/未命中、容量与淘汰情况）及并发请求合并计数"""
+    try:
+        return ApiResponse(
+            success=True,
+            message="获取LLM缓存统计成功",
+            data={**llm_cache.stats(), "single_flight": single_flight.metrics()}
+        )
+    except Exception as e:
+        logger.error(f"获取LLM缓存统计失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取LLM缓存统计失败: {str(e)}")
+
+@app.get("/api/ai/classifier")
+async def get_classifier_stats():
+    """获取本地预分类器的训练样本统计"""
+    try:
+        return ApiResponse(success=True, message="获取预分类器统计成功", data=category_classifier.stats())
     except Exception as e:
-        logger.error(f"测试AI模型失败: {e}")
-        raise HTTPException(status_code=500, detail=f"测试AI模型失败: {str(e)}")
+        logger.error(f"获取预分类器统计失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取预分类器统计失败: {str(e)}")
 
-async def test_ollama_model(config: dict, prompt: str) -> str:
-    """测试Ollama模型"""
+@app.delete("/api/ai/cache")
+async def clear_llm_cache():
+    """清空LLM响应缓存（内存与持久层）"""
     try:
-        async with aiohttp.ClientSession() as session:
-            url = f"{config['base_url'].rstrip('/')}/api/generate"
-            data = {
-                "model": config['model'],
-                "prompt": prompt,
-                "stream": False,
-                "options": {
-                    "num_predict": config.get('max_tokens', 512),
-                    "temperature": config.get('temperature', 0.7)
-                }
-            }
-            
-            logger.info(f"发送Ollama请求到: {url}")
-            logger.info(f"请求数据: {data}")
-            
-            async with session.post(url, json=data, 
-                                  timeout=aiohttp.ClientTimeout(total=60)) as response:
-                response_text = await response.text()
-                logger.info(f"Ollama响应状态: {response.status}")
-                logger.info(f"Ollama响应内容: {response_text[:200]}...")
-                
-                if response.status != 200:
-                    raise Exception(f"Ollama API请求失败: HTTP {response.status} - {response_text}")
-                
-                result = await response.json()
-                return result.get('response', '无响应内容')
-                
-    except aiohttp.ClientError as e:
-        logger.error(f"Ollama客户端错误: {e}")
-        raise Exception(f"无法连接到Ollama服务: {str(e)}")
+        deleted = llm_cache.clear()
+        return ApiResponse(
+            success=True,
+            message="LLM缓存已清空",
+            data={"deleted_entries": deleted}
+        )
     except Exception as e:
-        logger.error(f"Ollama测试失败: {e}")
-        raise Exception(str(e))
+        logger.error(f"清空LLM缓存失败: {e}")
+        raise HTTPException(status_code=500, detail=f"清空LLM缓存失败: {str(e)}")
 
 # Agent模板管理API
 @app.get("/api/ai/agents")
@@ -1735,6 +5789,176 @@ async def create_agent_template(template: AgentTemplate):
         logger.error(f"创建Agent模板失败: {e}")
         raise HTTPException(status_code=500, detail=f"创建Agent模板失败: {str(e)}")
 
+# Agent模板执行：模板编译一次后按内容签名缓存，逐条目渲染提示词并在各后端并发上限内扇出
+AGENT_TEMPLATE_FIELDS = {"input", "title", "url", "domain", "category", "tags", "visit_count", "last_visit_time"}
+AGENT_RUN_MAX_ITEMS = 200   # 单次执行的条目上限
+
+class CompiledAgentTemplate:
+    """预解析的Agent模板：系统提示词前缀 + 用户模板的字面量/占位符片段，渲染时只做拼接"""
+
+    def __init__(self, name: str, system_prompt: str, user_prompt_template: str, ai_config: str):
+        self.name = name
+        self.ai_config = ai_config
+        self.prefix = f"{system_prompt.strip()}\n\n" if system_prompt.strip() else ""
+        self.parts: List[Tuple[str, Optional[str]]] = []
+        for literal, field, _spec, _conversion in string.Formatter().parse(user_prompt_template):
+            if field is not None and field not in AGENT_TEMPLATE_FIELDS:
+                raise ValueError(f"模板占位符 {{{field}}} 不受支持，可用: {', '.join(sorted(AGENT_TEMPLATE_FIELDS))}")
+            self.parts.append((literal, field))
+        # 没有任何占位符的模板默认把条目内容追加在末尾，否则每个条目的提示词都相同
+        if not any(field for _, field in self.parts):
+            self.parts.append(("\n\n", "input"))
+
+    def render(self, item: dict) -> str:
+        return self.prefix + "".join(
+            literal + ("" if field is None else str(item.get(field) if item.get(field) is not None else ""))
+            for literal, field in self.parts
+        )
+
+_compiled_agent_templates: Dict[str, Tuple[str, CompiledAgentTemplate]] = {}
+
+def get_compiled_agent_template(name: str) -> CompiledAgentTemplate:
+    """读取模板并返回编译结果；模板内容未变化时直接复用缓存"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT name, system_prompt, user_prompt_template, ai_config, is_active
+            FROM agent_templates WHERE name = ?
+        ''', (name,))
+        row = cursor.fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail=f"Agent模板 '{name}' 不存在")
+    if not row['is_active']:
+        raise HTTPException(status_code=400, detail=f"Agent模板 '{name}' 未启用")
+    signature = hashlib.sha1(
+        "\x00".join([row['system_prompt'], row['user_prompt_template'], row['ai_config']]).encode('utf-8')
+    ).hexdigest()
+    cached = _compiled_agent_templates.get(name)
+    if cached and cached[0] == signature:
+        return cached[1]
+    try:
+        compiled = CompiledAgentTemplate(name, row['system_prompt'], row['user_prompt_template'], row['ai_config'])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    _compiled_agent_templates[name] = (signature, compiled)
+    return compiled
+
+def load_agent_items(source: str, ids: Optional[List[str]], limit: Optional[int]) -> List[dict]:
+    """按来源读取Agent执行条目（保持 ids 的顺序），统一为模板可用的字段"""
+    limit = max(1, min(limit or 20, AGENT_RUN_MAX_ITEMS))
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if source == 'history':
+            if ids:
+                cursor.execute(f'''
+                    SELECT id, url, title, visit_count, last_visit_time, category, tags
+                    FROM browser_history WHERE id IN ({','.join(['?'] * len(ids))})
+                ''', ids)
+            else:
+                cursor.execute('''
+                    SELECT id, url, title, visit_count, last_visit_time, category, tags
+                    FROM browser_history
+                    WHERE is_hidden = 0 OR is_hidden IS NULL
+                    ORDER BY last_visit_time DESC
+                    LIMIT ?
+                ''', (limit,))
+            rows = [dict(row) for row in cursor.fetchall()]
+        elif source == 'bookmarks':
+            if ids:
+                cursor.execute(f'''
+                    SELECT chrome_id AS id, url, title, category, tags, ai_category, ai_tags
+                    FROM bookmarks WHERE chrome_id IN ({','.join(['?'] * len(ids))})
+                ''', ids)
+            else:
+                cursor.execute('''
+                    SELECT chrome_id AS id, url, title, category, tags, ai_category, ai_tags
+                    FROM bookmarks
+                    WHERE type = 'bookmark' AND is_deleted = 0
+                    ORDER BY date_added DESC
+                    LIMIT ?
+                ''', (limit,))
+            rows = []
+            for row in cursor.fetchall():
+                # 未人工分类的书签使用AI分类
+                item = dict(row)
+                item["category"] = item["category"] or item.pop("ai_category")
+                item["tags"] = item["tags"] or item.pop("ai_tags")
+                item.pop("ai_category", None)
+                item.pop("ai_tags", None)
+                rows.append(item)
+        else:
+            raise HTTPException(status_code=400, detail=f"不支持的数据来源: {source}")
+
+    if ids:
+        order = {str(i): n for n, i in enumerate(ids)}
+        rows.sort(key=lambda r: order.get(str(r['id']), len(order)))
+        rows = rows[:AGENT_RUN_MAX_ITEMS]
+    for item in rows:
+        item["id"] = str(item["id"])
+        item["domain"] = extract_domain(item.get("url"))
+        item["input"] = "\n".join(
+            f"{label}: {item[key]}" for key, label in (("title", "标题"), ("url", "链接"), ("category", "分类"), ("tags", "标签"))
+            if item.get(key)
+        )
+    return rows
+
+async def run_agent_template(template: CompiledAgentTemplate, ai_config: dict, items: List[dict],
+                             use_cache: bool, emit) -> dict:
+    """逐条目渲染提示词并并发生成；每条完成即通过 emit('item', ...) 推送，单条失败不影响其余条目"""
+    started = time.perf_counter()
+    state = {"succeeded": 0, "failed": 0}
+
+    async def run_item(index: int, item: dict):
+        item_started = time.perf_counter()
+        result = {"index": index, "id": item["id"], "title": item.get("title"), "url": item.get("url")}
+        try:
+            # bounded=True：并发度受所选后端的信号量限制，随可用后端数量扩展
+            content = await generate_content_with_ai(ai_config, template.render(item), use_cache=use_cache, bounded=True)
+            result.update(status="success", content=content)
+            state["succeeded"] += 1
+        except Exception as e:
+            result.update(status="failed", error=str(e))
+            state["failed"] += 1
+        result["duration_ms"] = int((time.perf_counter() - item_started) * 1000)
+        emit("item", result)
+
+    await asyncio.gather(*(run_item(i, item) for i, item in enumerate(items)))
+    return {
+        "template": template.name,
+        "total": len(items),
+        "succeeded": state["succeeded"],
+        "failed": state["failed"],
+        "duration_ms": int((time.perf_counter() - started) * 1000),
+    }
+
+@app.post("/api/ai/agents/{name}/run")
+async def run_agent(name: str, request: AgentRunRequest):
+    """对选中的历史记录/书签批量执行Agent模板，以SSE逐条推送结果（start、item、done 或 error）"""
+    try:
+        template = get_compiled_agent_template(name)
+        # 使用模板绑定的AI配置
+        ai_config = load_test_ai_config(template.ai_config)
+        items = load_agent_items(request.source, request.ids, request.limit)
+        if not items:
+            raise HTTPException(status_code=404, detail="没有可执行的条目")
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"执行Agent模板失败: {e}")
+        raise HTTPException(status_code=500, detail=f"执行Agent模板失败: {str(e)}")
+
+    async def run(emit):
+        return await run_agent_template(template, ai_config, items, not request.no_cache, emit)
+
+    meta = {
+        "template": name,
+        "ai_config": template.ai_config,
+        "model": ai_config['model'],
+        "source": request.source,
+        "total": len(items),
+    }
+    return queued_sse_response(meta, run, f"执行Agent模板 '{name}'")
+
 # 链接管理API
 @app.post("/api/links/manage")
 async def manage_links(request: LinkManagementRequest):
@@ -1768,6 +5992,13 @@ async def manage_links(request: LinkManagementRequest):
                     WHERE id IN ({','.join(['?'] * len(request.url_ids))})
                 ''', request.url_ids)
             elif request.action == "categorize" and request.value:
+                cursor.execute(f'''
+                    SELECT id, title, url FROM browser_history
+                    WHERE id IN ({','.join(['?'] * len(request.url_ids))})
+                ''', request.url_ids)
+                category_classifier.learn(
+                    cursor, [(f"history:{r['id']}", r['title'], r['url'], request.value) for r in cursor.fetchall()]
+                )
                 cursor.execute(f'''
                     UPDATE browser_history 
                     SET category = ?, updated_at = CURRENT_TIMESTAMP 
@@ -1783,11 +6014,13 @@ async def manage_links(request: LinkManagementRequest):
                 raise HTTPException(status_code=400, detail="无效的操作类型")
             
             conn.commit()
-            return ApiResponse(
-                success=True,
-                message=f"成功{request.action}了{len(request.url_ids)}条链接",
-                data={"affected_count": len(request.url_ids)}
-            )
+        if request.action == "categorize":
+            refresh_user_profile_safely()
+        return ApiResponse(
+            success=True,
+            message=f"成功{request.action}了{len(request.url_ids)}条链接",
+            data={"affected_count": len(request.url_ids)}
+        )
     except Exception as e:
         logger.error(f"链接管理失败: {e}")
         raise HTTPException(status_code=500, detail=f"链接管理失败: {str(e)}")
@@ -1810,13 +6043,18 @@ async def deduplicate_links():
             ''')
             
             removed_count = cursor.rowcount
+            if removed_count:
+                rebuild_profile_rollups(cursor)
+                prune_keyword_index(cursor)
             conn.commit()
-            
-            return ApiResponse(
-                success=True,
-                message=f"成功去重，删除了{removed_count}条重复记录",
-                data={"removed_count": removed_count}
-            )
+        if removed_count:
+            refresh_user_profile_safely()
+
+        return ApiResponse(
+            success=True,
+            message=f"成功去重，删除了{removed_count}条重复记录",
+            data={"removed_count": removed_count}
+        )
     except Exception as e:
         logger.error(f"去重失败: {e}")
         raise HTTPException(status_code=500, detail=f"去重失败: {str(e)}")
@@ -1866,7 +6104,7 @@ async def get_enhanced_links(
             
             query = f'''
                 SELECT id, url, title, visit_time, visit_count, first_visit_time, 
-                       last_visit_time, is_hidden, is_invalid, category, tags
+                       last_visit_time, is_hidden, is_invalid, category, predicted_category, tags
                 FROM browser_history
                 {where_clause}
                 ORDER BY {sort_by} {sort_order}
@@ -1894,6 +6132,7 @@ async def get_enhanced_links(
                     "isHidden": bool(record['is_hidden']),
                     "isInvalid": bool(record['is_invalid']),
                     "category": record['category'] or "未分类",
+                    "predictedCategory": record['predicted_category'],
                     "tags": record['tags'] or ""
                 })
             
@@ -1914,6 +6153,301 @@ async def get_enhanced_links(
         logger.error(f"获取增强链接列表失败: {e}")
         raise HTTPException(status_code=500, detail=f"获取链接列表失败: {str(e)}")
 
+# 网页正文抓取：批量创作前下载来源网页并提取正文，结果缓存在 page_content_cache；
+# 并发由连接池控制（总数 + 每个域名），过期后以 If-None-Match/If-Modified-Since 复验，未变化时不重新下载
+PAGE_FETCH_CONCURRENCY = int(os.getenv("PAGE_FETCH_CONCURRENCY", "16"))
+PAGE_FETCH_PER_HOST = int(os.getenv("PAGE_FETCH_PER_HOST", "2"))
+PAGE_FETCH_TIMEOUT = float(os.getenv("PAGE_FETCH_TIMEOUT", "15"))
+PAGE_FETCH_MAX_BYTES = int(os.getenv("PAGE_FETCH_MAX_BYTES", str(2 * 1024 * 1024)))   # 单个网页最多下载的字节数
+PAGE_CONTENT_MAX_CHARS = int(os.getenv("PAGE_CONTENT_MAX_CHARS", "20000"))            # 缓存的正文最大字符数
+PAGE_CONTENT_FRESH_SECONDS = int(os.getenv("PAGE_CONTENT_FRESH_SECONDS", "86400"))    # 缓存期内直接使用，不发请求
+PAGE_FETCH_RETRY_SECONDS = 600       # 抓取失败后多久再尝试
+PAGE_CACHE_MAX_ENTRIES = int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "5000"))             # 正文缓存表的条数上限（含失败记录）
+PAGE_CACHE_MAX_BYTES = int(os.getenv("PAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 正文缓存表的总字节数上限
+PAGE_PROMPT_TOKEN_BUDGET = int(os.getenv("PAGE_PROMPT_TOKEN_BUDGET", "1500"))         # 嵌入提示词的正文token预算
+PAGE_FETCH_USER_AGENT = "Mozilla/5.0 (compatible; BrowserHistoryAssistant/1.0)"
+
+class PageFetchError(Exception):
+    """网页无法获取或内容不可用"""
+
+class MainTextExtractor(HTMLParser):
+    """提取网页标题与正文：跳过脚本、样式、导航等区域，存在 article/main 时优先使用其中的文本"""
+
+    SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "iframe", "nav", "header", "footer", "aside", "form", "button", "select"}
+    MAIN_TAGS = {"article", "main"}
+    BLOCK_TAGS = {
+        "p", "div", "section", "li", "ul", "ol", "br", "tr", "td", "pre", "blockquote", "dd", "dt", "figcaption",
+        "h1", "h2", "h3", "h4", "h5", "h6", "table",
+    } | MAIN_TAGS
+    MAIN_MIN_CHARS = 200   # article/main 中文本过少时（如只包了标题）退回使用全文
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title_parts: List[str] = []
+        self.blocks: List[str] = []
+        self.main_blocks: List[str] = []
+        self._current: List[str] = []
+        self._skip = 0
+        self._main = 0
+        self._in_title = False
+
+    def _flush(self):
+        text = re.sub(r'\s+', ' ', ''.join(self._current)).strip()
+        self._current = []
+        if text:
+            self.blocks.append(text)
+            if self._main:
+                self.main_blocks.append(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self._in_title = True
+        elif tag in self.SKIP_TAGS:
+            self._skip += 1
+        if tag in self.BLOCK_TAGS:
+            self._flush()
+        if tag in self.MAIN_TAGS:
+            self._main += 1
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self._in_title = False
+        elif tag in self.SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        if tag in self.BLOCK_TAGS:
+            self._flush()
+        if tag in self.MAIN_TAGS:
+            self._main = max(0, self._main - 1)
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title_parts.append(data)
+        elif not self._skip:
+            self._current.append(data)
+
+    def result(self) -> tuple:
+        """返回 (标题, 正文)，正文按块换行并去掉相邻重复块"""
+        self._flush()
+        blocks = self.main_blocks if sum(len(b) for b in self.main_blocks) >= self.MAIN_MIN_CHARS else self.blocks
+        lines: List[str] = []
+        for block in blocks:
+            if not lines or lines[-1] != block:
+                lines.append(block)
+        return re.sub(r'\s+', ' ', ''.join(self.title_parts)).strip(), "\n".join(lines)
+
+def extract_page_text(html: str) -> tuple:
+    extractor = MainTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.result()
+
+def decode_page_body(raw: bytes, charset: Optional[str]) -> str:
+    """按响应头或 <meta charset> 声明的编码解码，未知编码按 UTF-8 容错解码"""
+    if not charset:
+        match = re.search(rb'charset=["\']?([A-Za-z0-9_\-]+)', raw[:4096])
+        charset = match.group(1).decode('ascii') if match else 'utf-8'
+    try:
+        return raw.decode(charset, errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+def parse_page_body(raw: bytes, charset: Optional[str], content_type: str) -> tuple:
+    """解码响应并提取 (标题, 正文)；HTML 解析耗时较长，由调用方放到线程池执行"""
+    text = decode_page_body(raw, charset)
+    if "html" in content_type or not content_type:
+        return extract_page_text(text)
+    return None, text.strip()
+
+class PageFetcher:
+    """带缓存的网页正文抓取器；同一URL的并发请求只抓取一次"""
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.counters = {
+            "fetched": 0, "revalidated": 0, "cached": 0, "stale": 0, "failed": 0, "bytes": 0, "evictions": 0,
+        }
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=PAGE_FETCH_CONCURRENCY,
+                    limit_per_host=PAGE_FETCH_PER_HOST,
+                    ttl_dns_cache=300
+                ),
+                timeout=aiohttp.ClientTimeout(total=PAGE_FETCH_TIMEOUT),
+                headers={"User-Agent": PAGE_FETCH_USER_AGENT, "Accept": "text/html,application/xhtml+xml,text/plain;q=0.9,*/*;q=0.5"}
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @staticmethod
+    def load(url: str):
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM page_content_cache WHERE url = ?', (url,))
+            return cursor.fetchone()
+
+    def save(self, url: str, fields: Dict[str, Any]):
+        columns = ["url", *fields.keys()]
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                INSERT INTO page_content_cache ({", ".join(columns)})
+                VALUES ({", ".join("?" * len(columns))})
+                ON CONFLICT(url) DO UPDATE SET {", ".join(f"{c} = excluded.{c}" for c in fields)}
+            ''', (url, *fields.values()))
+            self._evict(cursor)
+            conn.commit()
+
+    def _evict(self, cursor):
+        """按最近请求时间淘汰最旧的条目，直到条数与字节数都在上限以内"""
+        size_sql = "LENGTH(CAST(COALESCE(content, '') AS BLOB)) + LENGTH(CAST(COALESCE(title, '') AS BLOB))"
+        cursor.execute(f'SELECT COUNT(*) AS entries, COALESCE(SUM({size_sql}), 0) AS total_bytes FROM page_content_cache')
+        row = cursor.fetchone()
+        entries, total_bytes = row['entries'], row['total_bytes']
+        if entries <= PAGE_CACHE_MAX_ENTRIES and total_bytes <= PAGE_CACHE_MAX_BYTES:
+            return
+        cursor.execute(f'SELECT url, {size_sql} AS size_bytes FROM page_content_cache ORDER BY checked_at ASC')
+        victims = []
+        for victim in cursor.fetchall():
+            if entries <= PAGE_CACHE_MAX_ENTRIES and total_bytes <= PAGE_CACHE_MAX_BYTES:
+                break
+            victims.append((victim['url'],))
+            entries -= 1
+            total_bytes -= victim['size_bytes']
+        cursor.executemany('DELETE FROM page_content_cache WHERE url = ?', victims)
+        self.counters["evictions"] += len(victims)
+
+    @staticmethod
+    def _result(url: str, row, status: str, error: Optional[str] = None) -> Dict[str, Any]:
+        content = row['content'] if row else None
+        return {
+            "url": url,
+            "status": status,          # cached | revalidated | fetched | stale | failed
+            "title": row['title'] if row else None,
+            "content": content,
+            "chars": len(content) if content else 0,
+            "truncated": bool(row['truncated']) if row else False,
+            "fetched_at": row['fetched_at'] if row else None,
+            "error": error if error is not None else (row['error'] if row else None),
+        }
+
+    async def get(self, url: str, force: bool = False) -> Dict[str, Any]:
+        """返回URL的正文缓存结果；过期时条件复验，抓取失败但有旧正文时返回旧正文（status=stale）"""
+        return await single_flight.do(f"page:{url}", lambda: self._get(url, force))
+
+    async def _get(self, url: str, force: bool) -> Dict[str, Any]:
+        row = self.load(url)
+        now = time.time()
+        if row and not force and row['checked_at']:
+            age = now - row['checked_at']
+            if row['content'] and age < PAGE_CONTENT_FRESH_SECONDS:
+                self.counters["cached"] += 1
+                return self._result(url, row, "cached")
+            if not row['content'] and age < PAGE_FETCH_RETRY_SECONDS:
+                self.counters["failed"] += 1
+                return self._result(url, row, "failed")
+
+        headers = {}
+        if row and row['content'] and not force:
+            if row['etag']:
+                headers["If-None-Match"] = row['etag']
+            if row['last_modified']:
+                headers["If-Modified-Since"] = row['last_modified']
+        try:
+            if urlsplit(url).scheme not in ("http", "https"):
+                raise PageFetchError("仅支持 http/https 链接")
+            async with self.session().get(url, headers=headers) as response:
+                if response.status == 304 and headers:
+                    self.save(url, {"checked_at": now, "error": None})
+                    self.counters["revalidated"] += 1
+                    return self._result(url, self.load(url), "revalidated")
+                if response.status != 200:
+                    raise PageFetchError(f"HTTP {response.status}")
+                content_type = response.headers.get("Content-Type", "").lower()
+                if content_type and "html" not in content_type and not content_type.startswith("text/"):
+                    raise PageFetchError(f"不支持的内容类型: {content_type.split(';')[0]}")
+                chunks: List[bytes] = []
+                size = 0
+                truncated = False
+                async for chunk in response.content.iter_chunked(65536):
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size > PAGE_FETCH_MAX_BYTES:
+                        truncated = True
+                        break
+                raw = b"".join(chunks)[:PAGE_FETCH_MAX_BYTES]
+                # 解码与正文提取是纯CPU操作，放到线程中执行，避免大页面阻塞事件循环
+                title, content = await asyncio.to_thread(parse_page_body, raw, response.charset, content_type)
+                if not content:
+                    raise PageFetchError("未提取到正文")
+                if len(content) > PAGE_CONTENT_MAX_CHARS:
+                    content, truncated = content[:PAGE_CONTENT_MAX_CHARS], True
+                self.save(url, {
+                    "final_url": str(response.url),
+                    "http_status": response.status,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "title": title,
+                    "content": content,
+                    "truncated": 1 if truncated else 0,
+                    "fetched_at": now,
+                    "checked_at": now,
+                    "error": None,
+                })
+                self.counters["fetched"] += 1
+                self.counters["bytes"] += len(raw)
+                return self._result(url, self.load(url), "fetched")
+        except (PageFetchError, aiohttp.ClientError, asyncio.TimeoutError, UnicodeError) as e:
+            error = str(e) or e.__class__.__name__
+            logger.warning(f"抓取网页失败 {url}: {error}")
+            self.save(url, {"checked_at": now, "error": error})
+            if row and row['content']:
+                self.counters["stale"] += 1
+                return self._result(url, self.load(url), "stale", error)
+            self.counters["failed"] += 1
+            return self._result(url, None, "failed", error)
+
+page_fetcher = PageFetcher()
+
+def format_page_for_prompt(page: Optional[Dict[str, Any]], budget: Optional[int] = None) -> str:
+    """按token预算截取网页正文用于提示词；没有正文时给出说明"""
+    if not page or not page.get('content'):
+        return "（未能获取网页正文，请基于链接本身与常识进行创作）"
+    budget = budget or PAGE_PROMPT_TOKEN_BUDGET
+    lines = pack_lines(page['content'].split("\n"), budget)
+    if not lines:
+        # 首段即超出预算时按字符截取（CJK约1字符1个token，保守估计）
+        lines = [page['content'][:budget]]
+    text = "\n".join(lines)
+    if page.get('title'):
+        text = f"网页标题: {page['title']}\n{text}"
+    if len(lines) < page['content'].count("\n") + 1 or page.get('truncated'):
+        text += "\n（正文较长，已截取前半部分）"
+    return text
+
+@app.post("/api/content/pages/fetch")
+async def fetch_page_contents(request: PageFetchRequest):
+    """预抓取网页正文到缓存（批量创作会自动抓取），返回每个URL的缓存状态，不含正文"""
+    try:
+        pages = await asyncio.gather(*(page_fetcher.get(url, force=request.force) for url in dict.fromkeys(request.urls)))
+        return ApiResponse(
+            success=True,
+            message=f"已处理 {len(pages)} 个网页",
+            data={
+                "pages": [{k: v for k, v in page.items() if k != "content"} for page in pages],
+                "counters": page_fetcher.counters,
+            }
+        )
+    except Exception as e:
+        logger.error(f"抓取网页正文失败: {e}")
+        raise HTTPException(status_code=500, detail=f"抓取网页正文失败: {str(e)}")
+
 # 批量内容生成API
 @app.post("/api/content/batch-generate")
 async def batch_generate_content(request: BatchContentGenerationRequest):
@@ -1932,21 +6466,43 @@ async def batch_generate_content(request: BatchContentGenerationRequest):
             
             task_id = cursor.lastrowid
             conn.commit()
-            
-            # 异步开始内容生成（这里简化为同步处理）
-            await process_batch_content_generation(task_id, request)
-            
-            return ApiResponse(
-                success=True,
-                message=f"批量内容生成任务已创建",
-                data={"task_id": task_id, "task_name": request.task_name}
-            )
+        
+        # 交给后台任务队列执行，立即返回
+        job_id = job_queue.enqueue("batch_generation", {"task_id": task_id, "request": request.model_dump()})
+        
+        return ApiResponse(
+            success=True,
+            message="批量内容生成任务已创建",
+            data={"task_id": task_id, "task_name": request.task_name, "job_id": job_id}
+        )
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"批量内容生成失败: {e}")
         raise HTTPException(status_code=500, detail=f"批量内容生成失败: {str(e)}")
 
+TASK_PROGRESS_COMMIT_SECONDS = 5  # 任务进度落盘的最小间隔
+
+def load_task_item_results(cursor, task_id: int) -> List[Dict[str, Any]]:
+    """按原始顺序读取批量任务的逐条结果"""
+    cursor.execute('''
+        SELECT url, status, content, error_message
+        FROM content_generation_items
+        WHERE task_id = ?
+        ORDER BY item_index
+    ''', (task_id,))
+    results = []
+    for row in cursor.fetchall():
+        item = {"url": row['url'], "status": row['status']}
+        if row['status'] == 'success':
+            item["content"] = row['content']
+        elif row['error_message']:
+            item["error"] = row['error_message']
+        results.append(item)
+    return results
+
 async def process_batch_content_generation(task_id: int, request: BatchContentGenerationRequest):
-    """处理批量内容生成"""
+    """处理批量内容生成：各URL在各后端并发上限内并行生成，每条完成即落库，失败条目不影响其余结果"""
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
@@ -1957,58 +6513,93 @@ async def process_batch_content_generation(task_id: int, request: BatchContentGe
                 SET status = 'processing', updated_at = CURRENT_TIMESTAMP 
                 WHERE id = ?
             ''', (task_id,))
-            conn.commit()
             
-            results = []
-            total_urls = len(request.source_urls)
+            # 获取活跃的AI配置（同模型的其他激活配置由路由器一并调度）
+            ai_config = get_active_ai_config()
             
-            # 获取活跃的AI配置
-            cursor.execute("SELECT * FROM ai_configs WHERE is_active = 1 LIMIT 1")
-            ai_config = cursor.fetchone()
-            
-            if not ai_config:
-                raise Exception("没有可用的AI配置")
+            # 任务恢复/重试时保留已成功的条目，只重新生成其余条目
+            cursor.executemany('''
+                INSERT OR IGNORE INTO content_generation_items (task_id, item_index, url, status)
+                VALUES (?, ?, ?, 'pending')
+            ''', [(task_id, i, url) for i, url in enumerate(request.source_urls)])
+            cursor.execute('''
+                SELECT item_index FROM content_generation_items WHERE task_id = ? AND status = 'success'
+            ''', (task_id,))
+            completed = {row['item_index'] for row in cursor.fetchall()}
+            conn.commit()
+        
+        total_urls = len(request.source_urls)
+        state = {"done": len(completed), "failed": 0, "last_progress_commit": time.monotonic()}
+        event_bus.publish("tasks", {"task_id": task_id, "status": "processing", "progress": 0})
+        
+        async def generate_item(index: int, url: str):
+            started = time.perf_counter()
+            try:
+                # 先取来源网页正文（缓存命中或304时不重新下载），再构建创作提示词并调用AI生成内容（每个后端的并发数受信号量限制）
+                page = await page_fetcher.get(url)
+                prompt = build_batch_creation_prompt(url, request, page)
+                ai_response = await generate_content_with_ai(
+                    ai_config, prompt, use_cache=not request.no_cache, bounded=True
+                )
+                status, content, error = 'success', ai_response, None
+            except Exception as e:
+                status, content, error = 'failed', None, str(e)
+            duration_ms = int((time.perf_counter() - started) * 1000)
             
-            for i, url in enumerate(request.source_urls):
-                try:
-                    # 构建创作提示词
-                    prompt = build_batch_creation_prompt(url, request)
-                    
-                    # 调用AI生成内容
-                    ai_response = await generate_content_with_ai(ai_config, prompt)
-                    
-                    results.append({
-                        "url": url,
-                        "content": ai_response,
-                        "status": "success"
-                    })
-                    
-                    # 更新进度
-                    progress = int((i + 1) / total_urls * 100)
+            state["done"] += 1
+            if status == 'failed':
+                state["failed"] += 1
+            progress = int(state["done"] / total_urls * 100)
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE content_generation_items
+                    SET status = ?, content = ?, error_message = ?, duration_ms = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE task_id = ? AND item_index = ?
+                ''', (status, content, error, duration_ms, task_id, index))
+                # 任务进度按时间间隔落盘，供轮询兼容；实时进度走事件推送
+                if time.monotonic() - state["last_progress_commit"] >= TASK_PROGRESS_COMMIT_SECONDS:
                     cursor.execute('''
                         UPDATE content_generation_tasks 
                         SET progress = ?, updated_at = CURRENT_TIMESTAMP 
                         WHERE id = ?
                     ''', (progress, task_id))
-                    conn.commit()
-                    
-                except Exception as e:
-                    results.append({
-                        "url": url,
-                        "error": str(e),
-                        "status": "failed"
-                    })
-            
-            # 更新任务完成状态
+                    state["last_progress_commit"] = time.monotonic()
+                conn.commit()
+            
+            event_bus.publish("tasks", {
+                "task_id": task_id,
+                "status": "processing",
+                "progress": progress,
+                "url": url,
+                "item_index": index,
+                "item_status": status
+            })
+        
+        await asyncio.gather(*(
+            generate_item(i, url) for i, url in enumerate(request.source_urls) if i not in completed
+        ))
+        
+        # 更新任务完成状态，同时保留按原始顺序汇总的 results 字段
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            results = load_task_item_results(cursor, task_id)
             cursor.execute('''
                 UPDATE content_generation_tasks 
                 SET status = 'completed', progress = 100, results = ?, updated_at = CURRENT_TIMESTAMP 
                 WHERE id = ?
             ''', (json.dumps(results), task_id))
             conn.commit()
+        event_bus.publish("tasks", {
+            "task_id": task_id,
+            "status": "completed",
+            "progress": 100,
+            "succeeded": total_urls - state["failed"],
+            "failed": state["failed"]
+        })
             
     except Exception as e:
-        # 更新任务失败状态
+        # 更新任务失败状态（已完成的条目保留在 content_generation_items 中）
         with get_db_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -2017,9 +6608,13 @@ async def process_batch_content_generation(task_id: int, request: BatchContentGe
                 WHERE id = ?
             ''', (str(e), task_id))
             conn.commit()
+        event_bus.publish("tasks", {"task_id": task_id, "status": "failed", "error": str(e)})
+        # 交由任务队列决定是否重试
+        raise
 
-def build_batch_creation_prompt(url: str, request: BatchContentGenerationRequest) -> str:
-    """构建批量创作的提示词"""
+def build_batch_creation_prompt(url: str, request: BatchContentGenerationRequest,
+                                page: Optional[Dict[str, Any]] = None) -> str:
+    """构建批量创作的提示词（page 为 page_fetcher 返回的网页正文缓存）"""
     style_map = {
         'marketing': '营销推广文，突出产品优势和价值，包含强烈的行动召唤',
         'review': '产品评测文，客观分析优缺点，提供购买建议',
@@ -2042,6 +6637,9 @@ def build_batch_creation_prompt(url: str, request: BatchContentGenerationRequest
 目标受众: {request.target_audience or '普通网络用户'}
 文章长度: {length_map.get(request.content_length, '中等长度文章')}
 
+=== 网页内容 ===
+{format_page_for_prompt(page)}
+
 === 创作任务 ===
 请基于上述网页内容，创作一篇符合要求的文章。
 
@@ -2053,33 +6651,194 @@ def build_batch_creation_prompt(url: str, request: BatchContentGenerationRequest
 
 请确保内容原创、有价值，并具有较强的可读性。"""
 
-async def generate_content_with_ai(ai_config, prompt: str) -> str:
-    """使用AI生成内容"""
+def build_generate_payload(ai_config, prompt: str, stream: bool) -> dict:
+    """构建 Ollama /api/generate 请求体"""
+    return {
+        "model": ai_config['model'],
+        "prompt": prompt,
+        "stream": stream,
+        "keep_alive": AI_KEEP_ALIVE,
+        "options": {
+            "num_predict": ai_config['max_tokens'] if ai_config['max_tokens'] else 2048,
+            "temperature": ai_config['temperature'] if ai_config['temperature'] else 0.7
+        }
+    }
+
+async def generate_content_with_ai(ai_config, prompt: str, use_cache: bool = True, bounded: bool = False) -> str:
+    """使用AI生成内容（默认先查LLM响应缓存，use_cache=False 时强制重新生成并刷新缓存）
+
+    请求经 ai_router 分发到提供同一模型的任一健康后端；bounded=True 时受所选后端的并发上限约束。
+    """
     try:
-        base_url = ai_config['base_url'].rstrip('/')
+        payload = build_generate_payload(ai_config, prompt, stream=False)
+        key_parts = llm_cache.make_key(ai_config, prompt, payload['options'])
+        if use_cache:
+            cached = llm_cache.get(key_parts[0])
+            if cached is not None:
+                ai_telemetry.record_cache_hit(ai_config, prompt, cached)
+                return cached
+        else:
+            llm_cache.counters["bypassed"] += 1
         
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{base_url}/api/generate",
-                json={
-                    "model": ai_config['model'],
-                    "prompt": prompt,
-                    "stream": False,
-                    "options": {
-                        "num_predict": ai_config['max_tokens'] if ai_config['max_tokens'] else 2048,
-                        "temperature": ai_config['temperature'] if ai_config['temperature'] else 0.7
-                    }
-                }
-            ) as response:
-                if response.status == 200:
+        async def call(config) -> str:
+            base_url = config['base_url'].rstrip('/')
+            session = ai_clients.session(base_url)
+            started = time.perf_counter()
+            try:
+                async with session.post(
+                    f"{base_url}/api/generate",
+                    json=payload,
+                    timeout=ai_clients.timeout()
+                ) as response:
+                    if response.status != 200:
+                        raise AIBackendError(f"AI生成失败: HTTP {response.status}", status=response.status)
                     result = await response.json()
-                    return result.get('response', '')
-                else:
-                    raise Exception(f"AI生成失败: HTTP {response.status}")
+            except asyncio.CancelledError:
+                # 对冲落败或调用方取消
+                ai_telemetry.record(payload['model'], "generate", "cancelled", (time.perf_counter() - started) * 1000,
+                                    backend=base_url, prompt=prompt)
+                raise
+            except Exception as e:
+                ai_telemetry.record(payload['model'], "generate", "error", (time.perf_counter() - started) * 1000,
+                                    backend=base_url, prompt=prompt, error=e)
+                raise
+            model_manager.record(base_url, payload['model'], result)
+            ai_telemetry.record(payload['model'], "generate", "success", (time.perf_counter() - started) * 1000,
+                                backend=base_url, prompt=prompt, response_text=result.get('response', ''), result=result)
+            return result.get('response', '')
+        
+        async def generate() -> str:
+            text = await ai_router.run(ai_config, call, bounded=bounded)
+            if text:
+                llm_cache.put(key_parts, text)
+            return text
+        
+        # 相同请求正在生成时直接共享其结果
+        return await single_flight.do(key_parts[0], generate)
     except Exception as e:
         logger.error(f"AI内容生成失败: {e}")
         raise e
 
+async def stream_content_with_ai(ai_config, prompt: str, bounded: bool = False):
+    """以流式方式调用AI，逐个产出 Ollama 返回的 NDJSON 片段（最后一个片段 done=True）"""
+    payload = build_generate_payload(ai_config, prompt, stream=True)
+
+    async def open_stream(config):
+        base_url = config['base_url'].rstrip('/')
+        session = ai_clients.session(base_url)
+        started = time.perf_counter()
+        parts: List[str] = []
+        outcome, error = "cancelled", None
+        final_chunk: dict = {}
+        try:
+            async with session.post(
+                f"{base_url}/api/generate",
+                json=payload,
+                timeout=ai_clients.timeout()
+            ) as response:
+                if response.status != 200:
+                    detail = await response.text()
+                    raise AIBackendError(f"AI生成失败: HTTP {response.status} - {detail[:200]}", status=response.status)
+                async for line in response.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get('error'):
+                        raise AIBackendError(f"AI生成失败: {chunk['error']}")
+                    parts.append(chunk.get('response', ''))
+                    if chunk.get('done'):
+                        final_chunk = chunk
+                        outcome = "success"
+                        model_manager.record(base_url, payload['model'], chunk)
+                    yield chunk
+                    if chunk.get('done'):
+                        break
+        except Exception as e:
+            outcome, error = "error", e
+            raise
+        finally:
+            # 客户端断开或路由器放弃时生成器被关闭，记为 cancelled
+            ai_telemetry.record(payload['model'], "stream", outcome, (time.perf_counter() - started) * 1000,
+                                backend=base_url, prompt=prompt, response_text=''.join(parts),
+                                result=final_chunk, error=error)
+
+    async for chunk in ai_router.stream(ai_config, open_stream, bounded=bounded):
+        yield chunk
+
+def generation_sse_response(
+    ai_config,
+    prompt: str,
+    meta: Optional[dict] = None,
+    on_complete=None,
+    on_error=None,
+    use_cache: bool = True
+) -> StreamingResponse:
+    """将流式生成结果以SSE推送给客户端
+
+    事件依次为 start（meta）、若干 token（{"text": 片段}）、done（统计信息与 on_complete 的返回值），
+    出错时发送 error。完整文本只在生成结束后交给 on_complete 持久化一次；
+    客户端中途断开时生成器被取消，上游请求随之关闭，模型停止生成，也不会写入半截结果。
+    命中LLM响应缓存时直接以单个 token 事件返回缓存文本。
+    """
+    key_parts = llm_cache.make_key(ai_config, prompt, build_generate_payload(ai_config, prompt, stream=True)['options'])
+
+    async def event_stream():
+        started = time.perf_counter()
+        first_token_ms = None
+        parts: List[str] = []
+        final_chunk: dict = {}
+        yield format_sse("start", meta or {})
+        try:
+            cached = llm_cache.get(key_parts[0]) if use_cache else None
+            if not use_cache:
+                llm_cache.counters["bypassed"] += 1
+            if cached is not None:
+                ai_telemetry.record_cache_hit(ai_config, prompt, cached, call_type="stream")
+                first_token_ms = int((time.perf_counter() - started) * 1000)
+                parts.append(cached)
+                yield format_sse("token", {"text": cached})
+            else:
+                def cache_stream_text(chunks: List[dict]):
+                    streamed = ''.join(c.get('response', '') for c in chunks)
+                    if streamed:
+                        llm_cache.put(key_parts, streamed)
+
+                # 相同请求正在流式生成时订阅同一条流（会先回放已生成的片段）
+                async for chunk in single_flight.stream(
+                    key_parts[0], lambda: stream_content_with_ai(ai_config, prompt), cache_stream_text
+                ):
+                    token = chunk.get('response', '')
+                    if token:
+                        if first_token_ms is None:
+                            first_token_ms = int((time.perf_counter() - started) * 1000)
+                        parts.append(token)
+                        yield format_sse("token", {"text": token})
+                    if chunk.get('done'):
+                        final_chunk = chunk
+            text = ''.join(parts)
+            result = on_complete(text) if on_complete else None
+            yield format_sse("done", {
+                **(result or {}),
+                "cached": cached is not None,
+                "chars": len(text),
+                "ttft_ms": first_token_ms,
+                "total_ms": int((time.perf_counter() - started) * 1000),
+                "eval_count": final_chunk.get('eval_count'),
+                "done_reason": final_chunk.get('done_reason'),
+            })
+        except Exception as e:
+            logger.error(f"AI流式生成失败: {e}")
+            if on_error:
+                on_error(e)
+            yield format_sse("error", {"message": str(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/api/content/tasks")
 async def get_content_tasks():
     """获取内容生成任务列表"""
@@ -2132,7 +6891,10 @@ async def get_task_results(task_id: int):
             if not task:
                 raise HTTPException(status_code=404, detail="任务不存在")
             
-            results = json.loads(task['results']) if task['results'] else []
+            # 优先读取逐条结果（任务进行中也能看到已完成的条目），旧任务回退到 results 字段
+            results = load_task_item_results(cursor, task_id)
+            if not results:
+                results = json.loads(task['results']) if task['results'] else []
             
             return ApiResponse(
                 success=True,
@@ -2247,83 +7009,104 @@ async def get_content_analytics():
         raise HTTPException(status_code=500, detail=f"获取内容分析失败: {str(e)}")
 
 # 学术创作API
+async def prepare_academic_generation(request: AcademicWorkRequest):
+    """收集画像/词云上下文并构建学术创作提示词"""
+    # 获取用户画像和词云数据
+    user_profile_data = None
+    word_cloud_data = None
+    
+    if request.use_user_profile:
+        user_profile_data = await get_user_profile_data()
+    
+    if request.use_word_cloud:
+        word_cloud_data = await get_word_cloud_data()
+    
+    # 构建学术创作提示词
+    prompt = build_academic_prompt(request, user_profile_data, word_cloud_data)
+    return prompt, user_profile_data, word_cloud_data
+
+def save_academic_work(request: AcademicWorkRequest, generated_content: str, user_profile_data, word_cloud_data) -> int:
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO academic_works 
+            (work_type, title, content, keywords, user_profile_data, word_cloud_data, status)
+            VALUES (?, ?, ?, ?, ?, ?, 'completed')
+        ''', (request.work_type, request.title, generated_content,
+              ','.join(word_cloud_data.get('high_frequency', [])) if word_cloud_data else None,
+              json.dumps(user_profile_data, ensure_ascii=False) if user_profile_data else None,
+              json.dumps(word_cloud_data, ensure_ascii=False) if word_cloud_data else None))
+        work_id = cursor.lastrowid
+        conn.commit()
+        return work_id
+
 @app.post("/api/academic/generate")
-async def generate_academic_work(request: AcademicWorkRequest):
-    """生成学术作品"""
+async def generate_academic_work(request: AcademicWorkRequest, background: bool = False):
+    """生成学术作品（background=true 时加入后台队列并立即返回任务ID）"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            # 获取用户画像和词云数据
-            user_profile_data = None
-            word_cloud_data = None
-            
-            if request.use_user_profile:
-                # 这里应该从之前的分析结果中获取用户画像数据
-                user_profile_data = await get_user_profile_data()
-            
-            if request.use_word_cloud:
-                # 这里应该从之前的分析结果中获取词云数据
-                word_cloud_data = await get_word_cloud_data()
-            
-            # 构建学术创作提示词
-            prompt = build_academic_prompt(request, user_profile_data, word_cloud_data)
-            
-            # 获取AI配置并生成内容
-            cursor.execute("SELECT * FROM ai_configs WHERE is_active = 1 LIMIT 1")
-            ai_config = cursor.fetchone()
-            
-            if not ai_config:
-                raise HTTPException(status_code=400, detail="没有可用的AI配置")
-            
-            generated_content = await generate_content_with_ai(ai_config, prompt)
-            
-            # 保存学术作品
-            cursor.execute('''
-                INSERT INTO academic_works 
-                (work_type, title, content, user_profile_data, word_cloud_data, status)
-                VALUES (?, ?, ?, ?, ?, 'completed')
-            ''', (request.work_type, request.title, generated_content,
-                  json.dumps(user_profile_data) if user_profile_data else None,
-                  json.dumps(word_cloud_data) if word_cloud_data else None))
-            
-            work_id = cursor.lastrowid
-            conn.commit()
-            
-            return ApiResponse(
-                success=True,
-                message=f"学术作品生成成功",
-                data={
-                    "work_id": work_id,
-                    "work_type": request.work_type,
-                    "title": request.title,
-                    "content_preview": generated_content[:200] + "..." if len(generated_content) > 200 else generated_content
-                }
-            )
+        if background:
+            job_id = job_queue.enqueue("academic_generation", request.model_dump())
+            return ApiResponse(success=True, message="学术作品生成任务已加入队列", data={"job_id": job_id})
+        prompt, user_profile_data, word_cloud_data = await prepare_academic_generation(request)
+        
+        # 获取AI配置并生成内容
+        ai_config = get_active_ai_config()
+        generated_content = await generate_content_with_ai(ai_config, prompt, use_cache=not request.no_cache)
+        
+        # 保存学术作品
+        work_id = save_academic_work(request, generated_content, user_profile_data, word_cloud_data)
+        
+        return ApiResponse(
+            success=True,
+            message="学术作品生成成功",
+            data={
+                "work_id": work_id,
+                "work_type": request.work_type,
+                "title": request.title,
+                "content_preview": generated_content[:200] + "..." if len(generated_content) > 200 else generated_content
+            }
+        )
+    except Exception as e:
+        logger.error(f"学术作品生成失败: {e}")
+        raise HTTPException(status_code=500, detail=f"学术作品生成失败: {str(e)}")
+
+@app.post("/api/academic/generate/stream")
+async def generate_academic_work_stream(request: AcademicWorkRequest):
+    """流式生成学术作品：以SSE逐段推送正文，生成结束后保存到 academic_works 表"""
+    try:
+        prompt, user_profile_data, word_cloud_data = await prepare_academic_generation(request)
+        ai_config = get_active_ai_config()
+    except HTTPException as he:
+        raise he
     except Exception as e:
         logger.error(f"学术作品生成失败: {e}")
         raise HTTPException(status_code=500, detail=f"学术作品生成失败: {str(e)}")
 
+    def on_complete(text: str) -> dict:
+        return {"work_id": save_academic_work(request, text, user_profile_data, word_cloud_data)}
+
+    meta = {"work_type": request.work_type, "title": request.title}
+    return generation_sse_response(ai_config, prompt, meta, on_complete, use_cache=not request.no_cache)
+
 async def get_user_profile_data():
-    """获取用户画像数据"""
-    # 这里应该从历史数据中分析用户画像
-    # 目前返回模拟数据
-    return {
-        "interests": ["技术", "AI", "Web开发"],
-        "profession": "程序员",
-        "activity_pattern": "工作日活跃",
-        "content_preference": "技术文章"
-    }
+    """获取用户画像数据（读取物化画像，仅在首次使用时计算）"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        profile = load_user_profile(cursor)
+        if profile is None:
+            refresh_profile_rollups(cursor)
+            profile = refresh_user_profile(cursor, force=True)
+            conn.commit()
+        return profile
 
-async def get_word_cloud_data():
-    """获取词云数据"""
-    # 这里应该从历史数据中提取关键词
-    # 目前返回模拟数据
-    return {
-        "high_frequency": ["AI", "技术", "开发"],
-        "medium_frequency": ["产品", "设计", "创新"],
-        "low_frequency": ["管理", "团队", "效率"]
-    }
+async def get_word_cloud_data(start: Optional[int] = None, end: Optional[int] = None):
+    """获取词云数据（基于本地关键词索引计算 TF-IDF）"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # 兜底：补齐尚未索引的新记录
+        refresh_keyword_index(cursor)
+        conn.commit()
+        return build_keyword_tiers(compute_keywords(cursor, start, end))
 
 def build_academic_prompt(request: AcademicWorkRequest, user_profile, word_cloud) -> str:
     """构建学术创作提示词"""
@@ -2349,7 +7132,8 @@ def build_academic_prompt(request: AcademicWorkRequest, user_profile, word_cloud
 === 用户画像参考 ===
 兴趣领域: {', '.join(user_profile.get('interests', []))}
 职业背景: {user_profile.get('profession', '未知')}
-活动模式: {user_profile.get('activity_pattern', '未知')}"""
+活动模式: {user_profile.get('activity_pattern', '未知')}
+内容偏好: {user_profile.get('content_preference', '未知')}"""
     
     if word_cloud:
         base_prompt += f"""
@@ -2473,14 +7257,194 @@ async def get_academic_work_detail(work_id: int):
         logger.error(f"获取学术作品详情失败: {e}")
         raise HTTPException(status_code=500, detail=f"获取学术作品详情失败: {str(e)}")
 
+# 后台任务处理函数：参数为 (job_id, payload)，返回值作为任务结果保存
+async def run_batch_generation_job(job_id: int, payload: dict) -> dict:
+    task_id = payload['task_id']
+    try:
+        await process_batch_content_generation(task_id, BatchContentGenerationRequest(**payload['request']))
+    except asyncio.CancelledError:
+        # 服务关闭导致的中断不算取消，任务会在重启后继续
+        if not job_queue.stopping:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    UPDATE content_generation_tasks
+                    SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND status IN ('pending', 'processing')
+                ''', (task_id,))
+                conn.commit()
+            event_bus.publish("tasks", {"task_id": task_id, "status": "cancelled"})
+        raise
+    return {"task_id": task_id}
+
+async def run_analysis_job(job_id: int, payload: dict) -> dict:
+    ai_config = get_active_ai_config()
+    use_cache = not payload.get('no_cache')
+    prompt, records_used, info = await prepare_analysis(
+        ai_config, payload.get('limit'), payload.get('mode', 'direct'), payload.get('granularity', 'month'), use_cache
+    )
+    response_text = await generate_content_with_ai(ai_config, prompt, use_cache=use_cache)
+    summary_id = save_analysis_summary(response_text, records_used)
+    return {"summary_id": summary_id, "records_used": records_used, **info}
+
+async def run_bookmark_classify_job(job_id: int, payload: dict) -> dict:
+    items = load_unclassified_bookmarks(payload.get('limit', 100))
+    if not items:
+        return {"classified": 0}
+    ai_config = get_active_ai_config()
+    return await classify_unclassified_bookmarks(
+        ai_config, items, use_cache=not payload.get('no_cache'), source="job", job_id=job_id,
+        use_classifier=not payload.get('no_classifier')
+    )
+
+async def run_bookmark_classify_session_job(job_id: int, payload: dict) -> dict:
+    body = BookmarkClassifyStartRequest(**payload)
+    items = load_classify_session_items(body)
+    ai_config = get_active_ai_config(body.config_name)
+    result = await create_classify_session(ai_config, body, items, job_id=job_id)
+    result.pop("original", None)
+    return result
+
+async def run_academic_generation_job(job_id: int, payload: dict) -> dict:
+    request = AcademicWorkRequest(**payload)
+    prompt, user_profile_data, word_cloud_data = await prepare_academic_generation(request)
+    ai_config = get_active_ai_config()
+    generated_content = await generate_content_with_ai(ai_config, prompt, use_cache=not request.no_cache)
+    work_id = save_academic_work(request, generated_content, user_profile_data, word_cloud_data)
+    return {"work_id": work_id}
+
+JOB_HANDLERS = {
+    "batch_generation": run_batch_generation_job,
+    "analysis": run_analysis_job,
+    "bookmark_classify": run_bookmark_classify_job,
+    "bookmark_classify_session": run_bookmark_classify_session_job,
+    "academic_generation": run_academic_generation_job,
+}
+
+def serialize_job(row) -> Dict[str, Any]:
+    return {
+        "id": row['id'],
+        "job_type": row['job_type'],
+        "status": row['status'],
+        "attempts": row['attempts'],
+        "max_attempts": row['max_attempts'],
+        "cancel_requested": bool(row['cancel_requested']),
+        "payload": json.loads(row['payload']) if row['payload'] else None,
+        "result": json.loads(row['result']) if row['result'] else None,
+        "error_message": row['error_message'],
+        "heartbeat_at": row['heartbeat_at'],
+        "created_at": row['created_at'],
+        "started_at": row['started_at'],
+        "finished_at": row['finished_at'],
+        "updated_at": row['updated_at'],
+    }
+
+# 后台任务队列API
+@app.get("/api/jobs", response_model=ApiResponse)
+async def list_jobs(status: Optional[str] = None, job_type: Optional[str] = None, limit: int = 50):
+    """获取后台任务列表及各状态计数"""
+    try:
+        if status and status not in JOB_STATUSES:
+            raise HTTPException(status_code=400, detail=f"未知的任务状态: {status}")
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            where = []
+            params: list = []
+            if status:
+                where.append("status = ?")
+                params.append(status)
+            if job_type:
+                where.append("job_type = ?")
+                params.append(job_type)
+            where_clause = ("WHERE " + " AND ".join(where)) if where else ""
+            cursor.execute(f'''
+                SELECT * FROM ai_jobs {where_clause}
+                ORDER BY id DESC
+                LIMIT ?
+            ''', params + [max(1, min(limit, 500))])
+            jobs = [serialize_job(r) for r in cursor.fetchall()]
+            cursor.execute('SELECT status, COUNT(*) AS cnt FROM ai_jobs GROUP BY status')
+            counts = {r['status']: r['cnt'] for r in cursor.fetchall()}
+        return ApiResponse(
+            success=True,
+            message=f"获取到 {len(jobs)} 个任务",
+            data={"jobs": jobs, "counts": counts, "workers": job_queue.workers}
+        )
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"获取任务列表失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取任务列表失败: {str(e)}")
+
+@app.get("/api/jobs/{job_id}", response_model=ApiResponse)
+async def get_job(job_id: int):
+    """获取单个后台任务状态与结果"""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM ai_jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="任务不存在")
+        return ApiResponse(success=True, message="获取任务成功", data=serialize_job(row))
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"获取任务失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取任务失败: {str(e)}")
+
+@app.post("/api/jobs/{job_id}/cancel", response_model=ApiResponse)
+async def cancel_job(job_id: int):
+    """取消后台任务"""
+    try:
+        status = job_queue.cancel(job_id)
+        return ApiResponse(success=True, message="任务取消请求已提交", data={"job_id": job_id, "status": status})
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"取消任务失败: {e}")
+        raise HTTPException(status_code=500, detail=f"取消任务失败: {str(e)}")
+
+@app.post("/api/jobs/{job_id}/retry", response_model=ApiResponse)
+async def retry_job(job_id: int):
+    """重新排队失败或已取消的任务"""
+    try:
+        job_queue.retry(job_id)
+        return ApiResponse(success=True, message="任务已重新加入队列", data={"job_id": job_id})
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        logger.error(f"重试任务失败: {e}")
+        raise HTTPException(status_code=500, detail=f"重试任务失败: {str(e)}")
+
 # 应用启动时初始化数据库
 @app.on_event("startup")
 async def startup_event():
     """应用启动事件"""
     logger.info("正在启动浏览器历史记录API服务...")
     init_database()
+    # 首次启动时用已有的人工分类训练本地预分类器
+    learn_categories_safely([])
+    # 补齐上次运行后尚未处理的派生数据（会话、关键词索引等）
+    refresh_history_derivatives()
+    # 启动后台任务队列（继续执行上次未完成的任务）
+    await job_queue.start()
+    ai_router.start()
+    # 预加载激活配置的模型，并在有排队任务时续期 keep_alive
+    model_manager.start()
     logger.info("API服务启动完成，可以接收请求")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用关闭事件：停止后台任务队列与健康检查，释放AI后端连接池"""
+    await job_queue.stop()
+    await ai_router.stop()
+    await model_manager.stop()
+    ai_telemetry.flush()
+    await page_fetcher.close()
+    await ai_clients.close()
+    logger.info("AI后端连接池已关闭")
+
 if __name__ == "__main__":
     print("🚀 启动浏览器历史记录本地API服务")
     print("📊 服务地址: http://localhost:8000")
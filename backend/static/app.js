@@ -9,6 +9,45 @@ class HistoryManager {
         this.bindEvents();
         this.bootstrapOnboarding();
         this.loadData();
+        this.subscribeEvents();
+    }
+
+    // 订阅服务端实时事件（SSE），替代轮询
+    subscribeEvents() {
+        if (!window.EventSource) return;
+        const source = new EventSource(`${this.apiBase}/events?topics=stats,tasks,classification`);
+        source.addEventListener('stats', (e) => {
+            try {
+                this.updateStats(JSON.parse(e.data));
+            } catch (err) {
+                console.warn('解析统计事件失败', err);
+            }
+        });
+        source.addEventListener('tasks', (e) => {
+            let data;
+            try {
+                data = JSON.parse(e.data);
+            } catch (err) {
+                console.warn('解析任务事件失败', err);
+                return;
+            }
+            // 只处理内容生成任务；进度按事件就地更新，新任务或任务结束时才重新加载列表
+            if (data.task_id == null) return;
+            const finished = ['completed', 'failed', 'cancelled'].includes(data.status);
+            if (finished || !this.updateTaskRow(data)) {
+                clearTimeout(this.tasksReloadTimer);
+                this.tasksReloadTimer = setTimeout(() => this.loadTasks(), 500);
+            }
+        });
+        source.addEventListener('classification', (e) => {
+            try {
+                const data = JSON.parse(e.data);
+                if (data.status === 'completed') this.loadBookmarksStats();
+            } catch (err) {
+                console.warn('解析分类事件失败', err);
+            }
+        });
+        this.eventSource = source;
     }
     
     initializeElements() {
@@ -510,17 +549,16 @@ class HistoryManager {
             this.elements.tasksCard.classList.remove('hidden');
             const html = tasks.map(t => {
                 const progress = Math.min(100, Math.max(0, t.progress || 0));
-                const statusColor = t.status === 'completed' ? 'bg-green-600' : t.status === 'failed' ? 'bg-red-600' : 'bg-indigo-600';
                 return `
-                    <div class="border rounded-lg p-4">
+                    <div class="border rounded-lg p-4" data-task-row="${t.id}">
                         <div class="flex items-center justify-between">
                             <div class="font-medium text-gray-900">${this.escapeHtml(t.task_name)}</div>
-                            <div class="text-xs text-gray-500">${this.escapeHtml(t.status)} · ${new Date(t.updated_at || t.created_at).toLocaleString('zh-CN')}</div>
+                            <div class="text-xs text-gray-500"><span data-role="status">${this.escapeHtml(t.status)}</span> · <span data-role="time">${new Date(t.updated_at || t.created_at).toLocaleString('zh-CN')}</span></div>
                         </div>
                         <div class="mt-2 w-full bg-gray-200 rounded-full h-2">
-                            <div class="h-2 rounded-full ${statusColor}" style="width: ${progress}%"></div>
+                            <div data-role="bar" class="h-2 rounded-full ${this.taskStatusColor(t.status)}" style="width: ${progress}%"></div>
                         </div>
-                        <div class="mt-2 text-xs text-gray-600">进度：${progress}%</div>
+                        <div class="mt-2 text-xs text-gray-600">进度：<span data-role="progress">${progress}</span>%</div>
                         <div class="mt-3">
                             <button data-task-id="${t.id}" class="view-task btn-view px-3 py-1 text-sm bg-white border rounded hover:bg-gray-50">查看结果</button>
                         </div>
@@ -539,6 +577,27 @@ class HistoryManager {
         }
     }
 
+    taskStatusColor(status) {
+        return status === 'completed' ? 'bg-green-600' : status === 'failed' ? 'bg-red-600' : 'bg-indigo-600';
+    }
+
+    // 按任务事件更新列表中对应行的进度与状态；列表中没有该任务时返回 false
+    updateTaskRow(data) {
+        const row = this.elements.tasksContainer?.querySelector(`[data-task-row="${data.task_id}"]`);
+        if (!row) return false;
+        if (data.status) {
+            row.querySelector('[data-role="status"]').textContent = data.status;
+            row.querySelector('[data-role="bar"]').className = `h-2 rounded-full ${this.taskStatusColor(data.status)}`;
+        }
+        if (typeof data.progress === 'number') {
+            const progress = Math.min(100, Math.max(0, data.progress));
+            row.querySelector('[data-role="bar"]').style.width = `${progress}%`;
+            row.querySelector('[data-role="progress"]').textContent = progress;
+        }
+        row.querySelector('[data-role="time"]').textContent = new Date().toLocaleString('zh-CN');
+        return true;
+    }
+
     async viewTaskResult(taskId) {
         try {
             const resp = await fetch(`${this.apiBase}/content/tasks/${taskId}/results`);
@@ -119,6 +119,8 @@ class LinkManager {
                 <span class="inline-flex items-center px-2.5 py-0.5 rounded-full text-xs font-medium bg-gray-100 text-gray-800">
                     ${item.category}
                 </span>
+                ${item.category === '未分类' && item.predictedCategory ? `
+                <span class="ml-1 text-xs text-gray-400" title="预分类器建议的分类">建议: ${item.predictedCategory}</span>` : ''}
             </td>
             <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-900">
                 ${item.visitCount}